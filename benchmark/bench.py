@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""This module benchmarks the fasta/fastq code on synthetic inputs.
+
+    run_benchmarks() run every benchmark, each in a fresh process.
+
+        Example:
+
+            $ python3 bench.py -o bench.json -c 24 -l 1000000 -q 20000
+
+        This will generate a synthetic fasta and fastq (see synthetic.py) in
+        a temporary directory and write a JSON report of
+
+            sequence_load_index: Sequence() construction (fai loading)
+            sequence_query_{random,sorted}_{file,mmap}: Sequence.query_region
+            fasta_query_{random,sorted}: Fasta.query_region
+            get_rgstr_head / get_rgstr_full: get_rgstr on the gzip fastq
+
+        with ops/s, MB/s (bases or fastq bytes processed) and peak RSS of the
+        benchmark process, so that reports of two versions can be compared.
+
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import platform
+import resource
+import tempfile
+import argparse
+import multiprocessing
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(_HERE, '..'), os.path.join(_HERE, '..',
+                                                        'prototype')]
+from sequence import Sequence
+from region import Region
+from fasta import Fasta
+from fastq import get_rgstr
+import synthetic
+
+
+# =============================================================================
+
+def make_queries(fasta_name, nquery, query_len, sort, seed=1):
+    """Draw random query regions on a fasta.
+
+    Returns:
+        a list of (chrom, pstart, pend), sorted by fai order and position if
+        sort is True
+
+    """
+
+    fa = Fasta(fasta_name)
+    rand = random.Random(seed)
+    queries = []
+    for _ in range(nquery):
+        chrom = rand.choice(fa.chrom_list)
+        chrom_len = fa.fai_data[chrom]['chrom_len']
+        pstart = rand.randint(1, max(chrom_len - query_len + 1, 1))
+        queries.append((chrom, pstart,
+                        min(pstart + query_len - 1, chrom_len)))
+    if sort:
+        chrom_rank = {chrom: i for i, chrom in enumerate(fa.chrom_list)}
+        queries.sort(key=lambda query: (chrom_rank[query[0]], query[1]))
+    return queries
+
+# =============================================================================
+
+def bench_load_index(fasta_name, nrepeat):
+    """Construct Sequence objects (fai parsing)."""
+
+    for _ in range(nrepeat):
+        Sequence(fasta_name)
+    return nrepeat, os.path.getsize(fasta_name + '.fai') * nrepeat
+
+
+def bench_sequence_query(fasta_name, queries, mode):
+    """Query a Sequence object region by region."""
+
+    regions = [Region(*query) for query in queries]
+    nbase = 0
+    with Sequence(fasta_name, mode=mode) as seq:
+        for region in regions:
+            nbase += len(seq.query_region(region))
+    return len(regions), nbase
+
+
+def bench_fasta_query(fasta_name, queries):
+    """Query a Fasta object region by region."""
+
+    fa = Fasta(fasta_name)
+    nbase = 0
+    for chrom, pstart, pend in queries:
+        nbase += len(fa.query_region(chrom, pstart, pend)[1])
+    return len(queries), nbase
+
+
+def bench_get_rgstr(fastq_name, head_nline):
+    """Derive the read group of a fastq (MB/s only for a full scan)."""
+
+    get_rgstr(fastq_name, head_nline=head_nline)
+    return 1, None if head_nline else os.path.getsize(fastq_name)
+
+
+_BENCHMARKS = {
+    'load_index': bench_load_index,
+    'sequence_query': bench_sequence_query,
+    'fasta_query': bench_fasta_query,
+    'get_rgstr': bench_get_rgstr,
+}
+
+
+def _run_one(args):
+    """Run a benchmark (in a fresh worker process) and measure it."""
+
+    bench_name, bench_args = args
+    time_start = time.perf_counter()
+    nop, nbyte = _BENCHMARKS[bench_name](*bench_args)
+    seconds = time.perf_counter() - time_start
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return {
+        'nop': nop,
+        'seconds': seconds,
+        'ops_per_s': nop / seconds if seconds else None,
+        'mb_per_s': (nbyte / 1e6 / seconds
+                     if seconds and nbyte is not None else None),
+        'peak_rss_mb': peak_rss / 1e6,
+    }
+
+# =============================================================================
+
+def run_benchmarks(work_dir, ncontig=24, contig_len=1000000, line_width=60,
+                   nquery=20000, query_len=200, nread=200000, nrepeat=3):
+    """Generate the synthetic inputs and run every benchmark.
+
+    Each benchmark runs in its own spawned process so its peak RSS is not
+    affected by the others; the best of nrepeat runs (by time) is reported.
+
+    Returns:
+        a dictionary with the benchmark settings, platform information and
+        the results of every benchmark
+
+    """
+
+    fasta_name = os.path.join(work_dir, 'synthetic.fa')
+    fastq_name = os.path.join(work_dir, 'synthetic.fastq.gz')
+    synthetic.write_fasta(fasta_name, ncontig, contig_len, line_width)
+    synthetic.write_fastq(fastq_name, nread)
+
+    benchmarks = [('sequence_load_index', 'load_index', (fasta_name, 100))]
+    for order in ('random', 'sorted'):
+        queries = make_queries(fasta_name, nquery, query_len,
+                               order == 'sorted')
+        for mode in ('file', 'mmap'):
+            benchmarks.append(('sequence_query_{}_{}'.format(order, mode),
+                               'sequence_query', (fasta_name, queries, mode)))
+        benchmarks.append(('fasta_query_{}'.format(order), 'fasta_query',
+                           (fasta_name, queries)))
+    benchmarks.append(('get_rgstr_head', 'get_rgstr', (fastq_name, 1000)))
+    benchmarks.append(('get_rgstr_full', 'get_rgstr', (fastq_name, 0)))
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, bench_name, bench_args in benchmarks:
+        runs = []
+        for _ in range(nrepeat):
+            with context.Pool(1) as pool:
+                runs.append(pool.apply(_run_one, ((bench_name, bench_args),)))
+        results[name] = min(runs, key=lambda run: run['seconds'])
+        print(':: {} {:.3f}s'.format(name, results[name]['seconds']),
+              file=sys.stderr, flush=True)
+
+    return {
+        'settings': {
+            'ncontig': ncontig,
+            'contig_len': contig_len,
+            'line_width': line_width,
+            'nquery': nquery,
+            'query_len': query_len,
+            'nread': nread,
+            'nrepeat': nrepeat,
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'system': platform.platform(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+# =============================================================================
+
+def main():
+    """Wrapper of function run_benchmarks() with command line inputs."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-o', '--output', metavar="json_name",
+                        help="output JSON report (default: stdout)",
+                        type=str, required=False, default=None)
+    parser.add_argument('-d', '--workdir', metavar="work_dir",
+                        help=("directory for the synthetic inputs (default: "
+                              "a temporary directory)"),
+                        type=str, required=False, default=None)
+    parser.add_argument('-c', '--ncontig', metavar="num_contig",
+                        help="number of contigs (default: 24)",
+                        type=int, required=False, default=24)
+    parser.add_argument('-l', '--contig-len', metavar="contig_len",
+                        help="bases per contig (default: 1000000)",
+                        type=int, required=False, default=1000000)
+    parser.add_argument('-w', '--line-width', metavar="line_width",
+                        help="bases per fasta line (default: 60)",
+                        type=int, required=False, default=60)
+    parser.add_argument('-q', '--nquery', metavar="num_query",
+                        help="number of region queries (default: 20000)",
+                        type=int, required=False, default=20000)
+    parser.add_argument('-r', '--nread', metavar="num_read",
+                        help="number of fastq reads (default: 200000)",
+                        type=int, required=False, default=200000)
+    parser.add_argument('-n', '--nrepeat', metavar="num_repeat",
+                        help="runs per benchmark, best kept (default: 3)",
+                        type=int, required=False, default=3)
+
+    args = parser.parse_args()
+
+    settings = (args.ncontig, args.contig_len, args.line_width, args.nquery,
+                200, args.nread, args.nrepeat)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        report = run_benchmarks(args.workdir, *settings)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = run_benchmarks(work_dir, *settings)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print(file=sys.stdout, flush=True)
+
+# =============================================================================
+
+if __name__ == '__main__':
+
+    main()
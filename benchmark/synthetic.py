@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""This module generates synthetic inputs for the benchmarks.
+
+    write_fasta() write a random fasta file with its fai index.
+    write_fastq() write a random gzip fastq file with Illumina read ids.
+
+        Example:
+
+            $ python3 synthetic.py -o out_dir -c 24 -l 1000000 -w 60 -r 100000
+
+        This will write "out_dir/synthetic.fa" (24 contigs of 1 Mbp, 60 bases
+        per line) with "synthetic.fa.fai", and "out_dir/synthetic.fastq.gz"
+        (100000 reads).
+
+    The same seed always gives the same files.
+
+"""
+
+import sys
+import os
+import gzip
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'prototype'))
+from fasta import Fasta
+
+
+# random bytes to bases (uniform: 256 is a multiple of 4)
+_BASES = bytes(b'ACGT'[byte % 4] for byte in range(256))
+_QUALS = bytes(b'#+5?AEFIJ'[byte % 9] for byte in range(256))
+
+# =============================================================================
+
+def write_fasta(fasta_name, ncontig=24, contig_len=1000000, line_width=60,
+                n_frac=0.01, mask_frac=0.1, seed=1):
+    """Write a random fasta file and its fai index.
+
+    Args:
+        fasta_name (str): output fasta file name (fai is fasta_name + '.fai')
+        ncontig (int): number of contigs (named chr1, chr2, ...)
+        contig_len (int): number of bases per contig
+        line_width (int): number of bases per line
+        n_frac (float): fraction of bases in N runs (runs of 1 kbp)
+        mask_frac (float): fraction of bases soft-masked (runs of 300 bp)
+        seed (int): random seed
+
+    """
+
+    rand = random.Random(seed)
+    with Fasta(fasta_name, mode='w', line_width=line_width) as fa:
+        for icontig in range(ncontig):
+            seq = bytearray(rand.randbytes(contig_len).translate(_BASES))
+            for _ in range(int(contig_len * n_frac) // 1000):
+                pos = rand.randrange(contig_len)
+                seq[pos:pos + 1000] = b'N' * len(seq[pos:pos + 1000])
+            for _ in range(int(contig_len * mask_frac) // 300):
+                pos = rand.randrange(contig_len)
+                seq[pos:pos + 300] = seq[pos:pos + 300].lower()
+            fa.write_record('chr{}'.format(icontig + 1), seq.decode())
+
+# =============================================================================
+
+def write_fastq(fastq_name, nread=100000, read_len=150, nlane=2, seed=1):
+    """Write a random gzip fastq file.
+
+    Read ids are of the form @INSTRUMENT:RUN:FLOWCELL:LANE:TILE:X:Y, with the
+    lanes interleaved.
+
+    Args:
+        fastq_name (str): output fastq file name
+        nread (int): number of reads
+        read_len (int): number of bases per read
+        nlane (int): number of lanes
+        seed (int): random seed
+
+    """
+
+    rand = random.Random(seed)
+    with gzip.open(fastq_name, 'wb', compresslevel=6) as f:
+        for iblock in range(0, nread, 10000):
+            records = []
+            for iread in range(iblock, min(iblock + 10000, nread)):
+                seq = rand.randbytes(read_len).translate(_BASES)
+                qual = rand.randbytes(read_len).translate(_QUALS)
+                records.append(b'@SIM-0001:42:HSYNTHXX:%d:%d:%d:%d 1:N:0:ACGT'
+                               b'\n%s\n+\n%s\n'
+                               % (iread % nlane + 1, 1101 + iread % 64,
+                                  rand.randrange(30000),
+                                  rand.randrange(30000), seq, qual))
+            f.write(b''.join(records))
+
+# =============================================================================
+
+def main():
+    """Wrapper of write_fasta() and write_fastq() with command line inputs."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-o', '--outdir', metavar="out_dir",
+                        help="output directory",
+                        type=str, required=True)
+    parser.add_argument('-c', '--ncontig', metavar="num_contig",
+                        help="number of contigs (default: 24)",
+                        type=int, required=False, default=24)
+    parser.add_argument('-l', '--contig-len', metavar="contig_len",
+                        help="bases per contig (default: 1000000)",
+                        type=int, required=False, default=1000000)
+    parser.add_argument('-w', '--line-width', metavar="line_width",
+                        help="bases per fasta line (default: 60)",
+                        type=int, required=False, default=60)
+    parser.add_argument('-r', '--nread', metavar="num_read",
+                        help="number of fastq reads (default: 100000)",
+                        type=int, required=False, default=100000)
+    parser.add_argument('-s', '--seed', metavar="seed",
+                        help="random seed (default: 1)",
+                        type=int, required=False, default=1)
+
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    write_fasta(os.path.join(args.outdir, 'synthetic.fa'), args.ncontig,
+                args.contig_len, args.line_width, seed=args.seed)
+    write_fastq(os.path.join(args.outdir, 'synthetic.fastq.gz'), args.nread,
+                seed=args.seed)
+
+# =============================================================================
+
+if __name__ == '__main__':
+
+    main()
@@ -13,11 +13,40 @@
             > 16:90000-90060
             ACCATGCCCAGCATGAGCCACTGCACCCAGATTAATTTTTGTATTTTTAGTAAAGATGAGG
 
+    query_region_file() query fasta file with all regions in a BED file or a
+    region list, using a pool of worker processes.
+
+        Example:
+
+            $ python3 fasta.py -f fasta_name -r region_file -t nproc
+
+        This will write one record per region (in the same format as above)
+        in the order of the region file. BED lines are 0-based half-open;
+        region list lines are "chrom", "chrom:pos" or "chrom:pstart-pend"
+        (1-based inclusive).
+
+    build_index() build the fai index of a fasta file (samtools compatible).
+
+        Example:
+
+            $ python3 fasta.py -f fasta_name -i -t nproc
+
+        This will scan the fasta file with "nproc" processes (split at contig
+        boundaries) and write "fasta_name.fai".
+
 """
 
 import sys
 import os
+import mmap
+import time
+import logging
 import argparse
+import itertools
+import collections
+import multiprocessing
+
+logger = logging.getLogger(__name__)
 
 
 # =============================================================================
@@ -31,25 +60,116 @@ class Fasta(object):
         fai_data (dict): key = chrom, value = chrom lenth and offset in fasta
         chrom_list (list): ordered list of chromosome names
 
+    A Fasta opened with use_mmap=True keeps one read-only memory map of the
+    fasta for its lifetime, and should be closed with close() or used as a
+    context manager:
+
+        with Fasta(fasta_name, use_mmap=True) as fa:
+            reg, seq = fa.query_region(chrom, pstart, pend)
+
+    A Fasta opened with mode='w' writes records with write_record() and
+    writes the fai index of the new fasta on close():
+
+        with Fasta(fasta_name, mode='w') as fa:
+            fa.write_record(chrom, sequence)
+
     """
 
-    def __init__(self, fasta_name, mode='r'):
+    def __init__(self, fasta_name, mode='r', use_mmap=False, line_width=60,
+                 stats=False):
         """Initialize a Fastq object to read/write.
 
         Args:
             fasta_name (string): fasta file name
+            mode (string): 'r' to read, 'w' to write
+            use_mmap (bool): keep the fasta memory mapped between queries
+            line_width (int): number of bases per line when writing
+            stats (bool): count queries, bytes read and query time, see
+                stats()
+
+        If the fai index of a fasta to read does not exist, it is built with
+        build_index().
 
         """
 
         self.fa_name = fasta_name
         self.fai_name = fasta_name + '.fai'
+        self.fa_mmap = None
+        self.fa_file = None
+        self.index_load_seconds = 0.0
+        self._stats = collections.Counter() if stats else None
+        self._hooks = []
         if mode == 'r':
+            time_start = time.perf_counter()
+            if not os.path.isfile(self.fai_name):
+                build_index(self.fa_name)
             self.fai_data, self.chrom_list = self.read_index()
+            self.index_load_seconds = time.perf_counter() - time_start
+            if use_mmap:
+                self.open_mmap()
         else:
             # functions for writing a fasta file
             self.fai_data = {}
             self.chrom_list = []
-            pass
+            self.line_width = line_width
+            self.fa_file = open(self.fa_name, 'wb')
+
+# =============================================================================
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_mmap(self):
+        """Memory map the fasta for the following queries."""
+        if self.fa_mmap is None:
+            with open(self.fa_name, 'rb') as f:
+                self.fa_mmap = mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Release the memory map of the fasta (if any).
+
+        In write mode, finish the fasta and write its fai index.
+        """
+        if self.fa_mmap is not None:
+            self.fa_mmap.close()
+            self.fa_mmap = None
+        if self.fa_file is not None:
+            self.fa_file.close()
+            self.fa_file = None
+            write_index(self.fai_name, self.fai_data, self.chrom_list)
+
+# =============================================================================
+
+    def stats(self):
+        """Return a snapshot of the query statistics.
+
+        Returns:
+            a dictionary of index_load_seconds (float), queries, bases,
+            bytes_read, seeks (int) and query_seconds (float); counters stay 0
+            unless the Fasta is opened with stats=True
+        """
+        query_stats = self._stats or collections.Counter()
+        return {
+            'index_load_seconds': self.index_load_seconds,
+            'queries': query_stats['queries'],
+            'bases': query_stats['bases'],
+            'bytes_read': query_stats['bytes_read'],
+            'seeks': query_stats['seeks'],
+            'query_seconds': query_stats['query_seconds'],
+        }
+
+    def add_hook(self, callback):
+        """Call callback('query_region', info) after every query, with info a
+        dictionary of region, nbase and seconds of the query."""
+        self._hooks.append(callback)
+
+    def remove_hook(self, callback):
+        """Stop calling a callback added with add_hook()."""
+        self._hooks.remove(callback)
 
 # =============================================================================
 
@@ -101,11 +221,45 @@ class Fasta(object):
                 }
                 chrom_list.append(chrom)
         if not fai_data or not chrom_list:
-            print('*WARNING* can not find any chromosome/contig in {}'
-                  .format(self.fai_name), file=sys.stderr, flush=True)
+            logger.warning('can not find any chromosome/contig in %s',
+                           self.fai_name)
 
         return fai_data, chrom_list
 
+# =============================================================================
+
+    def write_record(self, chrom, sequence, description=None):
+        """Write a sequence record to a fasta opened in write mode.
+
+        Args:
+            chrom (str): chromosome/contig name (must be unique in the fasta)
+            sequence (str): sequence of the record
+            description (str): optional text after the name in header line
+
+        The fai entry of the record is derived from the bytes written.
+        """
+
+        if chrom in self.fai_data:
+            raise ValueError('duplicated chrom "{}" in fasta {}'
+                             .format(chrom, self.fa_name))
+        header = '>{}'.format(chrom)
+        if description:
+            header += ' ' + description
+        self.fa_file.write(header.encode() + b'\n')
+        byte_offset = self.fa_file.tell()
+        sequence = sequence.encode()
+        width = self.line_width
+        self.fa_file.write(b''.join(sequence[i:i + width] + b'\n'
+                                    for i in range(0, len(sequence), width)))
+        self.fai_data[chrom] = {
+            'chrom_len': len(sequence),
+            'byte_offset': byte_offset,
+            'line_nbase': width if len(sequence) > width else len(sequence),
+            'line_nchar': (width if len(sequence) > width
+                           else len(sequence)) + 1,
+        }
+        self.chrom_list.append(chrom)
+
 # =============================================================================
 
     def query_region(self, chrom, pstart, pend):
@@ -125,10 +279,28 @@ class Fasta(object):
                 range)
         """
 
+        if self._stats is None and not self._hooks:
+            return self._query_region(chrom, pstart, pend)
+        time_start = time.perf_counter()
+        result = self._query_region(chrom, pstart, pend)
+        seconds = time.perf_counter() - time_start
+        nbase = len(result[1]) if result and result[1] else 0
+        if self._stats is not None:
+            self._stats['queries'] += 1
+            self._stats['bases'] += nbase
+            self._stats['query_seconds'] += seconds
+        for callback in self._hooks:
+            callback('query_region', {'region': result and result[0],
+                                      'nbase': nbase, 'seconds': seconds})
+        return result
+
+    def _query_region(self, chrom, pstart, pend):
+        """Query a sequence region, see query_region()."""
+
         sequence = None
         if chrom not in self.fai_data:
-            print('*Warning* query chrom "{}" is not found in fasta {}'
-                  .format(chrom, self.fa_name), file=sys.stderr, flush=True)
+            logger.warning('query chrom "%s" is not found in fasta %s',
+                           chrom, self.fa_name)
             return sequence
 
         if not pstart:
@@ -140,23 +312,20 @@ class Fasta(object):
         region = '{}:{}-{}'.format(chrom, pstart, pend)
 
         if pstart < 1 or pstart > self.fai_data[chrom]['chrom_len']:
-            print('*Warning* illegal query starting position {} (must be '
-                  '1-based within range [1,{}] for chrom {})'
-                  .format(pstart, self.fai_data[chrom]['chrom_len'], chrom),
-                  file=sys.stderr, flush=True)
+            logger.warning('illegal query starting position %d (must be '
+                           '1-based within range [1,%d] for chrom %s)',
+                           pstart, self.fai_data[chrom]['chrom_len'], chrom)
             return region, sequence
 
         if pend < 1 or pend > self.fai_data[chrom]['chrom_len']:
-            print('*Warning* illegal query ending position {} (must be '
-                  '1-based within range [1,{}] for chrom {})'
-                  .format(pend, self.fai_data[chrom]['chrom_len'], chrom),
-                  file=sys.stderr, flush=True)
+            logger.warning('illegal query ending position %d (must be '
+                           '1-based within range [1,%d] for chrom %s)',
+                           pend, self.fai_data[chrom]['chrom_len'], chrom)
             return region, sequence
 
         if pend < pstart:
-            print('*Warning* query region is of negative length ({}:{}-{})'
-                  .format(chrom, pstart, pend),
-                  file=sys.stderr, flush=True)
+            logger.warning('query region is of negative length (%s:%d-%d)',
+                           chrom, pstart, pend)
             return region, sequence
 
         chrom_offset = self.fai_data[chrom]['byte_offset']
@@ -168,15 +337,310 @@ class Fasta(object):
         offset_end = (chrom_offset + (pend - 1) + line_ndiff *
                         ((pend - 1) // line_nbase))
         read_nbyte = offset_end - offset_start + 1
+        if self._stats is not None:
+            self._stats['seeks'] += 1
+            self._stats['bytes_read'] += read_nbyte
 
-        with open(self.fa_name) as f:
-            f.seek(offset_start)
-            sequence = f.read(read_nbyte).replace('\n', '')
+        if self.fa_mmap is not None:
+            sequence = (self.fa_mmap[offset_start:offset_start + read_nbyte]
+                        .replace(b'\n', b'').decode())
+        else:
+            with open(self.fa_name) as f:
+                f.seek(offset_start)
+                sequence = f.read(read_nbyte).replace('\n', '')
 
         return region, sequence
 
 # =============================================================================
 
+def write_index(fai_name, fai_data, chrom_list):
+    """Write a fai index (samtools faidx format).
+
+    Args:
+        fai_name (str): fai index file name
+        fai_data (dict): fai data as returned by Fasta.read_index()
+        chrom_list (list): ordered list of chromosome names
+
+    """
+
+    with open(fai_name, 'w') as f:
+        for chrom in chrom_list:
+            f.write('{}\t{}\t{}\t{}\t{}\n'
+                    .format(chrom,
+                            fai_data[chrom]['chrom_len'],
+                            fai_data[chrom]['byte_offset'],
+                            fai_data[chrom]['line_nbase'],
+                            fai_data[chrom]['line_nchar']))
+
+
+def _count_newline(fa_mmap, start, end, buffer_nbyte=67108864):
+    """Count newlines in fa_mmap[start:end] reading buffer_nbyte at a time."""
+
+    count = 0
+    for pos in range(start, end, buffer_nbyte):
+        count += fa_mmap[pos:min(pos + buffer_nbyte, end)].count(b'\n')
+    return count
+
+
+def _index_contig(fa_mmap, chrom, seq_start, seq_end):
+    """Derive and validate the fai entry of a contig.
+
+    Args:
+        fa_mmap (mmap): memory map of the fasta
+        chrom (str): contig name
+        seq_start (int): byte offset of the first base of the contig
+        seq_end (int): byte offset of the next header (or end of file)
+
+    Returns:
+        a dictionary of fai data (see Fasta.read_index()) of the contig
+
+    Raises:
+        ValueError: lines of the contig are not of the same length (except
+            the last one)
+
+    """
+
+    # trailing empty lines are tolerated
+    while seq_end > seq_start and fa_mmap[seq_end - 1] in b'\r\n':
+        seq_end -= 1
+    first_newline = fa_mmap.find(b'\n', seq_start, seq_end)
+    if first_newline == -1:
+        chrom_len = seq_end - seq_start
+        line_nend = 2 if fa_mmap[seq_end:seq_end + 2] == b'\r\n' else 1
+        return {
+            'chrom_len': chrom_len,
+            'byte_offset': seq_start,
+            'line_nbase': chrom_len,
+            'line_nchar': chrom_len + line_nend,
+        }
+
+    line_nchar = first_newline - seq_start + 1
+    line_nend = 2 if fa_mmap[first_newline - 1] == ord('\r') else 1
+    line_nbase = line_nchar - line_nend
+    nline = _count_newline(fa_mmap, seq_start, seq_end)
+    # newlines of full lines must be every line_nchar bytes, and the last
+    # line (without newline after the trailing strip) not longer than others
+    newline_chars = fa_mmap[seq_start + line_nchar - 1:seq_end:line_nchar]
+    last_nbase = (seq_end - seq_start) - nline * line_nchar
+    if (newline_chars[:nline].count(b'\n') != nline or
+        not 0 < last_nbase <= line_nbase or
+        (line_nend == 2 and
+         fa_mmap[seq_start + line_nchar - 2:seq_end:line_nchar][:nline]
+         .count(b'\r') != nline)):
+        raise ValueError('different line length in contig "{}" at byte {}'
+                         .format(chrom, seq_start))
+    return {
+        'chrom_len': nline * line_nbase + last_nbase,
+        'byte_offset': seq_start,
+        'line_nbase': line_nbase,
+        'line_nchar': line_nchar,
+    }
+
+
+def _index_chunk(fasta_name, chunk_start, chunk_end):
+    """Index all contigs whose header starts in a chunk of the fasta.
+
+    Returns:
+        a list of (chrom, fai data) in the order of the fasta
+
+    """
+
+    entries = []
+    with open(fasta_name, 'rb') as f:
+        fa_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = chunk_start
+        while pos < chunk_end:
+            if fa_mmap[pos] != ord('>'):
+                raise ValueError('expect fasta header at byte {} in {}'
+                                 .format(pos, fasta_name))
+            header_end = fa_mmap.find(b'\n', pos)
+            if header_end == -1:
+                header_end = len(fa_mmap)
+            chrom = fa_mmap[pos + 1:header_end].split()[0].decode()
+            seq_end = fa_mmap.find(b'\n>', header_end, chunk_end)
+            seq_end = chunk_end if seq_end == -1 else seq_end + 1
+            entries.append((chrom, _index_contig(fa_mmap, chrom,
+                                                 header_end + 1, seq_end)))
+            pos = seq_end
+    finally:
+        fa_mmap.close()
+    return entries
+
+
+def build_index(fasta_name, nproc=1, fai_name=None):
+    """Build the fai index of a fasta file.
+
+    The fasta is split into nproc chunks at contig boundaries, which are
+    indexed in parallel with large buffered scans (no per-line python loop).
+    The line length of every contig is validated.
+
+    Args:
+        fasta_name (str): fasta file name
+        nproc (int): number of worker processes
+        fai_name (str): output fai name (default: fasta_name + '.fai')
+
+    Returns:
+        fai_data (dict): fai data as returned by Fasta.read_index()
+        chrom_list (list): ordered list of chromosome names
+
+    Raises:
+        ValueError: the fasta is malformed (no header, inconsistent line
+            length, duplicated contig names)
+
+    """
+
+    if not fai_name:
+        fai_name = fasta_name + '.fai'
+    file_nbyte = os.path.getsize(fasta_name)
+    chunk_bounds = [0]
+    if file_nbyte > 0:
+        with open(fasta_name, 'rb') as f:
+            fa_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with fa_mmap:
+            for ichunk in range(1, max(nproc, 1)):
+                pos = fa_mmap.find(b'\n>',
+                                   max(file_nbyte * ichunk // nproc - 1, 0))
+                pos = file_nbyte if pos == -1 else pos + 1
+                if pos > chunk_bounds[-1]:
+                    chunk_bounds.append(pos)
+    if chunk_bounds[-1] < file_nbyte:
+        chunk_bounds.append(file_nbyte)
+    chunks = [(fasta_name, start, end)
+              for start, end in zip(chunk_bounds[:-1], chunk_bounds[1:])]
+
+    if nproc > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(nproc, len(chunks))) as pool:
+            chunk_entries = pool.starmap(_index_chunk, chunks)
+    else:
+        chunk_entries = [_index_chunk(*chunk) for chunk in chunks]
+
+    fai_data = {}
+    chrom_list = []
+    for entries in chunk_entries:
+        for chrom, entry in entries:
+            if chrom in fai_data:
+                raise ValueError('duplicated contig name "{}" in {}'
+                                 .format(chrom, fasta_name))
+            fai_data[chrom] = entry
+            chrom_list.append(chrom)
+    write_index(fai_name, fai_data, chrom_list)
+    return fai_data, chrom_list
+
+# =============================================================================
+
+def read_region_file(region_name):
+    """Read query regions from a BED file or a region list.
+
+    Args:
+        region_name (str): name of BED file (chrom, start, end, ... separated
+            by tab, 0-based half-open) or region list file (one region per
+            line: chrom, chrom:pos or chrom:pstart-pend, 1-based inclusive).
+            Empty, comment (#), track and browser lines are skipped.
+
+    Yields:
+        (chrom, pstart, pend): query region (pstart and pend are 1-based
+            inclusive, None for a whole chromosome)
+
+    """
+    with open(region_name) as f:
+        for line in f:
+            line = line.rstrip()
+            if not line or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split('\t')
+            if len(fields) >= 3:
+                yield fields[0], int(fields[1]) + 1, int(fields[2])
+                continue
+            chrom, _, pos_range = fields[0].rpartition(':')
+            if not chrom:
+                yield pos_range, None, None
+                continue
+            pstart, _, pend = pos_range.replace(',', '').partition('-')
+            yield chrom, int(pstart), int(pend) if pend else int(pstart)
+
+# =============================================================================
+
+_worker_fasta = None
+
+
+def _init_worker(fasta):
+    """Set up a pool worker with the parsed fasta index of the parent."""
+
+    global _worker_fasta
+    _worker_fasta = fasta
+    _worker_fasta.open_mmap()
+
+
+def _query_region_list(region_list):
+    """Query a list of (chrom, pstart, pend) in the worker fasta."""
+
+    records = []
+    for chrom, pstart, pend in region_list:
+        result = _worker_fasta.query_region(chrom, pstart, pend)
+        if result is None or result[1] is None:
+            continue
+        records.append(result)
+    return records
+
+
+def query_region_file(fasta_name, region_name, out_file=sys.stdout, nproc=1,
+                      chunk_size=1000):
+    """Query a fasta file with all regions in a region file.
+
+    Regions are streamed from the region file in chunks of chunk_size, and at
+    most 2 * nproc chunks are in flight at any time, so the memory usage does
+    not grow with the number of regions. Records are written in the order of
+    the region file, regions with a query error are skipped (with warning).
+
+    Args:
+        fasta_name (str): fasta file name (with .fai index)
+        region_name (str): BED or region list file (see read_region_file())
+        out_file (file): output file for the fasta records
+        nproc (int): number of worker processes
+        chunk_size (int): number of regions sent to a worker at a time
+
+    Returns:
+        nrecord (int): number of records written
+
+    """
+
+    fa = Fasta(fasta_name)
+    region_iter = read_region_file(region_name)
+    chunk_iter = iter(lambda: list(itertools.islice(region_iter, chunk_size)),
+                      [])
+    nrecord = 0
+
+    def write_records(records):
+        for reg, seq in records:
+            out_file.write('> {}\n{}\n'.format(reg, seq))
+        return len(records)
+
+    if nproc <= 1:
+        _init_worker(fa)
+        for region_list in chunk_iter:
+            nrecord += write_records(_query_region_list(region_list))
+        _worker_fasta.close()
+        out_file.flush()
+        return nrecord
+
+    # the parsed fai is handed to the workers once (inherited on fork,
+    # pickled once per worker otherwise), each worker maps the fasta itself
+    with multiprocessing.Pool(nproc, initializer=_init_worker,
+                              initargs=(fa,)) as pool:
+        pending = collections.deque()
+        for region_list in chunk_iter:
+            pending.append(pool.apply_async(_query_region_list,
+                                            (region_list,)))
+            if len(pending) >= 2 * nproc:
+                nrecord += write_records(pending.popleft().get())
+        while pending:
+            nrecord += write_records(pending.popleft().get())
+    out_file.flush()
+    return nrecord
+
+# =============================================================================
+
 def main():
     """Wrapper of function fasta.query_region() with command line inputs."""
 
@@ -187,7 +651,7 @@ def main():
                         type=argparse.FileType('r'), required=True)
     parser.add_argument('-c', '--chrom', metavar="chrom_name",
                         help="chromosome name",
-                        type=str, required=True)
+                        type=str, required=False, default=None)
     parser.add_argument('-a', '--pstart', metavar="pos_start",
                         help=("starting genomic position 1-based inclusive "
                               "(default: 1)"),
@@ -196,10 +660,38 @@ def main():
                         help=("ending genomic position 1-based inclusive "
                               "(default: chromosome length)"),
                         type=int, required=False, default=None)
+    parser.add_argument('-r', '--regions', metavar="region_file",
+                        help=("BED file or region list (chrom:pstart-pend per "
+                              "line) to query instead of -c/-a/-b"),
+                        type=argparse.FileType('r'), required=False,
+                        default=None)
+    parser.add_argument('-i', '--index',
+                        help="build the fai index of the fasta",
+                        action='store_true')
+    parser.add_argument('-t', '--nproc', metavar="num_proc",
+                        help=("number of worker processes for -r/-i "
+                              "(default: 1)"),
+                        type=int, required=False, default=1)
 
     args = parser.parse_args()
+    logging.basicConfig(format='*%(levelname)s* %(message)s')
+    if not args.chrom and not args.regions and not args.index:
+        parser.error('one of -c/--chrom, -r/--regions or -i/--index is '
+                     'required')
 
     fasta_name = args.fasta.name
+    if args.index:
+        fai_data, chrom_list = build_index(fasta_name, args.nproc)
+        print(':: indexed {} contigs in {}'.format(len(chrom_list),
+                                                    fasta_name),
+              file=sys.stderr, flush=True)
+        return
+
+    if args.regions:
+        query_region_file(fasta_name, args.regions.name, sys.stdout,
+                          args.nproc)
+        return
+
     chrom = args.chrom
     pstart = args.pstart
     pend = args.pend
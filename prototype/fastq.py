@@ -13,19 +13,434 @@
             @RG ID:HWI-7001457:234:1 PL:ILLUMINA PU:HWI-7001457:234:C6UK1ANXX:1
             SM:QM4
 
+    read_fastq() iterate over (header, seq, plus, qual) records of a plain or
+    gzip fastq file in process.
+
+    map_fastq() split a plain or BGZF fastq file into chunks at record
+    boundaries and process the chunks with a map/reduce callback in a pool of
+    worker processes.
+
+    read_group_census() count the reads of every flowcell/lane in the whole
+    fastq file and derive one RG string per lane.
+
+        Example:
+
+            $ python3 fastq.py -f fastq_name -c -t nproc
+
+        This will print one RG line per flowcell/lane found in the fastq (and
+        the read count of each lane to stderr). With "-o out_prefix", the
+        fastq is also split into one fastq per read group
+        "out_prefix.{ID}.fastq.gz".
+
+    batch_rgstr() derive the RG strings of many fastq files in a pool of
+    worker processes, with a result cache on disk.
+
+        Example:
+
+            $ python3 fastq.py -g 'run42/*.fastq.gz' -C rg_cache.json -t 16
+
+        This will print a TSV table (fastq, ID, PL, PU, SM, error) of every
+        fastq (-m manifest for a list of fastq files, -j for JSON output).
+        Files already in the cache, with the same size and modification
+        time, are not read again.
+
+    fastq_qc() compute QC statistics of the whole fastq file: per cycle base
+    composition and quality distribution, GC and length histograms, N
+    content and an estimate of the duplicate rate.
+
+        Example:
+
+            $ python3 fastq.py -f fastq_name -q -t nproc > qc.json
+
 """
 
 import sys
-from subprocess import PIPE, Popen
+import glob
+import gzip
 import json
 import os
 import argparse
+import zlib
+import heapq
+import struct
+import functools
+import operator
+import itertools
+import collections
+import multiprocessing
+
+
+# =============================================================================
+
+def read_fastq(fastq_name, buffer_nbyte=4194304):
+    """Iterate over the records of a fastq file.
+
+    The file is read buffer_nbyte at a time and split into lines in bulk;
+    lines are kept as bytes (no decoding). Gzip input (including multi-member
+    gzip such as concatenated or BGZF files) is detected from its magic bytes
+    and decompressed in process.
+
+    Args:
+        fastq_name (string): fastq file name (plain or gzip compressed)
+        buffer_nbyte (int): number of (decompressed) bytes per read
+
+    Yields:
+        (header, seq, plus, qual): the 4 lines of a record as bytes, without
+            line ending
+
+    Raises:
+        ValueError: the last record of the fastq is truncated
+
+    """
+
+    with open(fastq_name, 'rb') as raw_file:
+        if raw_file.read(2) == b'\x1f\x8b':
+            raw_file.seek(0)
+            fastq_file = gzip.GzipFile(fileobj=raw_file)
+        else:
+            raw_file.seek(0)
+            fastq_file = raw_file
+
+        rest = b''
+        while True:
+            chunk = fastq_file.read(buffer_nbyte)
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            nline = len(lines) - len(lines) % 4
+            if nline < len(lines):
+                rest = b'\n'.join(lines[nline:] + [rest])
+                del lines[nline:]
+            if lines and lines[0].endswith(b'\r'):
+                lines = [line.rstrip(b'\r') for line in lines]
+            yield from zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4])
+
+        lines = rest.rstrip(b'\r\n').split(b'\n') if rest.strip() else []
+        if len(lines) % 4:
+            raise ValueError('truncated record at the end of fastq {}'
+                             .format(fastq_name))
+        lines = [line.rstrip(b'\r') for line in lines]
+        yield from zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4])
+
+# =============================================================================
+
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+
+def _bgzf_block_size(header):
+    """Return the compressed size of a BGZF block from its 18-byte header.
+
+    Returns:
+        block size in bytes (int), None if header is not a BGZF block header
+
+    """
+    if len(header) < 18 or header[:4] != _BGZF_MAGIC[:4] or \
+       header[10:16] != _BGZF_MAGIC[10:16]:
+        return None
+    return struct.unpack('<H', header[16:18])[0] + 1
+
+
+def _next_bgzf_block(fastq_file, offset, file_nbyte):
+    """Find the offset of the first BGZF block starting at or after offset.
+
+    A match of the block header is accepted if another block header (or the
+    end of file) follows at the offset given by its block size.
+    """
+    while offset < file_nbyte:
+        fastq_file.seek(offset)
+        data = fastq_file.read(262144)
+        pos = 0
+        while True:
+            pos = data.find(_BGZF_MAGIC[:4], pos)
+            if pos == -1:
+                break
+            block_offset = offset + pos
+            fastq_file.seek(block_offset)
+            block_size = _bgzf_block_size(fastq_file.read(18))
+            if block_size:
+                fastq_file.seek(block_offset + block_size)
+                next_header = fastq_file.read(18)
+                if not next_header or _bgzf_block_size(next_header):
+                    return block_offset
+            pos += 1
+        offset += max(len(data) - 3, 1)
+    return file_nbyte
+
+
+def split_fastq(fastq_name, nchunk):
+    """Split a fastq file into byte ranges to process in parallel.
+
+    Plain fastq are split into even byte ranges, BGZF fastq into ranges of
+    whole BGZF blocks. A range does not need to start at a record boundary:
+    read_fastq_chunk() resynchronizes on the first record of a range. Other
+    gzip fastq can not be split and give a single range.
+
+    Args:
+        fastq_name (string): fastq file name
+        nchunk (int): number of chunks
+
+    Returns:
+        a list of (chunk_start, chunk_end) offsets in the (compressed) file
+
+    """
+
+    file_nbyte = os.path.getsize(fastq_name)
+    with open(fastq_name, 'rb') as fastq_file:
+        header = fastq_file.read(18)
+        if header[:2] == b'\x1f\x8b' and not _bgzf_block_size(header):
+            return [(0, file_nbyte)]
+        bounds = [0]
+        for ichunk in range(1, max(nchunk, 1)):
+            offset = file_nbyte * ichunk // nchunk
+            if header[:2] == b'\x1f\x8b':
+                offset = _next_bgzf_block(fastq_file, offset, file_nbyte)
+            if bounds[-1] < offset < file_nbyte:
+                bounds.append(offset)
+    bounds.append(file_nbyte)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_chunk_data(fastq_file, chunk_start, chunk_end, buffer_nbyte):
+    """Read the data of a chunk, and beyond it until end of file.
+
+    Yields:
+        (data, owned_nbyte): decompressed data and how many of its first
+            bytes come from inside [chunk_start, chunk_end)
+
+    """
+    fastq_file.seek(0)
+    is_bgzf = _bgzf_block_size(fastq_file.read(18)) is not None
+    offset = chunk_start
+    fastq_file.seek(offset)
+    if not is_bgzf:
+        while True:
+            data = fastq_file.read(buffer_nbyte)
+            if not data:
+                return
+            yield data, min(len(data), max(chunk_end - offset, 0))
+            offset += len(data)
+
+    cdata = b''
+    while True:
+        more = fastq_file.read(buffer_nbyte)
+        cdata += more
+        pos = 0
+        parts = []
+        owned_nbyte = 0
+        while True:
+            block_size = _bgzf_block_size(cdata[pos:pos + 18])
+            if block_size is None or pos + block_size > len(cdata):
+                break
+            part = zlib.decompress(cdata[pos + 18:pos + block_size - 8], -15)
+            parts.append(part)
+            if offset + pos < chunk_end:
+                owned_nbyte += len(part)
+            pos += block_size
+        if parts:
+            yield b''.join(parts), owned_nbyte
+        cdata = cdata[pos:]
+        offset += pos
+        if not more:
+            return
+
+
+def _find_record_start(data, pos):
+    """Find the first line start after a newline at or after pos that begins
+    a fastq record.
+
+    A quality line may also start with '@', so a candidate header is only
+    accepted if the 3rd line after it starts with '+', the quality is as long
+    as the sequence and the next line (if any) starts with '@'.
+
+    Returns:
+        index of the record start in data, None if more data is needed
+
+    """
+    while True:
+        newline = data.find(b'\n', pos)
+        if newline == -1:
+            return None
+        start = newline + 1
+        lines = data[start:].split(b'\n', 5)
+        if len(lines) < 5:
+            return None
+        header, seq, plus, qual, next_line = lines[:5]
+        if (header.startswith(b'@') and plus.startswith(b'+') and
+            len(seq.rstrip(b'\r')) == len(qual.rstrip(b'\r')) and
+            (next_line.startswith(b'@') or
+             (len(lines) == 5 and not next_line.strip()))):
+            return start
+        pos = start
+
+
+def read_fastq_chunk(fastq_name, chunk_start, chunk_end,
+                     buffer_nbyte=4194304):
+    """Iterate over the records of a chunk of a fastq file.
+
+    A record belongs to the chunk if the newline ending the previous record
+    lies in the chunk (the first record of the file belongs to the first
+    chunk), so the chunks of split_fastq() cover each record exactly once.
+    Other gzip fastq can not be split: the chunk starting at offset 0 holds
+    all their records.
+
+    Args:
+        fastq_name (string): fastq file name (plain or gzip compressed)
+        chunk_start (int): start offset of the chunk in the file
+        chunk_end (int): end offset of the chunk in the file
+        buffer_nbyte (int): number of bytes per read
+
+    Yields:
+        (header, seq, plus, qual): the 4 lines of a record as bytes, without
+            line ending
+
+    """
+
+    with open(fastq_name, 'rb') as fastq_file:
+        header = fastq_file.read(18)
+    if header[:2] == b'\x1f\x8b' and not _bgzf_block_size(header):
+        if chunk_start == 0:
+            yield from read_fastq(fastq_name, buffer_nbyte)
+        return
+
+    with open(fastq_name, 'rb') as fastq_file:
+        data_iter = _read_chunk_data(fastq_file, chunk_start, chunk_end,
+                                     buffer_nbyte)
+        # buf starts at stream position buf_pos, owned_nbyte bytes of the
+        # stream are inside the chunk (final once the stream passes its end)
+        buf = b''
+        buf_pos = 0
+        owned_nbyte = 0
+        final = False
+        synced = chunk_start == 0
+        nrecord_left = None
+        at_eof = False
+        while True:
+            data, data_owned = next(data_iter, (b'', 0))
+            at_eof = not data
+            owned_nbyte += data_owned
+            final = final or at_eof or data_owned < len(data)
+            buf += data
+            if at_eof and buf and not buf.endswith(b'\n'):
+                buf += b'\n'
+
+            if not synced:
+                record_start = _find_record_start(buf, 0)
+                if record_start is None:
+                    if at_eof:
+                        return
+                    continue
+                if buf_pos + record_start - 1 >= owned_nbyte:
+                    if final:
+                        return
+                    continue
+                buf = buf[record_start:]
+                buf_pos += record_start
+                synced = True
+
+            if final and nrecord_left is None:
+                cut = owned_nbyte - buf_pos
+                nrecord_left = (buf.count(b'\n', 0, cut) // 4 + 1
+                                if cut >= 0 else 0)
+            lines = buf.split(b'\n')
+            rest = lines.pop()
+            nline = len(lines) - len(lines) % 4
+            if nrecord_left is not None:
+                nline = min(nline, 4 * nrecord_left)
+                nrecord_left -= nline // 4
+            if nline:
+                buf = b'\n'.join(lines[nline:] + [rest])
+                buf_pos += sum(map(len, lines[:nline])) + nline
+                del lines[nline:]
+                if lines[0].endswith(b'\r'):
+                    lines = [line.rstrip(b'\r') for line in lines]
+                yield from zip(lines[0::4], lines[1::4], lines[2::4],
+                               lines[3::4])
+            if nrecord_left == 0 or at_eof:
+                if at_eof and nrecord_left and buf.strip():
+                    raise ValueError('truncated record at the end of fastq '
+                                     '{}'.format(fastq_name))
+                return
+
+
+def _map_chunk(chunk):
+    """Apply map_func to the records of a chunk (in a worker process).
+
+    Args:
+        chunk (tuple): (fastq_name, chunk_start, chunk_end, map_func)
+
+    """
+
+    fastq_name, chunk_start, chunk_end, map_func = chunk
+    return map_func(read_fastq_chunk(fastq_name, chunk_start, chunk_end))
+
+
+def map_fastq(fastq_name, map_func, reduce_func, nproc=1, nchunk=None):
+    """Process a fastq file in parallel with map/reduce callbacks.
+
+    The fastq is split with split_fastq(), map_func is applied to the record
+    iterator of each chunk in a pool of nproc processes, and the partial
+    results are merged in chunk order with reduce_func. Both callbacks must
+    be picklable (module level functions).
+
+    Args:
+        fastq_name (string): plain or BGZF fastq file name (other gzip fastq
+            are processed as one chunk)
+        map_func (function): map_func(records) -> partial result, where
+            records iterates over (header, seq, plus, qual) as bytes
+        reduce_func (function): reduce_func(partial, partial) -> partial
+        nproc (int): number of worker processes
+        nchunk (int): number of chunks (default: 4 * nproc)
+
+    Returns:
+        the reduced result of all chunks
+
+    """
+
+    chunks = [(fastq_name, chunk_start, chunk_end, map_func)
+              for chunk_start, chunk_end
+              in split_fastq(fastq_name, nchunk or 4 * nproc)]
+    if len(chunks) == 1:
+        return map_func(read_fastq(fastq_name))
+    if nproc <= 1:
+        return functools.reduce(reduce_func, map(_map_chunk, chunks))
+    with multiprocessing.Pool(min(nproc, len(chunks))) as pool:
+        return functools.reduce(reduce_func, pool.imap(_map_chunk, chunks))
 
+# =============================================================================
+
+def _pu_key(header):
+    """Return the read id without the last 3 fields (tile id, cluster x
+    coordinate, cluster y coordinate) of a fastq header, as bytes."""
+
+    read_id = header.split(None, 1)[0]
+    return read_id.rsplit(b':', 3)[0] if read_id.count(b':') >= 3 else b''
+
+
+def _count_pu_str(records):
+    """Count reads by flowcell/lane (map_fastq() map callback).
+
+    Only the headers are looked at, counted by a Counter over a map (no
+    python loop body per read); keys are decoded once per lane.
+    """
+
+    pu_key_counter = collections.Counter(
+        map(_pu_key, map(operator.itemgetter(0), records)))
+    return {pu_key.decode(): count
+            for pu_key, count in pu_key_counter.items()}
+
+
+def _merge_counter(counter, other_counter):
+    """Add up two read counters (map_fastq() reduce callback)."""
+
+    for key, count in other_counter.items():
+        counter[key] = counter.get(key, 0) + count
+    return counter
 
 # =============================================================================
 
 def get_rgstr(fastq_name, sample_name=None, head_nline=1,
-                    platform='ILLUMINA'):
+                    platform='ILLUMINA', nproc=1):
     """Generate RG string from input fastq file.
 
     This function derives ID and PU information for the RG string based on the
@@ -38,11 +453,17 @@ def get_rgstr(fastq_name, sample_name=None, head_nline=1,
         sample_name (string): sample name (default to 1st field in fastq file
             name is not given)
         head_nline (int): first number of lines to sample in fastq file
+            (0 or None for the whole file)
         platform (string): platform informtion for PL field
+        nproc (int): number of processes to scan the whole file with (see
+            map_fastq())
 
     Returns:
         RG string in format: '@RG\tID:{}\tPL:{}\tPU:{}\tSM:{}'
 
+    Raises:
+        ValueError: no read is found in the fastq
+
 
     Following the convention of RG string, suppose the read ID in the input
     fastq is of the form:
@@ -79,31 +500,21 @@ def get_rgstr(fastq_name, sample_name=None, head_nline=1,
 
     # derive sample name from fastq name
     if not sample_name:
-        sample_name = os.path.basename(fastq_name).split('.')[0]
+        sample_name = _sample_name(fastq_name)
 
-    if fastq_name.endswith('gz'):
-        cmd = 'zcat {}'.format(fastq_name)
+    # a record is sampled if its header is within the first head_nline lines
+    head_nrecord = (head_nline + 3) // 4 if head_nline else None
+    if not head_nrecord:
+        pu_str_counter = map_fastq(fastq_name, _count_pu_str, _merge_counter,
+                                   nproc)
     else:
-        cmd = 'cat {}'.format(fastq_name)
-
-    proc = Popen(cmd, stdout=PIPE, shell=True, universal_newlines=True)
-    line_num = 0
-    pu_str_counter = {}
-    for line in proc.stdout:
-        line_num += 1
-        if (line_num-1) % 4 != 0:
-            continue
-        if head_nline and line_num > head_nline:
-            break
-
-        # exclude last 3 field in read id (tile id, cluster x coordinate,
-        # cluster y coordinate)
-        pu_str = ':'.join(line.rstrip().split()[0].split(':')[:-3])
-        if pu_str not in pu_str_counter:
-            pu_str_counter[pu_str] = 0
-        pu_str_counter[pu_str] += 1
-    proc.kill()
+        buffer_nbyte = 65536 if head_nrecord < 1000 else 4194304
+        pu_str_counter = _count_pu_str(
+            itertools.islice(read_fastq(fastq_name, buffer_nbyte),
+                             head_nrecord))
 
+    if not pu_str_counter:
+        raise ValueError('no reads found in fastq {}'.format(fastq_name))
     if len(pu_str_counter) > 1:
         print('*WARNING*: found multiple flowcell_id/lane in fastq {}: {}'
               .format(fastq_name, json.dumps(pu_str_counter, sort_keys=True)),
@@ -112,16 +523,519 @@ def get_rgstr(fastq_name, sample_name=None, head_nline=1,
     for pu_str in sorted(pu_str_counter):
         break
 
+    return _rg_str(pu_str, sample_name, platform)
+
+
+def _sample_name(fastq_name):
+    """Derive a sample name from the first field of the fastq file name."""
+
+    return os.path.basename(fastq_name).split('.')[0]
+
+
+def _rg_fields(pu_str):
+    """Derive the RG ID and PU from a read id without tile and cluster
+    coordinates (see get_rgstr())."""
+
     pu_str = pu_str.lstrip('@').split(':')
-    id_str = pu_str[:-2] + [pu_str[-1]]
     # instrument_id : flowcell_id : ... : lane_id
-    id_str = '.'.join(id_str)
+    id_str = '.'.join(pu_str[:-2] + [pu_str[-1]])
     # instrument_id : flowcell_id : ... : flowcell_barcode : lane_id
-    pu_str = '.'.join(pu_str)
-    rg_str = ('@RG\tID:{}\tPL:{}\tPU:{}\tSM:{}'
-              .format(id_str, platform, pu_str, sample_name))
+    return id_str, '.'.join(pu_str)
+
+
+def _rg_str(pu_str, sample_name, platform):
+    """Format the RG string of a flowcell/lane."""
 
-    return rg_str
+    id_str, pu_str = _rg_fields(pu_str)
+    return ('@RG\tID:{}\tPL:{}\tPU:{}\tSM:{}'
+            .format(id_str, platform, pu_str, sample_name))
+
+# =============================================================================
+
+def read_group_census(fastq_name, sample_name=None, platform='ILLUMINA',
+                      nproc=1, split_prefix=None):
+    """Count the reads of every flowcell/lane in a whole fastq file.
+
+    Unlike get_rgstr(), which derives one RG string from the head of the
+    fastq, every read is looked at and one RG string is derived per
+    flowcell/lane, so that fastq files mixing lanes get all their read
+    groups.
+
+    Args:
+        fastq_name (string): fastq file name
+        sample_name (string): sample name (default to 1st field in fastq file
+            name is not given)
+        platform (string): platform informtion for PL field
+        nproc (int): number of processes to scan the fastq with (see
+            map_fastq()), ignored if split_prefix is given
+        split_prefix (string): also write the reads of every read group to
+            "{split_prefix}.{ID}.fastq.gz" (in one pass over the fastq)
+
+    Returns:
+        a list of dictionaries, one per read group in the order of PU, with
+            ID, PU (string): RG ID and PU
+            rg_str (string): RG string as returned by get_rgstr()
+            count (int): number of reads
+            fastq_name (string): split fastq file name (if split_prefix)
+
+    """
+
+    if not sample_name:
+        sample_name = _sample_name(fastq_name)
+    if split_prefix:
+        pu_str_counter, split_names = _split_read_groups(fastq_name,
+                                                         split_prefix)
+    else:
+        pu_str_counter = map_fastq(fastq_name, _count_pu_str, _merge_counter,
+                                   nproc)
+        split_names = {}
+
+    read_groups = []
+    for pu_str in sorted(pu_str_counter):
+        id_str, pu = _rg_fields(pu_str)
+        read_group = {
+            'ID': id_str,
+            'PU': pu,
+            'rg_str': _rg_str(pu_str, sample_name, platform),
+            'count': pu_str_counter[pu_str],
+        }
+        if split_prefix:
+            read_group['fastq_name'] = split_names[pu_str]
+        read_groups.append(read_group)
+    return read_groups
+
+
+def _split_read_groups(fastq_name, split_prefix, buffer_nrecord=65536):
+    """Write the reads of every flowcell/lane to its own gzip fastq.
+
+    Returns:
+        pu_str_counter: {flowcell/lane: number of reads}
+        split_names: {flowcell/lane: fastq file name}
+
+    """
+
+    pu_str_counter = {}
+    split_names = {}
+    split_files = {}
+    try:
+        records = read_fastq(fastq_name)
+        while True:
+            batch = list(itertools.islice(records, buffer_nrecord))
+            if not batch:
+                break
+            batch.sort(key=lambda record: _pu_key(record[0]))
+            for pu_key, group in itertools.groupby(
+                    batch, key=lambda record: _pu_key(record[0])):
+                pu_str = pu_key.decode()
+                if pu_str not in split_files:
+                    split_names[pu_str] = '{}.{}.fastq.gz'.format(
+                        split_prefix, _rg_fields(pu_str)[0])
+                    split_files[pu_str] = gzip.open(split_names[pu_str],
+                                                    'wb', compresslevel=1)
+                    pu_str_counter[pu_str] = 0
+                group = list(group)
+                pu_str_counter[pu_str] += len(group)
+                split_files[pu_str].write(b''.join(
+                    b'\n'.join(record) + b'\n' for record in group))
+    finally:
+        for split_file in split_files.values():
+            split_file.close()
+    return pu_str_counter, split_names
+
+# =============================================================================
+
+def read_manifest(manifest_name):
+    """Read a manifest of fastq files.
+
+    Args:
+        manifest_name (string): text file with one fastq per line, optionally
+            followed by a tab and its sample name ('#' lines are skipped)
+
+    Returns:
+        a list of (fastq_name, sample_name), sample_name None if not given;
+        relative fastq names are relative to the manifest directory
+
+    """
+
+    manifest_dir = os.path.dirname(manifest_name)
+    fastq_list = []
+    with open(manifest_name) as manifest_file:
+        for line in manifest_file:
+            fields = line.rstrip('\r\n').split('\t')
+            if not fields[0] or fields[0].startswith('#'):
+                continue
+            fastq_name = os.path.join(manifest_dir, fields[0])
+            sample_name = fields[1] if len(fields) > 1 and fields[1] else None
+            fastq_list.append((fastq_name, sample_name))
+    return fastq_list
+
+
+def _cache_key(fastq_name, sample_name, head_nline, platform):
+    """Key of a get_rgstr() call in the result cache."""
+
+    return json.dumps([os.path.abspath(fastq_name), sample_name, head_nline,
+                       platform])
+
+
+def _batch_worker(task):
+    """Run get_rgstr() on a fastq of a batch (in a worker process).
+
+    Returns:
+        (fastq_name, rg_str, error): error message (and rg_str None) if the
+            fastq can not be processed
+
+    """
+
+    fastq_name, sample_name, head_nline, platform = task
+    try:
+        return fastq_name, get_rgstr(fastq_name, sample_name, head_nline,
+                                     platform), None
+    except Exception as err:
+        # any failure is reported for this fastq, not raised in the pool
+        return fastq_name, None, '{}: {}'.format(type(err).__name__, err)
+
+
+def batch_rgstr(fastq_list, head_nline=1000, platform='ILLUMINA', nproc=1,
+                cache_name=None):
+    """Derive the RG strings of many fastq files.
+
+    Files are processed by get_rgstr() in a pool of nproc processes. With a
+    cache file, the RG string of every file is saved with the file size and
+    modification time, and taken from the cache on the next calls as long as
+    the file is unchanged.
+
+    Args:
+        fastq_list (list): fastq file names, or (fastq_name, sample_name)
+            tuples (see read_manifest())
+        head_nline (int): see get_rgstr()
+        platform (string): see get_rgstr()
+        nproc (int): number of worker processes
+        cache_name (string): JSON file of cached results (created if missing)
+
+    Returns:
+        a dictionary {fastq_name: {'rg_str': rg_str, 'error': error}}, in
+            the order of fastq_list, with rg_str None and the error message
+            for files that can not be processed (also reported on stderr)
+
+    """
+
+    fastq_list = [(fastq, None) if isinstance(fastq, str) else tuple(fastq)
+                  for fastq in fastq_list]
+    cache = {}
+    if cache_name and os.path.isfile(cache_name):
+        with open(cache_name) as cache_file:
+            try:
+                cache = json.load(cache_file)
+            except ValueError:
+                print('*WARNING*: ignore corrupted cache {}'
+                      .format(cache_name), file=sys.stderr, flush=True)
+
+    results = {}
+    tasks = []
+    file_stats = {}
+    for fastq_name, sample_name in fastq_list:
+        key = _cache_key(fastq_name, sample_name, head_nline, platform)
+        try:
+            file_stat = os.stat(fastq_name)
+        except OSError as err:
+            print('*WARNING*: can not read fastq {}: {}'
+                  .format(fastq_name, err), file=sys.stderr, flush=True)
+            results[fastq_name] = {
+                'rg_str': None,
+                'error': '{}: {}'.format(type(err).__name__, err),
+            }
+            continue
+        file_stats[fastq_name] = [file_stat.st_size, file_stat.st_mtime_ns]
+        cached = cache.get(key)
+        if cached and cached['stat'] == file_stats[fastq_name]:
+            results[fastq_name] = {'rg_str': cached['rg_str'], 'error': None}
+        else:
+            results[fastq_name] = {'rg_str': None, 'error': None}
+            tasks.append((fastq_name, sample_name, head_nline, platform))
+
+    if tasks:
+        with multiprocessing.Pool(max(min(nproc, len(tasks)), 1)) as pool:
+            for fastq_name, rg_str, error in pool.imap_unordered(
+                    _batch_worker, tasks):
+                if error:
+                    print('*WARNING*: can not read fastq {}: {}'
+                          .format(fastq_name, error), file=sys.stderr,
+                          flush=True)
+                results[fastq_name] = {'rg_str': rg_str, 'error': error}
+        for fastq_name, sample_name, _, _ in tasks:
+            if results[fastq_name]['rg_str'] is not None:
+                cache[_cache_key(fastq_name, sample_name, head_nline,
+                                 platform)] = {
+                    'stat': file_stats[fastq_name],
+                    'rg_str': results[fastq_name]['rg_str'],
+                }
+        if cache_name:
+            tmp_name = '{}.{}.tmp'.format(cache_name, os.getpid())
+            with open(tmp_name, 'w') as cache_file:
+                json.dump(cache, cache_file, sort_keys=True)
+            os.replace(tmp_name, cache_name)
+
+    return results
+
+
+def write_rgstr_table(results, out_file, out_format='tsv'):
+    """Write the results of batch_rgstr() as TSV or JSON.
+
+    The TSV table has one row per fastq with the fields of its RG string
+    (fastq, ID, PL, PU, SM, error), empty but the error for files that
+    could not be processed. The JSON object maps every fastq to its
+    {"rg_str": ..., "error": ...} (null rg_str if not processed).
+
+    """
+
+    if out_format == 'json':
+        json.dump(results, out_file, indent=2)
+        out_file.write('\n')
+        return
+    columns = ('ID', 'PL', 'PU', 'SM')
+    out_file.write('\t'.join(('fastq',) + columns + ('error',)) + '\n')
+    for fastq_name, result in results.items():
+        fields = dict(field.split(':', 1)
+                      for field in (result['rg_str'] or '').split('\t')[1:])
+        out_file.write('\t'.join([fastq_name] +
+                                 [fields.get(column, '')
+                                  for column in columns] +
+                                 [result['error'] or ''])
+                       + '\n')
+
+# =============================================================================
+
+# bytes deleted to count the G/C bases of a read with bytes.translate
+_NOT_GC = bytes(sorted(set(range(256)) - set(b'GCgc')))
+# filler of reads shorter than the longest read of a batch (not a base nor a
+# quality character)
+_PAD = 0x20
+
+
+def _new_qc(dup_nkey):
+    """Return empty partial QC results (see _qc_batch()).
+
+    'dup' counts the reads of at most dup_nkey distinct sequences, by 64-bit
+    hash of their first bases.
+    """
+
+    return {
+        'nread': 0,
+        'nbase': 0,
+        'length': collections.Counter(),
+        'gc': collections.Counter(),
+        'n_per_read': collections.Counter(),
+        'cycle_bases': [],
+        'cycle_quals': [],
+        'dup': collections.Counter(),
+        'dup_nkey': dup_nkey,
+    }
+
+
+def _byte_values(data):
+    """Return the distinct byte values of data.
+
+    The values of a head sample of data are deleted from it with
+    bytes.translate until nothing is left, usually in a pass or two.
+    """
+
+    values = set()
+    while data:
+        values.update(data[:4096])
+        data = data.translate(None, bytes(values))
+    return values
+
+
+def _count_cycles(lines, max_len):
+    """Count the bytes at every cycle of a batch of equal role lines.
+
+    The lines are padded to max_len and joined, so that the bytes of cycle i
+    are the slice joined[i::max_len], counted with bytes.count for every
+    byte value of the batch (C loops over the whole batch, no python loop
+    per read).
+
+    Returns:
+        a list of max_len Counters {byte value: count}, padding excluded
+    """
+
+    joined = b''.join(map(bytes.ljust, lines, itertools.repeat(max_len),
+                          itertools.repeat(bytes([_PAD]))))
+    values = _byte_values(joined)
+    values.discard(_PAD)
+    cycle_counts = []
+    for cycle in range(max_len):
+        column = joined[cycle::max_len]
+        counter = collections.Counter({value: column.count(value)
+                                       for value in values})
+        cycle_counts.append(+counter)
+    return cycle_counts
+
+
+def _merge_cycles(cycle_counts, other_cycle_counts):
+    """Add per cycle Counters of other_cycle_counts to cycle_counts."""
+
+    for counter, other_counter in zip(cycle_counts, other_cycle_counts):
+        counter.update(other_counter)
+    cycle_counts.extend(other_cycle_counts[len(cycle_counts):])
+
+
+def _dup_hashes(dup_keys):
+    """Return 64-bit hashes (CRC32 and Adler-32) of a list of duplicate
+    keys."""
+
+    return map(operator.or_,
+               map(operator.lshift, map(zlib.crc32, dup_keys),
+                   itertools.repeat(32)),
+               map(zlib.adler32, dup_keys))
+
+
+def _trim_dup(qc):
+    """Keep the dup_nkey smallest hashes of qc['dup'] (bottom-k sample).
+
+    A hash among the dup_nkey smallest of all reads is also among the
+    dup_nkey smallest of any chunk, so its read count is complete once the
+    trimmed chunk results are merged and trimmed again.
+    """
+
+    dup = qc['dup']
+    if len(dup) > qc['dup_nkey']:
+        qc['dup'] = collections.Counter(
+            {dup_hash: dup[dup_hash]
+             for dup_hash in heapq.nsmallest(qc['dup_nkey'], dup)})
+
+
+def _qc_batch(qc, records, dup_nbase):
+    """Add a batch of records to partial QC results.
+
+    Args:
+        qc (dict): partial results (see _new_qc()), updated in place
+        records (list): (header, seq, plus, qual) records
+        dup_nbase (int): number of first bases identifying a duplicate
+
+    """
+
+    seqs = list(map(operator.itemgetter(1), records))
+    quals = list(map(operator.itemgetter(3), records))
+    lengths = list(map(len, seqs))
+    max_len = max(lengths)
+
+    qc['nread'] += len(seqs)
+    qc['nbase'] += sum(lengths)
+    qc['length'].update(lengths)
+    gc_counts = map(len, map(bytes.translate, seqs, itertools.repeat(None),
+                             itertools.repeat(_NOT_GC)))
+    qc['gc'].update(zip(gc_counts, lengths))
+    qc['n_per_read'].update(map(bytes.count, seqs, itertools.repeat(b'N')))
+    _merge_cycles(qc['cycle_bases'], _count_cycles(seqs, max_len))
+    _merge_cycles(qc['cycle_quals'], _count_cycles(quals, max_len))
+
+    # once the sample is full, hashes above its largest one can not enter it
+    dup_hashes = _dup_hashes(list(map(operator.getitem, seqs,
+                                      itertools.repeat(slice(dup_nbase)))))
+    if len(qc['dup']) >= qc['dup_nkey']:
+        dup_hashes = filter(max(qc['dup']).__ge__, dup_hashes)
+    qc['dup'].update(dup_hashes)
+    _trim_dup(qc)
+
+
+def _qc_records(records, dup_nbase=50, dup_nkey=100000, batch_nread=65536):
+    """Compute partial QC results of records (map_fastq() map callback).
+
+    Records are taken batch_nread at a time and every statistic of a batch
+    is computed by C level operations (Counter, map, bytes slicing and
+    translate) over the whole batch.
+
+    Returns:
+        partial QC results (see _new_qc())
+    """
+
+    qc = _new_qc(dup_nkey)
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_nread))
+        if not batch:
+            return qc
+        _qc_batch(qc, batch, dup_nbase)
+
+
+def _merge_qc(qc, other_qc):
+    """Add up two partial QC results (map_fastq() reduce callback)."""
+
+    for key in ('nread', 'nbase'):
+        qc[key] += other_qc[key]
+    for key in ('length', 'gc', 'n_per_read', 'dup'):
+        qc[key].update(other_qc[key])
+    for key in ('cycle_bases', 'cycle_quals'):
+        _merge_cycles(qc[key], other_qc[key])
+    _trim_dup(qc)
+    return qc
+
+
+def fastq_qc(fastq_name, nproc=1, phred_offset=33, dup_nbase=50,
+             dup_nkey=100000):
+    """Compute QC statistics of a whole fastq file.
+
+    The fastq is processed in chunks by map_fastq(), each chunk in batches
+    of reads (see _qc_records()), and the partial results are merged.
+
+    Args:
+        fastq_name (string): fastq file name
+        nproc (int): number of processes to scan the fastq with
+        phred_offset (int): offset of the quality characters
+        dup_nbase (int): number of first bases of a read compared to find
+            duplicates
+        dup_nkey (int): the duplicate rate is estimated on the reads of at
+            most dup_nkey distinct sequences, those of smallest hash (a
+            uniform sample), so the memory of every chunk's results and of
+            their merge stays bounded; it is exact if the fastq has no more
+            distinct sequences (up to hash collisions)
+
+    Returns:
+        a dictionary with
+            nread, nbase (int): numbers of reads and bases
+            length (dict): {read length: number of reads}
+            gc_hist (list): number of reads by GC percent (0 to 100)
+            n_frac (float): fraction of N bases
+            n_per_read (dict): {number of N: number of reads}
+            per_cycle_bases (list): {base: count} of every cycle
+            per_cycle_quals (list): {quality score: count} of every cycle
+            per_cycle_mean_qual (list): mean quality score of every cycle
+            duplicate_rate (float): estimated fraction of reads duplicating
+                a previous read
+
+    """
+
+    qc = map_fastq(fastq_name,
+                   functools.partial(_qc_records, dup_nbase=dup_nbase,
+                                     dup_nkey=dup_nkey),
+                   _merge_qc, nproc)
+
+    gc_hist = [0] * 101
+    for (gc_count, length), count in qc['gc'].items():
+        if length:
+            gc_hist[round(100 * gc_count / length)] += count
+    n_count = sum(n * count for n, count in qc['n_per_read'].items())
+    per_cycle_quals = [{qual - phred_offset: count
+                        for qual, count in sorted(counter.items())}
+                       for counter in qc['cycle_quals']]
+    ndup_read = sum(qc['dup'].values())
+    return {
+        'nread': qc['nread'],
+        'nbase': qc['nbase'],
+        'length': dict(sorted(qc['length'].items())),
+        'gc_hist': gc_hist,
+        'n_frac': n_count / qc['nbase'] if qc['nbase'] else 0.0,
+        'n_per_read': dict(sorted(qc['n_per_read'].items())),
+        'per_cycle_bases': [{chr(base): count
+                             for base, count in sorted(counter.items())}
+                            for counter in qc['cycle_bases']],
+        'per_cycle_quals': per_cycle_quals,
+        'per_cycle_mean_qual': [
+            sum(qual * count for qual, count in quals.items()) /
+            sum(quals.values()) for quals in per_cycle_quals],
+        'duplicate_rate': (1 - len(qc['dup']) / ndup_read
+                           if ndup_read else 0.0),
+    }
 
 # =============================================================================
 
@@ -132,21 +1046,84 @@ def main():
 
     parser.add_argument('-f', '--fastq', metavar="fastq",
                         help="input FASTQ",
-                        type=argparse.FileType('r'), required=True)
+                        type=argparse.FileType('r'), required=False,
+                        default=None)
     parser.add_argument('-s', '--sname', metavar="sample_name",
                         help="sample name (default: first field in file name)",
                         type=str, required=False, default=None)
     parser.add_argument('-n', '--nline', metavar="num_line",
                         help="number of fastq lines to sample (default: 1000)",
                         type=int, required=False, default=1000)
+    parser.add_argument('-t', '--nproc', metavar="num_proc",
+                        help=("number of processes to scan the whole fastq "
+                              "with -n 0, -c or -q (default: 1)"),
+                        type=int, required=False, default=1)
+    parser.add_argument('-c', '--census',
+                        help=("count the reads of every flowcell/lane in the "
+                              "whole fastq and print one RG per lane"),
+                        action='store_true')
+    parser.add_argument('-o', '--split-prefix', metavar="out_prefix",
+                        help=("with -c, also split the fastq into "
+                              "out_prefix.{ID}.fastq.gz per read group"),
+                        type=str, required=False, default=None)
+    parser.add_argument('-q', '--qc',
+                        help=("compute QC statistics of the whole fastq "
+                              "(JSON on stdout)"),
+                        action='store_true')
+    parser.add_argument('-m', '--manifest', metavar="manifest",
+                        help=("batch mode: file of fastq names (and sample "
+                              "names, tab separated), one per line"),
+                        type=str, required=False, default=None)
+    parser.add_argument('-g', '--glob', metavar="pattern",
+                        help=("batch mode: fastq file name pattern "
+                              "(repeatable)"),
+                        type=str, required=False, action='append', default=[])
+    parser.add_argument('-C', '--cache', metavar="cache_json",
+                        help="batch mode: file caching the results",
+                        type=str, required=False, default=None)
+    parser.add_argument('-j', '--json',
+                        help="batch mode: write JSON instead of TSV",
+                        action='store_true')
 
     args = parser.parse_args()
+    if not args.fastq and not args.manifest and not args.glob:
+        parser.error('one of -f/--fastq, -m/--manifest or -g/--glob is '
+                     'required')
+
+    if args.manifest or args.glob:
+        fastq_list = read_manifest(args.manifest) if args.manifest else []
+        for pattern in args.glob:
+            fastq_list += [(fastq_name, args.sname)
+                           for fastq_name in sorted(glob.glob(pattern))]
+        results = batch_rgstr(fastq_list, args.nline, nproc=args.nproc,
+                              cache_name=args.cache)
+        write_rgstr_table(results, sys.stdout,
+                          'json' if args.json else 'tsv')
+        return
+
+    if args.qc:
+        json.dump(fastq_qc(args.fastq.name, args.nproc), sys.stdout,
+                  indent=2)
+        print(file=sys.stdout, flush=True)
+        return
+
+    if args.census:
+        read_groups = read_group_census(args.fastq.name, args.sname,
+                                        nproc=args.nproc,
+                                        split_prefix=args.split_prefix)
+        for read_group in read_groups:
+            print(read_group['rg_str'], file=sys.stdout, flush=True)
+            print(':: {}\t{} reads'.format(read_group['ID'],
+                                            read_group['count']),
+                  file=sys.stderr, flush=True)
+        return
 
     fastq_name = args.fastq.name
     sample_name = args.sname
     head_nline = args.nline
 
-    read_group = get_rgstr(fastq_name, sample_name, head_nline)
+    read_group = get_rgstr(fastq_name, sample_name, head_nline,
+                           nproc=args.nproc)
     print(read_group, file=sys.stdout, flush=True)
 
 # =============================================================================
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""This module serves reference sequence queries from a resident process.
+
+    serve() load one or more references once and answer region queries over
+    a Unix socket or a localhost TCP port, with a pool of worker processes
+    that each keep the fasta memory mapped (Sequence mode 'mmap'), so all of
+    them share the page cache of the fasta.
+
+        Example:
+
+            $ python3 refserver.py -f hg38=hg38.fa -u /tmp/ref.sock -t 8
+
+    Protocol (one request per line, one response line per request, in the
+    order of the requests; clients may send many requests without waiting):
+
+        [@ref_name] region [region ...]
+
+            regions are "chrom", "chrom:pos" or "chrom:pstart-pend" (1-based
+            inclusive), all regions of a line are served by a single
+            Sequence.query_regions() call. The response is the sequences
+            separated by tabs (empty for chroms not in the reference), or
+            "ERR\\t<message>" for a bad request. ref_name defaults to the
+            first reference.
+
+    The same port also answers HTTP GET requests (one per connection):
+
+            $ curl 'http://127.0.0.1:8765/query?ref=hg38&region=chr1:1-100'
+
+        with one sequence per line in a text/plain response.
+
+    query_server() is a blocking client of the line protocol, which sends
+    regions in batches and pipelines the batches.
+
+"""
+
+import os
+import sys
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import itertools
+import urllib.parse
+import concurrent.futures
+
+from sequence import Sequence
+from region import Error as RegionError, RegionArray
+
+logger = logging.getLogger(__name__)
+
+# Sequence objects of a worker process, {ref_name: Sequence}
+_worker_sequences = {}
+
+
+def _init_worker(references):
+    """Open every reference in a worker process (memory mapped)."""
+    for ref_name, fasta_name in references.items():
+        _worker_sequences[ref_name] = Sequence(fasta_name, mode='mmap')
+
+
+def _query_worker(ref_name, region_strs):
+    """Query a batch of region strings on a reference in a worker process.
+
+    Returns:
+        a list of sequence strings in the order of region_strs
+
+    Raises:
+        ValueError, region.Error: a region string is invalid
+    """
+    regions = RegionArray.from_strings(region_strs)
+    return _worker_sequences[ref_name].query_regions(regions)
+
+
+class RefServer(object):
+    """A class for the reference query server.
+
+    Attributes:
+        references: {ref_name: fasta_name}, the first one is the default
+        nproc: number of worker processes (int)
+        max_pending: max number of requests of a connection being served
+            at once, further requests wait to be read (int)
+    """
+
+    def __init__(self, references, nproc=1, max_pending=64):
+        """Initialize a RefServer object (workers start in start()).
+
+        Args:
+            references: {ref_name: fasta_name} (dict), or a list of fasta
+                names named after their basename
+            nproc: number of worker processes (int)
+            max_pending: max number of pipelined requests of a connection
+                served at once (int)
+
+        Raises:
+            ValueError: no reference, or nproc < 1
+        """
+        if not isinstance(references, dict):
+            references = {os.path.basename(fasta_name): fasta_name
+                          for fasta_name in references}
+        if not references:
+            raise ValueError('no reference to serve')
+        if nproc < 1:
+            raise ValueError('number of worker processes must be >=1 (found '
+                             '{})'.format(nproc))
+        self.references = dict(references)
+        self.default_ref = next(iter(self.references))
+        self.nproc = nproc
+        self.max_pending = max_pending
+        self._executor = None
+
+
+    def start(self):
+        """Start the worker processes (each loads every reference once)."""
+        # check the references (and their fai) before forking the workers
+        for fasta_name in self.references.values():
+            Sequence(fasta_name).close()
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            self.nproc, initializer=_init_worker,
+            initargs=(self.references,))
+        # fork the workers now, before any socket is open: a worker forked
+        # while a client is connected keeps its socket open, and the client
+        # never sees the server close it
+        self._executor.submit(os.getpid).result()
+
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+    async def query(self, ref_name, region_strs):
+        """Query a batch of regions in a worker process.
+
+        Returns:
+            a list of sequence strings in the order of region_strs
+
+        Raises:
+            ValueError: unknown reference, or invalid region string
+            region.Error: invalid region range
+        """
+        if ref_name not in self.references:
+            raise ValueError('unknown reference "{}"'.format(ref_name))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _query_worker,
+                                          ref_name, region_strs)
+
+
+    async def handle_connection(self, reader, writer):
+        """Serve the requests of a client connection until it closes."""
+        pending = None
+        writer_task = None
+        try:
+            line = await reader.readline()
+            if line.startswith((b'GET ', b'HEAD ')):
+                await self._handle_http(line, reader, writer)
+                return
+            # the reader queues the request tasks in order, the writer awaits
+            # them in turn, so requests are served concurrently (pipelining)
+            # but answered in order; the reader stops if the writer fails
+            pending = asyncio.Queue(self.max_pending)
+            writer_task = asyncio.ensure_future(
+                self._write_responses(pending, writer))
+            while line:
+                task = asyncio.ensure_future(self._serve_line(line))
+                queued, _ = await self._unless_done(pending.put(task),
+                                                    writer_task)
+                if not queued:
+                    task.cancel()
+                    break
+                _, line = await self._unless_done(reader.readline(),
+                                                  writer_task)
+            await self._unless_done(pending.put(None), writer_task)
+            await writer_task
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            logger.warning('client connection lost: %s', err)
+        except Exception:
+            logger.exception('error serving a client connection')
+        finally:
+            if writer_task is not None:
+                writer_task.cancel()
+            while pending is not None and not pending.empty():
+                task = pending.get_nowait()
+                if task is not None:
+                    task.cancel()
+            writer.close()
+
+
+    @staticmethod
+    async def _unless_done(aw, writer_task):
+        """Await aw unless writer_task finishes first (aw is then cancelled).
+
+        Returns:
+            (True, result of aw), or (False, None) if writer_task is done
+        """
+        task = asyncio.ensure_future(aw)
+        await asyncio.wait((task, writer_task),
+                           return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return True, task.result()
+        task.cancel()
+        return False, None
+
+
+    async def _serve_line(self, line):
+        """Serve one request line of the line protocol."""
+        fields = line.decode(errors='replace').split()
+        ref_name = self.default_ref
+        if fields and fields[0].startswith('@'):
+            ref_name = fields.pop(0)[1:]
+        if not fields:
+            return b'\n'
+        try:
+            seq_list = await self.query(ref_name, fields)
+        except (ValueError, RegionError) as err:
+            return 'ERR\t{}\n'.format(str(err).strip()).encode()
+        except Exception as err:
+            # e.g. BrokenProcessPool: answer, the client waits for a line
+            logger.warning('query failed: %s: %s', type(err).__name__, err)
+            return 'ERR\t{}: {}\n'.format(type(err).__name__,
+                                          str(err).strip()).encode()
+        return ('\t'.join(seq_list) + '\n').encode()
+
+
+    async def _write_responses(self, pending, writer):
+        """Write the responses of queued request tasks in order."""
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            writer.write(await task)
+            await writer.drain()
+
+
+    async def _handle_http(self, request_line, reader, writer):
+        """Serve one HTTP GET /query?ref=...&region=... request."""
+        while (await reader.readline()).strip():
+            # skip the headers
+            pass
+        try:
+            method, target, _ = request_line.decode().split()
+            url = urllib.parse.urlsplit(target)
+            params = urllib.parse.parse_qs(url.query)
+            if url.path != '/query' or 'region' not in params:
+                status, body = '404 Not Found', 'usage: /query?region=...\n'
+            else:
+                ref_name = params.get('ref', [self.default_ref])[0]
+                seq_list = await self.query(ref_name, params['region'])
+                status, body = '200 OK', ''.join(seq + '\n'
+                                                 for seq in seq_list)
+        except (ValueError, RegionError) as err:
+            method = 'GET'
+            status, body = '400 Bad Request', str(err).strip() + '\n'
+        except Exception as err:
+            # e.g. BrokenProcessPool: answer, as the line protocol does
+            logger.warning('query failed: %s: %s', type(err).__name__, err)
+            method = 'GET'
+            status, body = ('500 Internal Server Error',
+                            '{}: {}\n'.format(type(err).__name__,
+                                              str(err).strip()))
+        body = body.encode()
+        writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain\r\n'
+                     'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                     .format(status, len(body)).encode())
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
+
+async def serve(references, socket_name=None, host='127.0.0.1', port=None,
+                nproc=1, max_pending=64):
+    """Serve reference queries until cancelled.
+
+    Args:
+        references: {ref_name: fasta_name} or list of fasta names, see
+            RefServer
+        socket_name: Unix socket to listen on (string)
+        host, port: TCP address to listen on if socket_name is None
+        nproc: number of worker processes (int)
+        max_pending: max number of pipelined requests of a connection served
+            at once (int)
+
+    Raises:
+        ValueError: neither socket_name nor port is given
+    """
+    if socket_name is None and port is None:
+        raise ValueError('either a Unix socket or a TCP port is required')
+    ref_server = RefServer(references, nproc, max_pending)
+    ref_server.start()
+    try:
+        if socket_name is not None:
+            server = await asyncio.start_unix_server(
+                ref_server.handle_connection, socket_name)
+            address = socket_name
+        else:
+            server = await asyncio.start_server(ref_server.handle_connection,
+                                                host, port)
+            address = '{}:{}'.format(host, port)
+        logger.info('serving %s on %s with %d workers',
+                    ', '.join(ref_server.references), address, nproc)
+        async with server:
+            await server.serve_forever()
+    finally:
+        ref_server.close()
+        if socket_name is not None and os.path.exists(socket_name):
+            os.unlink(socket_name)
+
+
+def query_server(region_strs, socket_name=None, host='127.0.0.1', port=None,
+                 ref_name=None, batch_nregion=1000, max_pending=16):
+    """Query a reference server (blocking client of the line protocol).
+
+    Args:
+        region_strs: iterable of region strings ("chrom(:pstart(-pend))")
+        socket_name: Unix socket of the server (string)
+        host, port: TCP address of the server if socket_name is None
+        ref_name: name of the reference (string, default: the first one of
+            the server)
+        batch_nregion: number of regions per request line (int)
+        max_pending: number of request lines sent ahead of the responses
+            (int)
+
+    Yields:
+        the sequence string of every region, in order
+
+    Raises:
+        ValueError: the server rejects a request
+    """
+    if socket_name is not None:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socket_name)
+    else:
+        conn = socket.create_connection((host, port))
+    prefix = '@{} '.format(ref_name) if ref_name else ''
+    region_strs = iter(region_strs)
+    with conn, conn.makefile('rb') as responses:
+        npending = 0
+        while True:
+            batch = list(itertools.islice(region_strs, batch_nregion))
+            if batch:
+                conn.sendall((prefix + ' '.join(batch) + '\n').encode())
+                npending += 1
+            if npending and (npending >= max_pending or not batch):
+                response = responses.readline().decode().rstrip('\n')
+                npending -= 1
+                if response.startswith('ERR\t'):
+                    raise ValueError(response[4:])
+                yield from response.split('\t')
+            elif not batch:
+                break
+
+
+def main():
+    """Wrapper of function serve() with command line inputs."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-f', '--fasta', metavar="[name=]fasta",
+                        help=("reference fasta to serve, named name or "
+                              "after its file name (repeatable, the first "
+                              "one is the default)"),
+                        type=str, required=True, action='append')
+    parser.add_argument('-u', '--socket', metavar="socket_name",
+                        help="Unix socket to listen on",
+                        type=str, required=False, default=None)
+    parser.add_argument('-p', '--port', metavar="port",
+                        help="localhost TCP port to listen on",
+                        type=int, required=False, default=None)
+    parser.add_argument('-t', '--nproc', metavar="num_proc",
+                        help="number of worker processes (default: 1)",
+                        type=int, required=False, default=1)
+
+    args = parser.parse_args()
+    if not args.socket and not args.port:
+        parser.error('one of -u/--socket or -p/--port is required')
+    logging.basicConfig(level=logging.INFO,
+                        format=':: %(message)s', stream=sys.stderr)
+
+    references = {}
+    for ref_str in args.fasta:
+        ref_name, _, fasta_name = ref_str.rpartition('=')
+        references[ref_name or os.path.basename(fasta_name)] = fasta_name
+
+    async def serve_until_terminated():
+        # stop the workers and remove the socket on SIGTERM as on Ctrl-C
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel)
+        await serve(references, args.socket, port=args.port,
+                    nproc=args.nproc)
+
+    try:
+        asyncio.run(serve_until_terminated())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+
+    main()
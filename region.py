@@ -1,3 +1,11 @@
+import re
+import sys
+import heapq
+import array
+import bisect
+import operator
+import itertools
+import tempfile
 
 
 class Error(Exception):
@@ -27,6 +35,8 @@ class Region(object):
         length: number of base-pairs in the region (int) -1 if region is empty
     """
 
+    __slots__ = ('chrom', 'pstart', 'pend', 'length')
+
     def __init__(self, *args):
         """Initialize a Region object.
 
@@ -100,3 +110,626 @@ class Region(object):
         if self.length == -1:
             return self.chrom
         return '{}:{}-{}'.format(self.chrom, self.pstart, self.pend)
+
+
+    @classmethod
+    def _from_valid(cls, chrom, pstart, pend):
+        """Build a Region from already validated fields (no checks).
+
+        Args:
+            chrom: chromosome name (string)
+            pstart, pend: 1-based inclusive positions (int), -1 for a whole
+                chromosome
+        """
+        region = cls.__new__(cls)
+        region.chrom, region.pstart, region.pend = chrom, pstart, pend
+        region.length = pend - pstart + 1 if pstart != -1 else -1
+        return region
+
+
+class RegionArray(object):
+    """A class for many genomic regions stored by column.
+
+    Chromosome names are stored once and referred to by integer codes, and
+    starting/ending positions are kept in typed arrays, which takes a small
+    fraction of the memory of a list of Region objects. Regions are parsed in
+    bulk from text, with the fields of all lines extracted by one regex pass
+    and validated column-wise.
+
+    Methods:
+        from_strings(): parse "chrom(:pstart(-pend))" strings
+        from_bed(): parse BED lines (0-based half-open)
+        read_bed(): parse a BED file
+        append(): add a Region object
+        __getitem__(): return the i-th region as a Region object
+
+    Attributes:
+        chrom_names: list of chromosome names (index = chrom code)
+        chrom_codes: array of chrom code per region (int)
+        pstarts: array of region starting positions 1-based inclusive (int)
+            -1 for a whole chromosome
+        pends: array of region ending positions 1-based inclusive (int)
+            -1 for a whole chromosome
+    """
+
+    _REGION_STR = re.compile(r'^([^:\n-]+)(?::([0-9]+)(?:-([0-9]+))?)?$',
+                             re.MULTILINE)
+    _BED_LINE = re.compile(r'^([^\t\n]+)\t([0-9]+)\t([0-9]+)(?:\t.*)?$',
+                           re.MULTILINE)
+    _BED_HEADER = re.compile(r'^(?:#|track|browser|$)', re.MULTILINE)
+
+    def __init__(self):
+        """Initialize an empty RegionArray object."""
+        self.chrom_names = []
+        self.chrom_codes = array.array('i')
+        self.pstarts = array.array('q')
+        self.pends = array.array('q')
+        self._chrom_code = {}
+
+
+    def __len__(self):
+        return len(self.pstarts)
+
+
+    def __getitem__(self, i):
+        return Region._from_valid(self.chrom_names[self.chrom_codes[i]],
+                                  self.pstarts[i], self.pends[i])
+
+
+    def __iter__(self):
+        return map(Region._from_valid,
+                   map(self.chrom_names.__getitem__, self.chrom_codes),
+                   self.pstarts, self.pends)
+
+
+    def append(self, region):
+        """Add a Region object (a whole chromosome if it has no range)."""
+        if region.chrom not in self._chrom_code:
+            self._chrom_code[region.chrom] = len(self.chrom_names)
+            self.chrom_names.append(region.chrom)
+        self.chrom_codes.append(self._chrom_code[region.chrom])
+        self.pstarts.append(region.pstart)
+        self.pends.append(region.pend)
+
+
+    @classmethod
+    def from_strings(cls, region_strs):
+        """Parse regions in the format of Region.__str__().
+
+        Args:
+            region_strs: iterable of strings "chrom", "chrom:pos" or
+                "chrom:pstart-pend" (1-based inclusive)
+
+        Returns:
+            a RegionArray object
+
+        Raises:
+            ValueError: a string is not in region format
+            RegionRangeError: invalid region, pstart<=0 or pend<=0 or
+                pend < pstart
+        """
+        region_strs = list(region_strs)
+        fields = cls._REGION_STR.findall('\n'.join(region_strs))
+        if len(fields) != len(region_strs):
+            for region_str in region_strs:
+                if not cls._REGION_STR.fullmatch(region_str):
+                    raise ValueError('invalid region string "{}"'
+                                     .format(region_str))
+        if not fields:
+            return cls()
+        chroms, pstarts, pends = cls._columns(fields)
+        if '' in pstarts or '' in pends:
+            # whole chromosome (-1) or single base (pend = pstart)
+            pstarts, pends = zip(*((pstart or '-1', pend or pstart or '-1')
+                                   for pstart, pend in zip(pstarts, pends)))
+        return cls._from_columns(chroms, pstarts, pends,
+                                 region_strs.__getitem__)
+
+
+    @classmethod
+    def from_bed(cls, bed_lines):
+        """Parse BED lines (chrom, start, end, ... 0-based half-open).
+
+        Empty lines and header lines (#, track, browser) are skipped.
+
+        Args:
+            bed_lines: iterable of BED lines (with or without newline)
+
+        Returns:
+            a RegionArray object
+
+        Raises:
+            ValueError: a line is not in BED format
+            RegionRangeError: invalid region, end <= start
+        """
+        bed_text = ''.join(line if line.endswith('\n') else line + '\n'
+                           for line in bed_lines)
+        fields = cls._BED_LINE.findall(bed_text)
+        nheader = len(cls._BED_HEADER.findall(bed_text)) - 1
+        if len(fields) != bed_text.count('\n') - nheader:
+            for line in bed_text.splitlines():
+                if (not cls._BED_HEADER.match(line) and
+                    not cls._BED_LINE.fullmatch(line)):
+                    raise ValueError('invalid BED line "{}"'.format(line))
+        if not fields:
+            return cls()
+        chroms, starts, pends = cls._columns(fields)
+        # 0-based start to 1-based inclusive
+        pstarts = array.array('q', map(operator.add, map(int, starts),
+                                       itertools.repeat(1)))
+        return cls._from_columns(chroms, pstarts, pends,
+                                 lambda i: '\t'.join(fields[i]))
+
+
+    @classmethod
+    def read_bed(cls, bed_name):
+        """Parse a BED file (see from_bed())."""
+        with open(bed_name) as bed_file:
+            return cls.from_bed(bed_file)
+
+
+    @staticmethod
+    def _columns(fields):
+        """Transpose regex matches (chrom, start, end) into 3 lists."""
+        return [list(map(operator.itemgetter(i), fields)) for i in range(3)]
+
+
+    @classmethod
+    def _from_columns(cls, chroms, pstarts, pends, source):
+        """Build a RegionArray from parsed columns and validate positions.
+
+        Args:
+            chroms: sequence of chromosome names
+            pstarts, pends: sequences of positions (int or decimal string),
+                -1 for whole chromosome
+            source: function returning the text of the i-th region (for
+                error messages)
+        """
+        regions = cls()
+        regions.chrom_names = list(dict.fromkeys(chroms))
+        regions._chrom_code = {chrom: code for code, chrom
+                               in enumerate(regions.chrom_names)}
+        regions.chrom_codes = array.array('i', map(regions._chrom_code
+                                                   .__getitem__, chroms))
+        regions.pstarts = array.array('q', map(int, pstarts))
+        regions.pends = array.array('q', map(int, pends))
+
+        # parsed digits are >= 0, -1 only marks a whole chromosome
+        if 0 in regions.pstarts or 0 in regions.pends:
+            i = (regions.pstarts.index(0) if 0 in regions.pstarts
+                 else regions.pends.index(0))
+            raise RegionRangeError('region starting/ending position must be '
+                                   '>=1 (found "{}")'.format(source(i)))
+        negative = list(map(operator.lt, regions.pends, regions.pstarts))
+        if True in negative:
+            raise RegionRangeError('region is empty or negative length '
+                                   '(found "{}")'
+                                   .format(source(negative.index(True))))
+        return regions
+
+
+class RegionIndex(object):
+    """A class for overlap queries over many genomic regions.
+
+    Regions are kept per chromosome in arrays sorted by starting position,
+    which are read as an implicit binary tree augmented with the max ending
+    position of each subtree (the layout of cgranges). Overlap and position
+    queries take O(log n + k) for n indexed regions and k hits. A Region
+    without range (whole chromosome) covers every position of its chrom.
+
+    Methods:
+        __init__(): initialize a RegionIndex object from regions
+        add(): add a region to the index
+        overlaps(): regions overlapping a query region
+        contains(): regions containing a query position
+        nearest(): regions closest to a query region
+
+    Example:
+        index = RegionIndex(target_regions)
+        for region in index.overlaps(Region('chr1', 10000, 10200)):
+            print(region)
+    """
+
+    # subtrees up to this level are scanned linearly instead of descended
+    _SCAN_LEVEL = 3
+
+    def __init__(self, regions=()):
+        """Initialize a RegionIndex object.
+
+        Args:
+            regions: iterable of Region objects (may be added later by add())
+
+        Raises:
+            InternalError: region without chrom (empty region) is indexed
+        """
+        # chrom: [starts, ends, regions] with 0-based half-open positions
+        self._chrom_data = {}
+        # chrom: (starts, ends, max_ends, regions, ends_sorted, ends_order,
+        # max_level) once the index is built
+        self._chrom_index = {}
+        for region in regions:
+            self.add(region)
+
+
+    def __len__(self):
+        return sum(len(data[2]) for data in self._chrom_data.values())
+
+
+    def add(self, region):
+        """Add a region to the index (rebuilt on next query)."""
+        if not region.chrom:
+            raise InternalError('can not index an empty region\n')
+        start, end = self._span(region)
+        data = self._chrom_data.setdefault(region.chrom, [[], [], []])
+        data[0].append(start)
+        data[1].append(end)
+        data[2].append(region)
+        self._chrom_index.pop(region.chrom, None)
+
+
+    def overlaps(self, qregion):
+        """Find indexed regions overlapping a query region.
+
+        Args:
+            qregion: query Region object
+
+        Returns:
+            a list of Region objects sorted by starting position
+        """
+        chrom_index = self._get_index(qregion.chrom)
+        if chrom_index is None:
+            return []
+        qstart, qend = self._span(qregion)
+        return [chrom_index[3][i]
+                for i in self._overlap_ids(chrom_index, qstart, qend)]
+
+
+    def contains(self, chrom, pos):
+        """Find indexed regions containing a position.
+
+        Args:
+            chrom: chromosome name (string)
+            pos: 1-based position (int)
+
+        Returns:
+            a list of Region objects sorted by starting position (empty if
+            the position is not covered)
+        """
+        chrom_index = self._get_index(chrom)
+        if chrom_index is None:
+            return []
+        return [chrom_index[3][i]
+                for i in self._overlap_ids(chrom_index, pos - 1, pos)]
+
+
+    def nearest(self, qregion):
+        """Find indexed regions closest to a query region.
+
+        Args:
+            qregion: query Region object
+
+        Returns:
+            a list of Region objects: the overlapping regions if any,
+            otherwise the closest upstream and/or downstream regions (both if
+            they are equally distant). Empty if chrom has no region.
+        """
+        chrom_index = self._get_index(qregion.chrom)
+        if chrom_index is None:
+            return []
+        qstart, qend = self._span(qregion)
+        overlap_ids = self._overlap_ids(chrom_index, qstart, qend)
+        if overlap_ids:
+            return [chrom_index[3][i] for i in overlap_ids]
+
+        starts, _, _, regions, ends_sorted, ends_order, _ = chrom_index
+        hits = []
+        iup = bisect.bisect_right(ends_sorted, qstart) - 1
+        idown = bisect.bisect_left(starts, qend)
+        dist_up = qstart - ends_sorted[iup] if iup >= 0 else None
+        dist_down = starts[idown] - qend if idown < len(starts) else None
+        if dist_up is not None and (dist_down is None or
+                                    dist_up <= dist_down):
+            end = ends_sorted[iup]
+            while iup >= 0 and ends_sorted[iup] == end:
+                hits.append(regions[ends_order[iup]])
+                iup -= 1
+            hits.reverse()
+        if dist_down is not None and (dist_up is None or
+                                      dist_down <= dist_up):
+            start = starts[idown]
+            while idown < len(starts) and starts[idown] == start:
+                hits.append(regions[idown])
+                idown += 1
+        return hits
+
+
+    @staticmethod
+    def _span(region):
+        """Return 0-based half-open (start, end) of a Region object."""
+        if region.length == -1:
+            return 0, sys.maxsize
+        return region.pstart - 1, region.pend
+
+
+    def _get_index(self, chrom):
+        """Return the (lazily built) index data of a chromosome."""
+        if chrom in self._chrom_index:
+            return self._chrom_index[chrom]
+        if chrom not in self._chrom_data:
+            return None
+
+        starts, ends, regions = self._chrom_data[chrom]
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        starts = [starts[i] for i in order]
+        ends = [ends[i] for i in order]
+        regions = [regions[i] for i in order]
+        self._chrom_data[chrom] = [starts, ends, regions]
+        max_ends = self._augment(starts, ends)
+        ends_order = sorted(range(len(ends)), key=ends.__getitem__)
+        ends_sorted = [ends[i] for i in ends_order]
+        max_level = max(len(starts).bit_length() - 1, 0)
+        self._chrom_index[chrom] = (starts, ends, max_ends, regions,
+                                    ends_sorted, ends_order, max_level)
+        return self._chrom_index[chrom]
+
+
+    @staticmethod
+    def _augment(starts, ends):
+        """Compute the max ending position of every implicit subtree.
+
+        Node i of the tree is at level k where k is the number of trailing
+        1-bits of i; its children are i -/+ 2**(k-1).
+        """
+        nitem = len(starts)
+        max_ends = list(ends)
+        if nitem == 0:
+            return max_ends
+        last_i = nitem - 1 if (nitem - 1) % 2 == 0 else nitem - 2
+        last = max_ends[last_i]
+        level = 1
+        while 1 << level <= nitem:
+            half = 1 << (level - 1)
+            for i in range((half << 1) - 1, nitem, half << 2):
+                left = max_ends[i - half]
+                right = max_ends[i + half] if i + half < nitem else last
+                max_ends[i] = max(max_ends[i], left, right)
+            last_i = last_i - half if (last_i >> level) & 1 else last_i + half
+            if last_i < nitem and max_ends[last_i] > last:
+                last = max_ends[last_i]
+            level += 1
+        return max_ends
+
+
+    def _overlap_ids(self, chrom_index, qstart, qend):
+        """Return sorted ids of regions overlapping [qstart, qend)."""
+        starts, ends, max_ends, _, _, _, max_level = chrom_index
+        nitem = len(starts)
+        hits = []
+        # stack of (level, node, left child visited)
+        stack = [(max_level, (1 << max_level) - 1, False)]
+        while stack:
+            level, node, left_done = stack.pop()
+            if level <= self._SCAN_LEVEL:
+                i = node >> level << level
+                i_end = min(i + (1 << (level + 1)) - 1, nitem)
+                while i < i_end and starts[i] < qend:
+                    if qstart < ends[i]:
+                        hits.append(i)
+                    i += 1
+            elif not left_done:
+                left = node - (1 << (level - 1))
+                stack.append((level, node, True))
+                if left >= nitem or max_ends[left] > qstart:
+                    stack.append((level - 1, left, False))
+            elif node < nitem and starts[node] < qend:
+                if qstart < ends[node]:
+                    hits.append(node)
+                stack.append((level - 1, node + (1 << (level - 1)), False))
+        return hits
+
+
+def sort_regions(regions, chrom_order=None, buffer_nregion=1000000):
+    """Sort regions by (chrom, pstart, pend).
+
+    A re-iterable input (list, RegionArray, ...) that is already sorted is
+    streamed as is. Other inputs are sorted in memory if they have at most
+    buffer_nregion regions, and by an external merge sort (sorted runs of
+    buffer_nregion regions in temporary files) otherwise.
+
+    Args:
+        regions: iterable of Region objects
+        chrom_order: list of chromosome names giving the chrom order (e.g.
+            Sequence.chrom_list), chroms not listed come after in name order.
+            Chroms are sorted by name if not given.
+        buffer_nregion: max number of regions held in memory (int)
+
+    Returns:
+        an iterator of Region objects
+    """
+    sort_key = _region_sort_key(chrom_order)
+    if iter(regions) is not regions:
+        keys, next_keys = itertools.tee(map(sort_key, regions))
+        next(next_keys, None)
+        if all(map(operator.le, keys, next_keys)):
+            return iter(regions)
+
+    regions = iter(regions)
+    buffer = sorted(itertools.islice(regions, buffer_nregion), key=sort_key)
+    if len(buffer) < buffer_nregion:
+        return iter(buffer)
+    run_files = []
+    while buffer:
+        run_file = tempfile.TemporaryFile('w+')
+        run_file.writelines('{}\t{}\t{}\n'.format(region.chrom, region.pstart,
+                                                  region.pend)
+                            for region in buffer)
+        run_file.seek(0)
+        run_files.append(run_file)
+        buffer = sorted(itertools.islice(regions, buffer_nregion),
+                        key=sort_key)
+    return heapq.merge(*map(_read_region_run, run_files), key=sort_key)
+
+
+def merge_regions(regions, gap=0, chrom_order=None, presorted=False):
+    """Merge overlapping or adjacent regions.
+
+    Args:
+        regions: iterable of Region objects (with position range)
+        gap: also merge regions separated by at most gap bases (int)
+        chrom_order: chrom order of the input/output (see sort_regions())
+        presorted: input is known to be sorted in chrom_order (bool), skip
+            sort_regions()
+
+    Yields:
+        sorted, non-overlapping Region objects
+    """
+    if not presorted:
+        regions = sort_regions(regions, chrom_order)
+    chrom = None
+    for region in regions:
+        _check_range(region)
+        if region.chrom == chrom and region.pstart <= pend + 1 + gap:
+            pend = max(pend, region.pend)
+            continue
+        if chrom is not None:
+            yield Region._from_valid(chrom, pstart, pend)
+        chrom, pstart, pend = region.chrom, region.pstart, region.pend
+    if chrom is not None:
+        yield Region._from_valid(chrom, pstart, pend)
+
+
+def intersect_regions(regions, other_regions, chrom_order=None,
+                      presorted=False):
+    """Intersect two region sets.
+
+    Args:
+        regions, other_regions: iterables of Region objects
+        chrom_order: chrom order of the inputs/output (see sort_regions())
+        presorted: inputs are known to be sorted in chrom_order (bool)
+
+    Yields:
+        sorted, non-overlapping Region objects covered by both sets
+    """
+    chrom_key = _chrom_sort_key(chrom_order)
+    regions = merge_regions(regions, 0, chrom_order, presorted)
+    other_regions = merge_regions(other_regions, 0, chrom_order, presorted)
+    region = next(regions, None)
+    other = next(other_regions, None)
+    while region is not None and other is not None:
+        region_key = chrom_key(region.chrom)
+        other_key = chrom_key(other.chrom)
+        if region_key != other_key:
+            if region_key < other_key:
+                region = next(regions, None)
+            else:
+                other = next(other_regions, None)
+            continue
+        pstart = max(region.pstart, other.pstart)
+        pend = min(region.pend, other.pend)
+        if pstart <= pend:
+            yield Region._from_valid(region.chrom, pstart, pend)
+        if region.pend < other.pend:
+            region = next(regions, None)
+        else:
+            other = next(other_regions, None)
+
+
+def subtract_regions(regions, other_regions, chrom_order=None,
+                     presorted=False):
+    """Subtract a region set from another.
+
+    Args:
+        regions: iterable of Region objects to subtract from
+        other_regions: iterable of Region objects to subtract
+        chrom_order: chrom order of the inputs/output (see sort_regions())
+        presorted: inputs are known to be sorted in chrom_order (bool)
+
+    Yields:
+        sorted, non-overlapping Region objects covered by regions only
+    """
+    chrom_key = _chrom_sort_key(chrom_order)
+    other_regions = merge_regions(other_regions, 0, chrom_order, presorted)
+    other = next(other_regions, None)
+    for region in merge_regions(regions, 0, chrom_order, presorted):
+        region_key = chrom_key(region.chrom)
+        pstart = region.pstart
+        while other is not None and (chrom_key(other.chrom) < region_key or
+                                     other.chrom == region.chrom and
+                                     other.pend < pstart):
+            other = next(other_regions, None)
+        while (other is not None and other.chrom == region.chrom and
+               other.pstart <= region.pend):
+            if other.pstart > pstart:
+                yield Region._from_valid(region.chrom, pstart,
+                                         other.pstart - 1)
+            pstart = max(pstart, other.pend + 1)
+            if other.pend > region.pend:
+                # may also overlap the next region
+                break
+            other = next(other_regions, None)
+        if pstart <= region.pend:
+            yield Region._from_valid(region.chrom, pstart, region.pend)
+
+
+def complement_regions(regions, sequence, presorted=False):
+    """Find the parts of the reference not covered by a region set.
+
+    Args:
+        regions: iterable of Region objects
+        sequence: Sequence object whose fai gives the chrom order and lengths
+        presorted: input is known to be sorted in sequence.chrom_list order
+            (bool)
+
+    Yields:
+        Region objects in sequence.chrom_list order, including whole
+        chromosomes without any region. Regions on chroms missing from the
+        fai are ignored.
+    """
+    chrom_order = sequence.chrom_list
+    regions = merge_regions(regions, 0, chrom_order, presorted)
+    region = next(regions, None)
+    for chrom in chrom_order:
+        chrom_len = sequence.fai_data[chrom]['chrom_len']
+        pstart = 1
+        while region is not None and region.chrom == chrom:
+            # regions are clipped to the chrom (nothing left past its end)
+            pend = min(region.pstart - 1, chrom_len)
+            if pstart <= pend:
+                yield Region._from_valid(chrom, pstart, pend)
+            pstart = max(pstart, min(region.pend, chrom_len) + 1)
+            region = next(regions, None)
+        if pstart <= chrom_len:
+            yield Region._from_valid(chrom, pstart, chrom_len)
+        while region is not None and region.chrom not in sequence.fai_data:
+            region = next(regions, None)
+
+
+def _chrom_sort_key(chrom_order):
+    """Return a function mapping a chrom to its sort key."""
+    if not chrom_order:
+        return lambda chrom: (0, chrom)
+    chrom_rank = {chrom: rank for rank, chrom in enumerate(chrom_order)}
+    nrank = len(chrom_rank)
+    return lambda chrom: (chrom_rank.get(chrom, nrank), chrom)
+
+
+def _region_sort_key(chrom_order):
+    """Return a function mapping a Region to its sort key."""
+    chrom_key = _chrom_sort_key(chrom_order)
+    return lambda region: (chrom_key(region.chrom), region.pstart,
+                           region.pend)
+
+
+def _check_range(region):
+    """Raise InternalError for a region without position range."""
+    if region.length == -1:
+        raise InternalError('region "{}" without position range in region '
+                            'set operation\n'.format(region))
+
+
+def _read_region_run(run_file):
+    """Read back the regions of a sorted run written by sort_regions()."""
+    with run_file:
+        for line in run_file:
+            chrom, pstart, pend = line.rstrip('\n').split('\t')
+            yield Region._from_valid(chrom, int(pstart), int(pend))
@@ -1,5 +1,20 @@
+import re
 import sys
 import os
+import mmap
+import zlib
+import array
+import struct
+import bisect
+import itertools
+import collections
+import collections.abc
+import time
+import logging
+from multiprocessing import resource_tracker, shared_memory
+
+
+logger = logging.getLogger(__name__)
 
 
 class Error(Exception):
@@ -12,27 +27,902 @@ class InputFileError(Error):
     pass
 
 
+class _BgzfReader(object):
+    """Random access reader of a BGZF (bgzip) file with a .gzi index.
+
+    Reads are addressed by offsets in the uncompressed data. Only the blocks
+    touched by a read are decompressed, and the last cache_nblock
+    decompressed blocks are kept in an LRU cache.
+    """
+
+
+    _BLOCK_HEADER = struct.Struct('<4sI2xH2sHH')
+
+
+    def __init__(self, bgzf_name, gzi_name, use_mmap=False, cache_nblock=256):
+        """Initialize a _BgzfReader object.
+
+        Args:
+            bgzf_name: name of BGZF file (string)
+            gzi_name: name of BGZF index file written by bgzip -i (string)
+            use_mmap: keep a memory map of the compressed file (bool)
+            cache_nblock: max number of decompressed blocks in cache (int)
+
+        Raises:
+            InputFileError: the file is not BGZF or the gzi can not be read
+
+        """
+        self.bgzf_name = bgzf_name
+        self.cache_nblock = cache_nblock
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = collections.OrderedDict()
+        self._mmap = None
+        with open(gzi_name, 'rb') as gzi_file:
+            gzi_bytes = gzi_file.read()
+        if len(gzi_bytes) < 8:
+            raise InputFileError('can not read BGZF index "{}"\n'
+                                 .format(gzi_name))
+        nentry = struct.unpack_from('<Q', gzi_bytes)[0]
+        if len(gzi_bytes) != 8 + 16 * nentry:
+            raise InputFileError('truncated BGZF index "{}"\n'
+                                 .format(gzi_name))
+        entries = struct.unpack_from('<{}Q'.format(2 * nentry), gzi_bytes, 8)
+        # the first block (0, 0) is implicit in the gzi
+        self._coffsets = [0] + list(entries[0::2])
+        self._uoffsets = [0] + list(entries[1::2])
+        with open(bgzf_name, 'rb') as bgzf_file:
+            if self._block_size(bgzf_file.read(18)) is None:
+                raise InputFileError('input fasta is not BGZF compressed '
+                                     '({})\n'.format(bgzf_name))
+            if use_mmap:
+                self._mmap = mmap.mmap(bgzf_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+
+
+    def close(self):
+        """Release the memory map and the block cache."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._cache.clear()
+
+
+    def read(self, offset, nbyte):
+        """Read nbyte uncompressed bytes starting at uncompressed offset.
+
+        Returns:
+            a bytes object of length nbyte (shorter at end of file)
+
+        """
+        iblock = bisect.bisect_right(self._uoffsets, offset) - 1
+        coffset = self._coffsets[iblock]
+        skip = offset - self._uoffsets[iblock]
+        parts = []
+        if self._mmap is not None:
+            bgzf_file = None
+        else:
+            bgzf_file = open(self.bgzf_name, 'rb')
+        try:
+            while nbyte > 0:
+                block_data, block_size = self._block(bgzf_file, coffset)
+                if block_size == 0:
+                    break
+                part = block_data[skip:skip + nbyte]
+                parts.append(part)
+                nbyte -= len(part)
+                skip = max(skip - len(block_data), 0)
+                coffset += block_size
+        finally:
+            if bgzf_file is not None:
+                bgzf_file.close()
+        return b''.join(parts)
+
+
+    def _block_size(self, header):
+        """Return the compressed size of a block from its 18-byte header.
+
+        Returns:
+            block size in bytes (int), 0 at end of file, None if the header
+            is not a BGZF block header
+
+        """
+        if not header:
+            return 0
+        if len(header) < 18:
+            return None
+        magic, _, xlen, subfield, sublen, bsize \
+            = self._BLOCK_HEADER.unpack(header)
+        if (magic != b'\x1f\x8b\x08\x04' or xlen != 6 or subfield != b'BC' or
+            sublen != 2):
+            return None
+        return bsize + 1
+
+
+    def _block(self, bgzf_file, coffset):
+        """Return (decompressed data, compressed size) of block at coffset."""
+        if coffset in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(coffset)
+            return self._cache[coffset]
+        self.cache_misses += 1
+        if bgzf_file is None:
+            header = self._mmap[coffset:coffset + 18]
+        else:
+            bgzf_file.seek(coffset)
+            header = bgzf_file.read(18)
+        block_size = self._block_size(header)
+        if block_size is None:
+            raise InputFileError('corrupted BGZF block at offset {} in {}\n'
+                                 .format(coffset, self.bgzf_name))
+        if block_size == 0:
+            return b'', 0
+        if bgzf_file is None:
+            cdata = self._mmap[coffset + 18:coffset + block_size - 8]
+        else:
+            cdata = bgzf_file.read(block_size - 26)
+        block = (zlib.decompress(cdata, -15), block_size)
+        self._cache[coffset] = block
+        if len(self._cache) > self.cache_nblock:
+            self._cache.popitem(last=False)
+        return block
+
+
+# 2-bit codes of the UCSC .2bit format (T=0 C=1 A=2 G=3), the first base of a
+# byte in its most significant bits. Non-ACGT bases are packed as T and
+# restored from the N blocks.
+_TWOBIT_CODES = bytes('TCAG'.index(chr(c).upper())
+                      if chr(c).upper() in 'TCAG' else 0 for c in range(256))
+_TWOBIT_SHIFTS = [bytes((code << shift) & 0xff for code in range(256))
+                  for shift in (6, 4, 2, 0)]
+_TWOBIT_UNPACK = [bytes(b'TCAG'[(byte >> shift) & 3] for shift in (6, 4, 2, 0))
+                  for byte in range(256)]
+_LOWER_CASE = bytes.maketrans(b'ACGTN', b'acgtn')
+
+# base complement (IUPAC codes included, case kept)
+_COMPLEMENT = bytes.maketrans(b'ACGTURYKMBVDHNacgturykmbvdhn',
+                              b'TGCAAYRMKVBHDNtgcaayrmkvbhdn')
+
+
+def _query_table(strand, case):
+    """Build the translate table of a (strand, case) of query_bytes()."""
+    table = bytes(range(256))
+    if strand == '-':
+        table = table.translate(_COMPLEMENT)
+    if case is not None:
+        table = getattr(table, case)()
+    return table
+
+
+# translate tables of Sequence.query_bytes(), {(strand, case): table}
+_QUERY_TABLES = {(strand, case): _query_table(strand, case)
+                 for strand in ('+', '-') for case in (None, 'upper', 'lower')}
+
+
+class _TwoBit(object):
+    """Reference held in memory as 2-bit packed bases.
+
+    The layout of every contig follows the UCSC .2bit format: packed bases
+    plus separate lists of N blocks and soft-masked (lower case) blocks, so
+    the reference takes about a quarter of the size of the text fasta and can
+    be written to / memory mapped from a .2bit file. Non-ACGT IUPAC codes are
+    reported as N.
+    """
+
+
+    _SIGNATURE = 0x1A412743
+
+
+    def __init__(self):
+        """Initialize an empty _TwoBit object (see build() and load())."""
+        # chrom: (chrom_len, buffer, dna_offset, n_starts, n_ends,
+        # mask_starts, mask_ends) with 0-based half-open blocks
+        self.contigs = {}
+        self._mmap = None
+
+
+    @classmethod
+    def build(cls, sequence):
+        """Pack every contig of a Sequence object.
+
+        Returns:
+            a _TwoBit object
+
+        """
+        twobit = cls()
+        for chrom in sequence.chrom_list:
+            chrom_len = sequence.fai_data[chrom]['chrom_len']
+            seq_bytes = sequence.fetch(chrom, 0, chrom_len)
+            n_starts, n_ends = _find_runs(rb'[^ACGTacgt]+', seq_bytes)
+            mask_starts, mask_ends = _find_runs(rb'[a-z]+', seq_bytes)
+            twobit.contigs[chrom] = (chrom_len, cls._pack(seq_bytes), 0,
+                                     n_starts, n_ends, mask_starts, mask_ends)
+        return twobit
+
+
+    @classmethod
+    def load(cls, twobit_name):
+        """Memory map a .2bit file (packed bases are not copied).
+
+        Returns:
+            a _TwoBit object
+
+        Raises:
+            InputFileError: the file is not in .2bit format
+
+        """
+        with open(twobit_name, 'rb') as twobit_file:
+            twobit_mmap = mmap.mmap(twobit_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        try:
+            twobit = cls.from_buffer(twobit_mmap, twobit_name)
+        except InputFileError:
+            twobit_mmap.close()
+            raise
+        twobit._mmap = twobit_mmap
+        return twobit
+
+
+    @classmethod
+    def from_buffer(cls, buf, source='buffer'):
+        """Read contigs from a buffer in .2bit format (packed bases are not
+        copied).
+
+        Returns:
+            a _TwoBit object
+
+        Raises:
+            InputFileError: the buffer is not in .2bit format
+
+        """
+        twobit = cls()
+        signature, version, nseq, _ = struct.unpack_from('<4I', buf)
+        if signature != cls._SIGNATURE or version != 0:
+            raise InputFileError('input is not a .2bit file ({})\n'
+                                 .format(source))
+        pos = 16
+        for _ in range(nseq):
+            name_size = buf[pos]
+            chrom = bytes(buf[pos + 1:pos + 1 + name_size]).decode()
+            record_offset = struct.unpack_from('<I', buf,
+                                               pos + 1 + name_size)[0]
+            pos += 5 + name_size
+            chrom_len, nblock = struct.unpack_from('<2I', buf, record_offset)
+            n_starts, n_ends, record_offset \
+                = cls._load_blocks(buf, record_offset + 8, nblock)
+            nblock = struct.unpack_from('<I', buf, record_offset)[0]
+            mask_starts, mask_ends, record_offset \
+                = cls._load_blocks(buf, record_offset + 4, nblock)
+            twobit.contigs[chrom] = (chrom_len, buf, record_offset + 4,
+                                     n_starts, n_ends, mask_starts, mask_ends)
+        return twobit
+
+
+    def save(self, twobit_name, chrom_list):
+        """Write contigs in chrom_list order to a .2bit file."""
+        chunks = self.dump(chrom_list, twobit_name)
+        with open(twobit_name, 'wb') as twobit_file:
+            for chunk in chunks:
+                twobit_file.write(chunk)
+
+
+    def dump(self, chrom_list, twobit_name='buffer'):
+        """Format contigs in chrom_list order as .2bit content.
+
+        Returns:
+            a list of bytes objects to be written in order
+
+        """
+        index = []
+        records = []
+        record_offset = (16 + sum(5 + len(chrom.encode())
+                                  for chrom in chrom_list))
+        for chrom in chrom_list:
+            chrom_len, buf, dna_offset, n_starts, n_ends, mask_starts, \
+                mask_ends = self.contigs[chrom]
+            name = chrom.encode()
+            if len(name) > 255:
+                raise InputFileError('contig name too long for .2bit ({})\n'
+                                     .format(chrom))
+            index.append(struct.pack('<B', len(name)) + name +
+                         struct.pack('<I', record_offset))
+            record = [struct.pack('<2I', chrom_len, len(n_starts))]
+            record += self._dump_blocks(n_starts, n_ends)
+            record.append(struct.pack('<I', len(mask_starts)))
+            record += self._dump_blocks(mask_starts, mask_ends)
+            record.append(struct.pack('<I', 0))
+            record.append(bytes(buf[dna_offset:
+                                    dna_offset + (chrom_len + 3) // 4]))
+            records.append(b''.join(record))
+            record_offset += len(records[-1])
+        if record_offset > 0xffffffff:
+            raise InputFileError('reference too large for .2bit ({})\n'
+                                 .format(twobit_name))
+        return [struct.pack('<4I', self._SIGNATURE, 0, len(chrom_list), 0),
+                b''.join(index)] + records
+
+
+    def close(self):
+        """Release the memory map of the .2bit file (if any)."""
+        self.contigs = {}
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+    def fetch(self, chrom, query_start, query_end):
+        """Decode bases of a contig in 0-based half-open [start, end).
+
+        Returns:
+            a bytes object of the sequence (soft-masked bases in lower case)
+
+        """
+        _, buf, dna_offset, n_starts, n_ends, mask_starts, mask_ends \
+            = self.contigs[chrom]
+        packed = buf[dna_offset + query_start // 4:
+                     dna_offset + (query_end + 3) // 4]
+        head = query_start % 4
+        seq_bytes = bytearray(b''.join(map(_TWOBIT_UNPACK.__getitem__,
+                                           packed))
+                              [head:head + query_end - query_start])
+        for start, end in self._overlap_blocks(n_starts, n_ends,
+                                               query_start, query_end):
+            seq_bytes[start:end] = b'N' * (end - start)
+        for start, end in self._overlap_blocks(mask_starts, mask_ends,
+                                               query_start, query_end):
+            seq_bytes[start:end] = seq_bytes[start:end].translate(_LOWER_CASE)
+        return bytes(seq_bytes)
+
+
+    @staticmethod
+    def _pack(seq_bytes):
+        """Pack bases 4 per byte, whole-sequence operations only."""
+        codes = seq_bytes.translate(_TWOBIT_CODES)
+        codes += bytes(-len(codes) % 4)
+        npacked = len(codes) // 4
+        packed = 0
+        # no carry between bytes: each term only sets its own 2 bits
+        for ibase, shift_table in enumerate(_TWOBIT_SHIFTS):
+            packed |= int.from_bytes(codes[ibase::4].translate(shift_table),
+                                     'big')
+        return packed.to_bytes(npacked, 'big')
+
+
+    @staticmethod
+    def _load_blocks(buf, pos, nblock):
+        """Read nblock (starts, sizes) of a .2bit record at pos.
+
+        Returns:
+            starts, ends (array of int) and position after the blocks
+
+        """
+        starts = array.array('I')
+        starts.frombytes(buf[pos:pos + 4 * nblock])
+        sizes = array.array('I')
+        sizes.frombytes(buf[pos + 4 * nblock:pos + 8 * nblock])
+        if sys.byteorder != 'little':
+            starts.byteswap()
+            sizes.byteswap()
+        ends = array.array('I', map(sum, zip(starts, sizes)))
+        return starts, ends, pos + 8 * nblock
+
+
+    @staticmethod
+    def _dump_blocks(starts, ends):
+        """Format (starts, ends) blocks as .2bit starts and sizes arrays."""
+        starts = array.array('I', starts)
+        sizes = array.array('I', (end - start
+                                  for start, end in zip(starts, ends)))
+        if sys.byteorder != 'little':
+            starts.byteswap()
+            sizes.byteswap()
+        return [starts.tobytes(), sizes.tobytes()]
+
+
+    @staticmethod
+    def _overlap_blocks(starts, ends, query_start, query_end):
+        """Yield blocks clipped to [query_start, query_end), relative to it."""
+        iblock = max(bisect.bisect_right(starts, query_start) - 1, 0)
+        while iblock < len(starts) and starts[iblock] < query_end:
+            start = max(starts[iblock], query_start)
+            end = min(ends[iblock], query_end)
+            if start < end:
+                yield start - query_start, end - query_start
+            iblock += 1
+
+
+def _find_runs(pattern, seq_bytes):
+    """Find runs of a regex pattern in a sequence.
+
+    Returns:
+        starts, ends: arrays of 0-based half-open run positions
+
+    """
+    starts = array.array('I')
+    ends = array.array('I')
+    for match in re.finditer(pattern, seq_bytes):
+        starts.append(match.start())
+        ends.append(match.end())
+    return starts, ends
+
+
+class _FaiTable(collections.abc.Mapping):
+    """Fai index packed in one flat buffer, read as {chrom: fai entry}.
+
+    The buffer holds no python object, so it can live in shared memory or in
+    a memory mapped file and be used by many processes without a copy:
+
+        header: magic (uint32), nchrom (uint32), names_nbyte (uint64)
+        fields: chrom_len, byte_offset, line_nbase, line_nchar (int64) of
+            every chrom in fai order
+        name_ends: end of every chrom name in names (int64), in fai order
+        name_order: chrom ids (uint32) sorted by name, for bisect lookups
+        names: utf-8 chrom names, concatenated in fai order
+
+    Integers are in native byte order (the magic does not match otherwise).
+    """
+
+
+    _HEADER = struct.Struct('=IIQ')
+    _MAGIC = 0x54494146
+    _FIELDS = ('chrom_len', 'byte_offset', 'line_nbase', 'line_nchar')
+
+
+    def __init__(self, buf):
+        """Initialize a _FaiTable object over a buffer made by pack().
+
+        Raises:
+            InputFileError: the buffer is not a packed fai table
+
+        """
+        buf = memoryview(buf)
+        if len(buf) < self._HEADER.size:
+            raise InputFileError('truncated fai table\n')
+        magic, nchrom, names_nbyte = self._HEADER.unpack_from(buf)
+        if magic != self._MAGIC:
+            raise InputFileError('not a fai table (or wrong byte order)\n')
+        pos = self._HEADER.size
+        fields_end = pos + 32 * nchrom
+        ends_end = fields_end + 8 * nchrom
+        order_end = ends_end + 4 * nchrom
+        self.nbyte = order_end + names_nbyte
+        if len(buf) < self.nbyte:
+            raise InputFileError('truncated fai table\n')
+        self._views = [buf[pos:fields_end].cast('q'),
+                       buf[fields_end:ends_end].cast('q'),
+                       buf[ends_end:order_end].cast('I'),
+                       buf[order_end:self.nbyte], buf]
+        self._fields, self._name_ends, self._name_order, self._names, _ \
+            = self._views
+        self._sorted_names = _SortedNames(self)
+        # entries looked up so far (filled on demand, so a table of many
+        # contigs costs nothing until queried)
+        self._entries = {}
+
+
+    @classmethod
+    def pack(cls, fai_data, chrom_list):
+        """Pack a fai index (see Sequence._load_index()).
+
+        Returns:
+            a bytes object to be read with _FaiTable(...)
+
+        """
+        names = [chrom.encode() for chrom in chrom_list]
+        fields = array.array('q', (fai_data[chrom][field]
+                                   for chrom in chrom_list
+                                   for field in cls._FIELDS))
+        name_ends = array.array('q', itertools.accumulate(map(len, names)))
+        name_order = array.array('I', sorted(range(len(names)),
+                                             key=names.__getitem__))
+        return b''.join([cls._HEADER.pack(cls._MAGIC, len(names),
+                                          sum(map(len, names))),
+                         fields.tobytes(), name_ends.tobytes(),
+                         name_order.tobytes()] + names)
+
+
+    def release(self):
+        """Release the views of the buffer (before the buffer is closed)."""
+        self._sorted_names = None
+        self._entries = {}
+        for view in self._views:
+            view.release()
+
+
+    def names(self):
+        """Return the chrom names in fai order (a sequence view)."""
+        return _FaiNames(self)
+
+
+    def _name(self, ichrom):
+        """Return the utf-8 name of chrom ichrom (fai order)."""
+        start = self._name_ends[ichrom - 1] if ichrom else 0
+        return bytes(self._names[start:self._name_ends[ichrom]])
+
+
+    def _find(self, chrom):
+        """Return the fai order id of a chrom, or -1 if not found."""
+        name = chrom.encode()
+        isorted = bisect.bisect_left(self._sorted_names, name)
+        if (isorted < len(self._name_order) and
+            self._sorted_names[isorted] == name):
+            return self._name_order[isorted]
+        return -1
+
+
+    def __getitem__(self, chrom):
+        entry = self._entries.get(chrom)
+        if entry is not None:
+            return entry
+        ichrom = self._find(chrom)
+        if ichrom < 0:
+            raise KeyError(chrom)
+        entry = dict(zip(self._FIELDS, self._fields[4 * ichrom:
+                                                    4 * ichrom + 4]))
+        self._entries[chrom] = entry
+        return entry
+
+
+    def __contains__(self, chrom):
+        return isinstance(chrom, str) and (chrom in self._entries or
+                                           self._find(chrom) >= 0)
+
+
+    def __iter__(self):
+        return iter(self.names())
+
+
+    def __len__(self):
+        return len(self._name_order)
+
+
+class _SortedNames(object):
+    """Chrom names of a _FaiTable in sorted order (utf-8), for bisect."""
+
+
+    def __init__(self, fai_table):
+        self._fai_table = fai_table
+
+
+    def __len__(self):
+        return len(self._fai_table)
+
+
+    def __getitem__(self, isorted):
+        fai_table = self._fai_table
+        return fai_table._name(fai_table._name_order[isorted])
+
+
+class _FaiNames(collections.abc.Sequence):
+    """Chrom names of a _FaiTable in fai order, decoded on access."""
+
+
+    def __init__(self, fai_table):
+        self._fai_table = fai_table
+
+
+    def __len__(self):
+        return len(self._fai_table)
+
+
+    def __getitem__(self, ichrom):
+        if isinstance(ichrom, slice):
+            return [self[i] for i in range(*ichrom.indices(len(self)))]
+        if ichrom < 0:
+            ichrom += len(self)
+        if not 0 <= ichrom < len(self):
+            raise IndexError('chrom index out of range')
+        return self._fai_table._name(ichrom).decode()
+
+
+class _MaskIndex(object):
+    """Runs of N and of soft-masked (lower case) bases of every contig.
+
+    N runs are runs of bases other than A, C, G and T (either case), i.e. N
+    and the other IUPAC codes, the bases a 2-bit reference stores as N, so
+    that an index built in any mode counts the same bases. Each kind of run
+    is kept as starts, ends (0-based half-open, uint32) and the cumulative
+    run length before each run (int64), so the number of bases of a kind in
+    any range is found by two bisect lookups, without reading the sequence.
+    The index is saved to / memory mapped from a binary file:
+
+        header: magic, size and mtime (ns) of the fai and of the fasta,
+            nchrom
+        directory: n_nrun, mask_nrun, data offset (int64) of every chrom in
+            fai order
+        data of a chrom: n_starts, n_ends, mask_starts, mask_ends (uint32),
+            padded to 8 bytes, n_cums, mask_cums (int64, nrun + 1 each)
+    """
+
+
+    _HEADER = struct.Struct('=4sxxxxQQQQQ')
+    _MAGIC = b'SQMK'
+    _N_PATTERN = rb'[^ACGTacgt]+'
+    _MASK_PATTERN = rb'[a-z]+'
+
+
+    def __init__(self, chrom_list, key=None):
+        """Initialize an empty _MaskIndex object (see build() and load()).
+
+        Args:
+            chrom_list: chrom names in fai order (list)
+            key: (fai size, fai mtime_ns, fasta size, fasta mtime_ns) of the
+                files the index describes (see Sequence._mask_key())
+        """
+        self.key = key
+        self.chrom_ids = {chrom: ichrom
+                          for ichrom, chrom in enumerate(chrom_list)}
+        # fai order: (n_starts, n_ends, n_cums, mask_starts, mask_ends,
+        # mask_cums)
+        self.runs = []
+        self._mmap = None
+        self._views = []
+
+
+    @classmethod
+    def build(cls, sequence, key=None, block_nbase=4194304):
+        """Find the N and lower case runs of every contig of a Sequence.
+
+        Every block of block_nbase bases is scanned by one regex pass per
+        kind of run; in '2bit' mode the runs of the 2-bit reference are
+        taken as is.
+
+        Returns:
+            a _MaskIndex object
+
+        """
+        mask_index = cls(sequence.chrom_list, key)
+        for chrom in sequence.chrom_list:
+            if sequence._twobit is not None:
+                _, _, _, n_starts, n_ends, mask_starts, mask_ends \
+                    = sequence._twobit.contigs[chrom]
+            else:
+                n_starts, n_ends, mask_starts, mask_ends \
+                    = cls._scan(sequence, chrom, block_nbase)
+            mask_index.runs.append(
+                (n_starts, n_ends, cls._cums(n_starts, n_ends),
+                 mask_starts, mask_ends, cls._cums(mask_starts, mask_ends)))
+        return mask_index
+
+
+    @classmethod
+    def load(cls, mask_name, chrom_list, key):
+        """Memory map a saved _MaskIndex, None if missing or stale."""
+        try:
+            with open(mask_name, 'rb') as mask_file:
+                mask_mmap = mmap.mmap(mask_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(mask_mmap) >= cls._HEADER.size:
+            magic, *file_key, nchrom = cls._HEADER.unpack_from(mask_mmap)
+            if (magic == cls._MAGIC and tuple(file_key) == key and
+                nchrom == len(chrom_list)):
+                mask_index = cls(chrom_list, key)
+                mask_index._mmap = mask_mmap
+                mask_index._map_runs(memoryview(mask_mmap), nchrom)
+                return mask_index
+        mask_mmap.close()
+        return None
+
+
+    @classmethod
+    def is_saved(cls, mask_name, key):
+        """Check if a saved index exists for the files of key."""
+        try:
+            with open(mask_name, 'rb') as mask_file:
+                header = mask_file.read(cls._HEADER.size)
+        except OSError:
+            return False
+        if len(header) < cls._HEADER.size:
+            return False
+        magic, *file_key, _ = cls._HEADER.unpack(header)
+        return magic == cls._MAGIC and tuple(file_key) == key
+
+
+    def save(self, mask_name):
+        """Write the index to a binary file (atomically)."""
+        directory = array.array('q')
+        data = []
+        offset = self._HEADER.size + 24 * len(self.runs)
+        for n_starts, n_ends, n_cums, mask_starts, mask_ends, mask_cums \
+                in self.runs:
+            directory.extend((len(n_starts), len(mask_starts), offset))
+            chunk = b''.join(array.array('I', runs).tobytes()
+                             for runs in (n_starts, n_ends, mask_starts,
+                                          mask_ends))
+            chunk += bytes(-len(chunk) % 8)
+            chunk += b''.join(array.array('q', cums).tobytes()
+                              for cums in (n_cums, mask_cums))
+            data.append(chunk)
+            offset += len(chunk)
+        tmp_name = '{}.{}.tmp'.format(mask_name, os.getpid())
+        with open(tmp_name, 'wb') as mask_file:
+            mask_file.write(self._HEADER.pack(self._MAGIC, *self.key,
+                                              len(self.runs)))
+            mask_file.write(directory.tobytes())
+            for chunk in data:
+                mask_file.write(chunk)
+        os.replace(tmp_name, mask_name)
+
+
+    def close(self):
+        """Release the memory map of the index file (if any)."""
+        self.runs = []
+        for view in self._views:
+            view.release()
+        self._views = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+    def count(self, chrom, start, end):
+        """Count N and soft-masked bases in 0-based half-open [start, end).
+
+        Returns:
+            (n_count, mask_count)
+
+        """
+        n_starts, n_ends, n_cums, mask_starts, mask_ends, mask_cums \
+            = self.runs[self.chrom_ids[chrom]]
+        return (self._covered(n_starts, n_ends, n_cums, end) -
+                self._covered(n_starts, n_ends, n_cums, start),
+                self._covered(mask_starts, mask_ends, mask_cums, end) -
+                self._covered(mask_starts, mask_ends, mask_cums, start))
+
+
+    @staticmethod
+    def _covered(starts, ends, cums, pos):
+        """Number of run bases before pos."""
+        irun = bisect.bisect_left(starts, pos)
+        if irun and ends[irun - 1] > pos:
+            return cums[irun] - (ends[irun - 1] - pos)
+        return cums[irun]
+
+
+    @staticmethod
+    def _cums(starts, ends):
+        """Cumulative run lengths before every run (and in total)."""
+        return array.array('q', itertools.accumulate(
+            map(int.__sub__, ends, starts), initial=0))
+
+
+    @classmethod
+    def _scan(cls, sequence, chrom, block_nbase):
+        """Find the N and lower case runs of a contig, block by block."""
+        chrom_len = sequence.fai_data[chrom]['chrom_len']
+        runs = ([array.array('I'), array.array('I')],
+                [array.array('I'), array.array('I')])
+        for block_start in range(0, chrom_len, block_nbase):
+            block = sequence.fetch(chrom, block_start,
+                                   block_start + block_nbase)
+            for pattern, (starts, ends) in zip((cls._N_PATTERN,
+                                                cls._MASK_PATTERN), runs):
+                block_starts, block_ends = _find_runs(pattern, block)
+                if not block_starts:
+                    continue
+                if ends and ends[-1] == block_start + block_starts[0]:
+                    # run across the block boundary
+                    ends[-1] = block_start + block_ends[0]
+                    block_starts, block_ends = block_starts[1:], \
+                        block_ends[1:]
+                starts.extend(block_start + start for start in block_starts)
+                ends.extend(block_start + end for end in block_ends)
+        return runs[0][0], runs[0][1], runs[1][0], runs[1][1]
+
+
+    def _map_runs(self, buf, nchrom):
+        """Read the runs of every chrom from a saved index (no copy)."""
+        directory = buf[self._HEADER.size:
+                        self._HEADER.size + 24 * nchrom].cast('q')
+        self._views.append(directory)
+        for ichrom in range(nchrom):
+            n_nrun, mask_nrun, offset = directory[3 * ichrom:3 * ichrom + 3]
+            views = []
+            for nrun in (n_nrun, n_nrun, mask_nrun, mask_nrun):
+                views.append(buf[offset:offset + 4 * nrun].cast('I'))
+                offset += 4 * nrun
+            offset += -offset % 8
+            for nrun in (n_nrun, mask_nrun):
+                views.append(buf[offset:offset + 8 * (nrun + 1)].cast('q'))
+                offset += 8 * (nrun + 1)
+            self._views += views
+            n_starts, n_ends, mask_starts, mask_ends, n_cums, mask_cums \
+                = views
+            self.runs.append((n_starts, n_ends, n_cums, mask_starts,
+                              mask_ends, mask_cums))
+
+
+def _align8(nbyte):
+    """Round a number of bytes up to a multiple of 8."""
+    return (nbyte + 7) & ~7
+
+
+class _QueryStats(object):
+    """Counters and timers of the queries served by a Sequence object."""
+
+
+    def __init__(self):
+        """Initialize a _QueryStats object with every counter at zero."""
+        self.queries = 0
+        self.regions = 0
+        self.bases = 0
+        self.bytes_read = 0
+        self.seeks = 0
+        self.query_seconds = 0.0
+        # {latency upper bound in microseconds (power of 2): query count}
+        self.latency_hist = collections.Counter()
+
+
+    def add_query(self, nregion, nbase, seconds):
+        """Count one query call of nregion regions returning nbase bases."""
+        self.queries += 1
+        self.regions += nregion
+        self.bases += nbase
+        self.query_seconds += seconds
+        latency_us = int(seconds * 1e6)
+        self.latency_hist[1 << max(latency_us - 1, 0).bit_length()] += 1
+
+
+    def add_read(self, read_nbyte):
+        """Count one seek and read of read_nbyte bytes from the fasta."""
+        self.seeks += 1
+        self.bytes_read += read_nbyte
+
+
 class Sequence(object):
 
 
-    def __init__(self, fasta_name):
+    def __init__(self, fasta_name, mode='file', cache_nblock=256,
+                 save_2bit=False, stats=False, save_index=False):
         """Initialize a Sequence object with the fasta file.
 
+        The fasta may be bgzip compressed (.fa.gz/.fasta.gz), in which case
+        the BGZF index (.gzi, from bgzip -i or samtools faidx) is required
+        next to the fai, and decompressed blocks are cached between queries.
+
+        Args:
+            fasta_name: name of reference genome fasta file (string)
+            mode: how the fasta is read on query (string)
+                'file': open, seek and read the fasta on every query (default)
+                'mmap': keep one read-only memory map of the fasta open until
+                    close() is called (or the with-block exits)
+                '2bit': hold the whole reference 2-bit packed in memory (see
+                    _TwoBit), loaded from fasta_name + '.2bit' if that file
+                    is newer than the fasta, packed from the fasta otherwise
+            cache_nblock: number of decompressed BGZF blocks to cache (int)
+            save_2bit: write fasta_name + '.2bit' after packing the fasta in
+                '2bit' mode, for instant reload (bool)
+            stats: count queries, bytes read, seeks and query latency, see
+                stats() (bool); off by default so queries pay no overhead
+            save_index: write the binary fai index fasta_name + '.fai.bin'
+                if it is missing or stale (bool), see _load_index()
+
         Attributes:
             fa_name: name of reference genome fasta file (string)
             fai_name: name of reference genome fasta index file (string)
-            fai_data: fai data: chrom,length,offset,nbase/nchar (dict)
+            gzi_name: name of BGZF index file, None if fasta is uncompressed
+            fai_data: fai data: chrom,length,offset,nbase/nchar (dict, or
+                _FaiTable for a Sequence from attach())
+            mode: fasta reading mode (string), 'shared' for a Sequence from
+                attach()
+            index_load_seconds: time spent loading the fai index (float)
 
         Raises:
             InputFileError: error in file extension of file opening
+            ValueError: unknown reading mode
 
         """
+        if mode not in ('file', 'mmap', '2bit'):
+            raise ValueError('unknown sequence reading mode "{}"\n'
+                             .format(mode))
         if (not os.path.exists(fasta_name) or
             not os.path.isfile(fasta_name)):
             raise InputFileError('can not read input fasta "{}"\n'
                                  .format(fasta_name))
-        if not fasta_name.endswith(('.fa', '.fasta')):
-            raise InputFileError('input fasta without .fa/.fasta ({})\n'
+        if not fasta_name.endswith(('.fa', '.fasta', '.fa.gz', '.fasta.gz')):
+            raise InputFileError('input fasta without .fa/.fasta(.gz) ({})\n'
                                  .format(fasta_name))
         fasta_index_name = fasta_name + '.fai'
         if (not os.path.exists(fasta_index_name) or
@@ -41,7 +931,230 @@ class Sequence(object):
                                  .format(fasta_index_name))
         self.fa_name = fasta_name
         self.fai_name = fasta_index_name
-        self.fai_data, self.chrom_list = self._load_index()
+        self.gzi_name = None
+        if fasta_name.endswith('.gz'):
+            self.gzi_name = fasta_name + '.gzi'
+            if (not os.path.exists(self.gzi_name) or
+                not os.path.isfile(self.gzi_name)):
+                raise InputFileError('can not read input fasta BGZF index '
+                                     '"{}"\n'.format(self.gzi_name))
+        self._stats = _QueryStats() if stats else None
+        self._hooks = []
+        self._fai_mmap = None
+        self._mask_index = None
+        time_start = time.perf_counter()
+        self.fai_data, self.chrom_list = self._load_index(save_index)
+        self.index_load_seconds = time.perf_counter() - time_start
+        logger.info('loaded %d contigs from %s in %.3fs', len(self.fai_data),
+                    self.fai_name, self.index_load_seconds)
+        self.mode = mode
+        self._fa_mmap = None
+        self._bgzf = None
+        self._twobit = None
+        self._shm = None
+        self._shm_owner = False
+        self._shared_fasta = None
+        if self.gzi_name:
+            self._bgzf = _BgzfReader(self.fa_name, self.gzi_name,
+                                     mode == 'mmap', cache_nblock)
+        elif mode == 'mmap':
+            with open(self.fa_name, 'rb') as file_fa:
+                self._fa_mmap = mmap.mmap(file_fa.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        if mode == '2bit':
+            twobit_name = self.fa_name + '.2bit'
+            if (os.path.isfile(twobit_name) and
+                os.path.getmtime(twobit_name) >=
+                os.path.getmtime(self.fa_name)):
+                self._twobit = _TwoBit.load(twobit_name)
+            else:
+                self._twobit = _TwoBit.build(self)
+                if save_2bit:
+                    self._twobit.save(twobit_name, self.chrom_list)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        """Release the memory map and block cache of the fasta (if any).
+
+        A Sequence that called share() also frees the shared memory, which
+        must not be used by attached Sequence objects afterwards.
+        """
+        if self._fa_mmap is not None:
+            self._fa_mmap.close()
+            self._fa_mmap = None
+        if self._bgzf is not None:
+            self._bgzf.close()
+        if self._twobit is not None:
+            self._twobit.close()
+        if self._mask_index is not None:
+            self._mask_index.close()
+            self._mask_index = None
+        if isinstance(self.fai_data, _FaiTable):
+            self.fai_data.release()
+            self.fai_data = {}
+            self.chrom_list = []
+        if self._fai_mmap is not None:
+            self._fai_mmap.close()
+            self._fai_mmap = None
+        if self._shm is not None:
+            if self._shared_fasta is not None:
+                self._shared_fasta.release()
+                self._shared_fasta = None
+            self._shm.close()
+            if self._shm_owner:
+                # attach() of python < 3.13 unregisters the name from the
+                # resource tracker, which pool workers share with us:
+                # register it again so that unlink() can unregister it
+                resource_tracker.register(self._shm._name, 'shared_memory')
+                try:
+                    self._shm.unlink()
+                except FileNotFoundError:
+                    pass
+            self._shm = None
+
+
+    # layout of shared memory: header, fasta name, _FaiTable, then the
+    # fasta bytes (or the .2bit content in '2bit' mode), 8-byte aligned
+    _SHARED_HEADER = struct.Struct('=4s?xxxQQQ')
+    _SHARED_MAGIC = b'SQSH'
+
+
+    def share(self, copy_nbyte=67108864):
+        """Publish the reference in shared memory for attach().
+
+        The fai index is packed in a _FaiTable, followed by the fasta bytes
+        (decompressed if the fasta is bgzipped), or the 2-bit packed reference
+        in '2bit' mode. The shared memory lives until this Sequence is
+        closed.
+
+            with Sequence(fasta_name) as seq:
+                shm_name = seq.share()
+                with multiprocessing.Pool(64, init_worker, (shm_name,)):
+                    ...
+            # in init_worker: seq = Sequence.attach(shm_name)
+
+        Args:
+            copy_nbyte: number of fasta bytes copied at a time (int)
+
+        Returns:
+            the name of the shared memory (string)
+
+        """
+        if self._shm is not None:
+            return self._shm.name
+        fa_name = self.fa_name.encode()
+        fai_bytes = _FaiTable.pack(self.fai_data, self.chrom_list)
+        if self._twobit is not None:
+            chunks = self._twobit.dump(self.chrom_list)
+            data_nbyte = sum(map(len, chunks))
+        else:
+            data_nbyte = 0
+            for chrom in self.chrom_list:
+                chrom_len = self.fai_data[chrom]['chrom_len']
+                if chrom_len:
+                    data_nbyte = max(data_nbyte,
+                                     sum(self._byte_range(chrom, 0,
+                                                          chrom_len - 1)))
+        fai_offset = _align8(self._SHARED_HEADER.size + len(fa_name))
+        data_offset = _align8(fai_offset + len(fai_bytes))
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(data_offset + data_nbyte,
+                                                  1))
+        buf = shm.buf
+        self._SHARED_HEADER.pack_into(buf, 0, self._SHARED_MAGIC,
+                                      self._twobit is not None,
+                                      len(fa_name), len(fai_bytes),
+                                      data_nbyte)
+        buf[self._SHARED_HEADER.size:
+            self._SHARED_HEADER.size + len(fa_name)] = fa_name
+        buf[fai_offset:fai_offset + len(fai_bytes)] = fai_bytes
+        if self._twobit is not None:
+            pos = data_offset
+            for chunk in chunks:
+                buf[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+        else:
+            for pos in range(0, data_nbyte, copy_nbyte):
+                chunk = self._read(pos, min(copy_nbyte, data_nbyte - pos))
+                buf[data_offset + pos:data_offset + pos + len(chunk)] = chunk
+        del buf
+        self._shm = shm
+        self._shm_owner = True
+        return shm.name
+
+
+    @classmethod
+    def attach(cls, shm_name, stats=False):
+        """Open a reference published by share() in another process.
+
+        Nothing is copied: the fai table and the sequence are read in place
+        from the shared memory, so the memory used by many worker processes
+        stays flat. The attached Sequence supports the same queries as the
+        one that shared it; close() only detaches it.
+
+        Args:
+            shm_name: name returned by share() (string)
+            stats: see Sequence() (bool)
+
+        Returns:
+            a Sequence object in 'shared' mode
+
+        Raises:
+            InputFileError: the shared memory does not hold a reference
+            FileNotFoundError: no shared memory of this name
+
+        """
+        try:
+            # the creating process owns the shared memory (python >= 3.13)
+            shm = shared_memory.SharedMemory(shm_name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(shm_name)
+            # the resource tracker of this process would unlink the shared
+            # memory when this process exits
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        buf = shm.buf
+        magic, is_twobit, name_nbyte, fai_nbyte, data_nbyte \
+            = cls._SHARED_HEADER.unpack_from(buf)
+        if magic != cls._SHARED_MAGIC:
+            del buf
+            shm.close()
+            raise InputFileError('shared memory "{}" does not hold a '
+                                 'reference\n'.format(shm_name))
+        fai_offset = _align8(cls._SHARED_HEADER.size + name_nbyte)
+        data_offset = _align8(fai_offset + fai_nbyte)
+
+        seq = cls.__new__(cls)
+        seq.fa_name = bytes(buf[cls._SHARED_HEADER.size:
+                                cls._SHARED_HEADER.size + name_nbyte]).decode()
+        seq.fai_name = seq.fa_name + '.fai'
+        seq.gzi_name = None
+        seq._stats = _QueryStats() if stats else None
+        seq._hooks = []
+        seq._fai_mmap = None
+        seq._mask_index = None
+        time_start = time.perf_counter()
+        seq.fai_data = _FaiTable(buf[fai_offset:fai_offset + fai_nbyte])
+        seq.chrom_list = seq.fai_data.names()
+        seq.index_load_seconds = time.perf_counter() - time_start
+        seq.mode = 'shared'
+        seq._fa_mmap = None
+        seq._bgzf = None
+        seq._twobit = None
+        seq._shared_fasta = buf[data_offset:data_offset + data_nbyte]
+        if is_twobit:
+            seq._twobit = _TwoBit.from_buffer(seq._shared_fasta, shm_name)
+        del buf
+        seq._shm = shm
+        seq._shm_owner = False
+        return seq
 
 
     def __str__(self):
@@ -60,11 +1173,22 @@ class Sequence(object):
         return '\n'.join(out_str)
 
 
-    def _load_index(self):
+    # header of the binary fai index: magic, fai size and fai mtime (ns)
+    _FAI_BIN_HEADER = struct.Struct('=4sxxxxQQ')
+    _FAI_BIN_MAGIC = b'FAIB'
+
+
+    def _load_index(self, save_index=False):
         """Load a fasta index file.
 
+        If fasta_name + '.fai.bin' was written for the current fai (same size
+        and modification time), the index is memory mapped from it as a
+        _FaiTable and looked up lazily, which takes constant time whatever
+        the number of contigs. Otherwise the fai is parsed, and written to
+        fasta_name + '.fai.bin' if save_index is True.
+
         Returns:
-            fai_data: a dictionary with index data
+            fai_data: a dictionary (or _FaiTable) with index data
                 {
                     chrom (string):
                     {
@@ -78,6 +1202,12 @@ class Sequence(object):
                 printing)
 
         """
+        fai_stat = os.stat(self.fai_name)
+        fai_bin_name = self.fa_name + '.fai.bin'
+        fai_table = self._load_index_bin(fai_bin_name, fai_stat)
+        if fai_table is not None:
+            return fai_table, fai_table.names()
+
         fai_data = {}
         chrom_list = []
         with open(self.fai_name) as fai_file:
@@ -91,11 +1221,228 @@ class Sequence(object):
                     'line_nchar': int(line_nchar),
                 }
                 chrom_list.append(chrom)
-        print(':: loaded {} contigs from {}'
-              .format(len(fai_data), self.fai_name), file=sys.stderr)
+        if save_index:
+            self._save_index_bin(fai_bin_name, fai_stat, fai_data,
+                                 chrom_list)
         return fai_data, chrom_list
 
 
+    def load_mask_index(self, save=False, block_nbase=4194304):
+        """Load (or build) the index of N and soft-masked runs.
+
+        The index is memory mapped from fasta_name + '.mask' if that file was
+        written for the current fasta and fai (same sizes and modification
+        times), and built from the sequence otherwise (see
+        _MaskIndex.build()). An index already loaded is kept unless the
+        files changed since.
+
+        Args:
+            save: write fasta_name + '.mask' if it is missing or stale (bool)
+            block_nbase: number of bases scanned at a time (int)
+
+        """
+        mask_name = self.fa_name + '.mask'
+        key = self._mask_key()
+        if self._mask_index is not None and self._mask_index.key != key:
+            self._mask_index.close()
+            self._mask_index = None
+        if self._mask_index is None and key is not None:
+            self._mask_index = _MaskIndex.load(mask_name, self.chrom_list,
+                                               key)
+        if self._mask_index is None:
+            time_start = time.perf_counter()
+            self._mask_index = _MaskIndex.build(self, key, block_nbase)
+            logger.info('indexed N and soft-masked runs of %d contigs in '
+                        '%.3fs', len(self.chrom_list),
+                        time.perf_counter() - time_start)
+        if (save and key is not None and
+                not _MaskIndex.is_saved(mask_name, key)):
+            self._mask_index.save(mask_name)
+
+
+    def mask_runs(self, chrom, kind='N'):
+        """Return the N or soft-masked runs of a chrom from the mask index.
+
+        Args:
+            chrom: chrom name (string)
+            kind: 'N' for runs of non-ACGT bases, 'masked' for runs of lower
+                case bases
+
+        Returns:
+            (starts, ends): sequences of 0-based half-open run bounds, in
+            increasing order, None if chrom is not found in the fai index
+
+        Raises:
+            ValueError: unknown kind
+
+        """
+        if kind not in ('N', 'masked'):
+            raise ValueError('unknown kind of run "{}"'.format(kind))
+        if self._mask_index is None:
+            self.load_mask_index()
+        ichrom = self._mask_index.chrom_ids.get(chrom)
+        if ichrom is None:
+            return None
+        runs = self._mask_index.runs[ichrom]
+        return runs[:2] if kind == 'N' else runs[3:5]
+
+
+    def mask_stats(self, qregion):
+        """Count N and soft-masked bases of a region from the mask index.
+
+        No sequence is read: the index (see load_mask_index(), loaded on the
+        first call) answers in O(log(number of runs)).
+
+        Args:
+            qregion: region object initialized with region.Region(...)
+
+        Returns:
+            a dictionary of
+                length: number of bases of the region clipped to the chrom
+                n_count, masked_count: number of non-ACGT / lower case
+                    bases (int)
+                n_frac, masked_frac: fractions of the region length (float)
+                in_gap: the whole region is N (bool)
+            None if query chrom is not found in the fai index
+
+        """
+        query_span = self._query_span(qregion)
+        if query_span is None:
+            return None
+        if self._mask_index is None:
+            self.load_mask_index()
+        query_start, query_end = query_span
+        length = query_end - query_start + 1
+        n_count, masked_count = self._mask_index.count(
+            qregion.chrom, query_start, query_end + 1)
+        return {
+            'length': length,
+            'n_count': n_count,
+            'masked_count': masked_count,
+            'n_frac': n_count / length if length > 0 else 0.0,
+            'masked_frac': masked_count / length if length > 0 else 0.0,
+            'in_gap': length > 0 and n_count == length,
+        }
+
+
+    def _mask_key(self):
+        """Sizes and modification times of the fai and the fasta, None if
+        either is missing (the key of a saved mask index)."""
+        try:
+            fai_stat = os.stat(self.fai_name)
+            fa_stat = os.stat(self.fa_name)
+        except OSError:
+            return None
+        return (fai_stat.st_size, fai_stat.st_mtime_ns, fa_stat.st_size,
+                fa_stat.st_mtime_ns)
+
+
+    def _load_index_bin(self, fai_bin_name, fai_stat):
+        """Memory map a binary fai index, None if missing or stale."""
+        try:
+            with open(fai_bin_name, 'rb') as fai_bin_file:
+                fai_mmap = mmap.mmap(fai_bin_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # missing, unreadable or empty
+            return None
+        header_nbyte = self._FAI_BIN_HEADER.size
+        if len(fai_mmap) >= header_nbyte:
+            magic, fai_nbyte, fai_mtime_ns \
+                = self._FAI_BIN_HEADER.unpack_from(fai_mmap)
+            if (magic == self._FAI_BIN_MAGIC and
+                fai_nbyte == fai_stat.st_size and
+                fai_mtime_ns == fai_stat.st_mtime_ns):
+                try:
+                    fai_table = _FaiTable(memoryview(fai_mmap)[header_nbyte:])
+                except InputFileError as err:
+                    logger.warning('ignore binary fai index %s: %s',
+                                   fai_bin_name, str(err).strip())
+                else:
+                    self._fai_mmap = fai_mmap
+                    return fai_table
+        fai_mmap.close()
+        return None
+
+
+    def _save_index_bin(self, fai_bin_name, fai_stat, fai_data, chrom_list):
+        """Write a binary fai index (atomically, skipped if not writable)."""
+        tmp_name = '{}.{}.tmp'.format(fai_bin_name, os.getpid())
+        try:
+            with open(tmp_name, 'wb') as fai_bin_file:
+                fai_bin_file.write(self._FAI_BIN_HEADER.pack(
+                    self._FAI_BIN_MAGIC, fai_stat.st_size,
+                    fai_stat.st_mtime_ns))
+                fai_bin_file.write(_FaiTable.pack(fai_data, chrom_list))
+            os.replace(tmp_name, fai_bin_name)
+        except OSError as err:
+            logger.warning('can not write binary fai index %s: %s',
+                           fai_bin_name, err)
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+
+    def stats(self):
+        """Return a snapshot of the query statistics of a sequence object.
+
+        Counters other than index_load_seconds and the BGZF cache ones stay 0
+        unless the object is created with stats=True.
+
+        Returns:
+            a dictionary of
+                index_load_seconds: time spent loading the fai index (float)
+                queries: number of query_region/query_regions calls (int)
+                regions: number of regions queried (int)
+                bases: number of bases returned (int)
+                bytes_read: number of fasta bytes read (int)
+                seeks: number of reads at a new fasta offset (int)
+                cache_hits/cache_misses: BGZF block cache lookups (int)
+                query_seconds: total time spent in queries (float)
+                latency_us_hist: number of queries by latency, keyed by the
+                    upper bound in microseconds (power of 2) (dict)
+
+        """
+        query_stats = self._stats or _QueryStats()
+        return {
+            'index_load_seconds': self.index_load_seconds,
+            'queries': query_stats.queries,
+            'regions': query_stats.regions,
+            'bases': query_stats.bases,
+            'bytes_read': query_stats.bytes_read,
+            'seeks': query_stats.seeks,
+            'cache_hits': self._bgzf.cache_hits if self._bgzf else 0,
+            'cache_misses': self._bgzf.cache_misses if self._bgzf else 0,
+            'query_seconds': query_stats.query_seconds,
+            'latency_us_hist': dict(sorted(query_stats.latency_hist.items())),
+        }
+
+
+    def add_hook(self, callback):
+        """Call callback(event, info) after every query.
+
+        Args:
+            callback: function of event ('query_region', 'query_regions'
+                or 'query_bytes') and info, a dictionary of nregion, nbase
+                and seconds of the query
+
+        """
+        self._hooks.append(callback)
+
+
+    def remove_hook(self, callback):
+        """Stop calling a callback added with add_hook()."""
+        self._hooks.remove(callback)
+
+
+    def _record_query(self, event, nregion, nbase, seconds):
+        """Update the statistics and call the hooks after a query."""
+        if self._stats is not None:
+            self._stats.add_query(nregion, nbase, seconds)
+        for callback in self._hooks:
+            callback(event, {'nregion': nregion, 'nbase': nbase,
+                             'seconds': seconds})
+
+
     def query_region(self, qregion):
         """Query a sequence object with a region object.
 
@@ -107,33 +1454,274 @@ class Sequence(object):
             return empty string if query chrom is not found in the fai index
 
         """
+        if self._stats is None and not self._hooks:
+            return self._query_region(qregion)
+        time_start = time.perf_counter()
+        seq_str = self._query_region(qregion)
+        self._record_query('query_region', 1, len(seq_str),
+                           time.perf_counter() - time_start)
+        return seq_str
+
+
+    def query_bytes(self, qregion, strand='+', flank=0, case=None,
+                    zero_copy=False):
+        """Query a region as bytes, optionally reverse complemented, padded
+        and case normalized.
+
+        Newlines are removed, bases complemented and case changed by a single
+        bytes.translate() of the raw fasta bytes, followed by a reversal on
+        the minus strand.
+
+        Args:
+            qregion: region object initialized with region.Region(...)
+            strand: '+' for the reference strand, '-' for the reverse
+                complement (string)
+            flank: number of bases added on both sides of the region, clipped
+                to the chromosome (int)
+            case: None to keep the case of the fasta, 'upper' or 'lower'
+            zero_copy: return a memoryview of the fasta (no copy) when the
+                region lies in a single fasta line and needs no change, in
+                'mmap' and 'shared' mode (bool). The view must be released
+                before the Sequence is closed.
+
+        Returns:
+            a bytes object (or memoryview) of the sequence, empty if query
+            chrom is not found in the fai index
+
+        Raises:
+            ValueError: invalid strand, flank or case
+
+        """
+        if (strand, case) not in _QUERY_TABLES:
+            raise ValueError('invalid strand "{}" or case "{}"'
+                             .format(strand, case))
+        if flank < 0:
+            raise ValueError('flank must be >=0 (found {})'.format(flank))
+        if self._stats is None and not self._hooks:
+            return self._query_bytes(qregion, strand, flank, case, zero_copy)
+        time_start = time.perf_counter()
+        seq_bytes = self._query_bytes(qregion, strand, flank, case,
+                                      zero_copy)
+        self._record_query('query_bytes', 1, len(seq_bytes),
+                           time.perf_counter() - time_start)
+        return seq_bytes
+
+
+    def _query_bytes(self, qregion, strand, flank, case, zero_copy):
+        """Query one region as bytes, see query_bytes()."""
+        query_span = self._query_span(qregion)
+        if query_span is None:
+            return b''
+        query_start = max(query_span[0] - flank, 0)
+        query_end = min(query_span[1] + flank,
+                        self.fai_data[qregion.chrom]['chrom_len'] - 1)
+        table = _QUERY_TABLES[strand, case]
+
+        if self._twobit is not None:
+            seq_bytes = self._twobit.fetch(qregion.chrom, query_start,
+                                           query_end + 1)
+            if strand == '+' and case is None:
+                return seq_bytes
+            seq_bytes = seq_bytes.translate(table)
+        else:
+            offset_start, read_nbyte = self._byte_range(qregion.chrom,
+                                                        query_start,
+                                                        query_end)
+            fasta_buf = (self._fa_mmap if self._shared_fasta is None
+                         else self._shared_fasta)
+            if (zero_copy and fasta_buf is not None and strand == '+' and
+                case is None and read_nbyte == query_end - query_start + 1):
+                if self._stats is not None:
+                    self._stats.add_read(read_nbyte)
+                return memoryview(fasta_buf)[offset_start:
+                                             offset_start + read_nbyte]
+            seq_bytes = self._read(offset_start, read_nbyte).translate(
+                table, b'\n')
+        return seq_bytes[::-1] if strand == '-' else seq_bytes
+
+
+    def _query_region(self, qregion):
+        """Query one region, see query_region()."""
         seq_str = ''
-        if qregion.chrom not in self.fai_data:
-            print('*Warning* chrom "{}" is not found in ref. seq.'
-                  .format(qregion.chrom), file=sys.stderr)
+        query_span = self._query_span(qregion)
+        if query_span is None:
             return seq_str
 
-        chrom_offset = self.fai_data[qregion.chrom]['byte_offset']
-        # query_pstart query_pend are 0-based inclusive
-        if (qregion.length == -1 or
-            qregion.pend > self.fai_data[qregion.chrom]['chrom_len']):
-            query_start = 0
-            query_end = self.fai_data[qregion.chrom]['chrom_len'] - 1
-        else:
-            query_start = qregion.pstart - 1
-            query_end = qregion.pend - 1
+        query_start, query_end = query_span
+        seq_str = self.fetch(qregion.chrom, query_start,
+                             query_end + 1).decode()
+
+        return seq_str
+
+
+    def query_regions(self, qregions, merge_nbyte=4096,
+                      max_read_nbyte=16777216):
+        """Query a sequence object with many region objects at once.
 
-        line_ndiff = (self.fai_data[qregion.chrom]['line_nchar'] -
-                      self.fai_data[qregion.chrom]['line_nbase'])
-        line_nbase = self.fai_data[qregion.chrom]['line_nbase']
+        Requests are sorted by (chrom, byte_offset) and requests that overlap
+        or lie within merge_nbyte bytes of each other are served by a single
+        read, so a panel of regions costs a few large sequential reads instead
+        of one seek and read per region.
+
+        Args:
+            qregions: iterable of region objects (region.Region(...))
+            merge_nbyte: max gap in bytes between two requests to merge into
+                one read (int)
+            max_read_nbyte: max size in bytes of a merged read (int); a single
+                region larger than this is still read in one piece
+
+        Returns:
+            seq_list: a list of sequence strings in the order of qregions.
+            empty string for regions whose chrom is not found in the fai index
+
+        """
+        if self._stats is None and not self._hooks:
+            return self._query_regions(qregions, merge_nbyte, max_read_nbyte)
+        time_start = time.perf_counter()
+        seq_list = self._query_regions(qregions, merge_nbyte, max_read_nbyte)
+        self._record_query('query_regions', len(seq_list),
+                           sum(map(len, seq_list)),
+                           time.perf_counter() - time_start)
+        return seq_list
+
+
+    def _query_regions(self, qregions, merge_nbyte, max_read_nbyte):
+        """Query many regions with coalesced reads, see query_regions()."""
+        if self._twobit is not None:
+            # in memory already, nothing to coalesce
+            return [self._query_region(qregion) for qregion in qregions]
+
+        seq_list = []
+        requests = []
+        for qregion in qregions:
+            seq_list.append('')
+            query_span = self._query_span(qregion)
+            if query_span is None:
+                continue
+            offset_start, read_nbyte = self._byte_range(qregion.chrom,
+                                                        *query_span)
+            requests.append((qregion.chrom, offset_start,
+                             offset_start + read_nbyte, len(seq_list) - 1))
+        # fai byte offsets never overlap between contigs, so sorting on the
+        # offset alone also keeps requests of the same chrom together
+        requests.sort(key=lambda request: (request[1], request[2]))
+
+        ibatch = 0
+        while ibatch < len(requests):
+            batch_start = requests[ibatch][1]
+            batch_end = requests[ibatch][2]
+            jbatch = ibatch + 1
+            while jbatch < len(requests):
+                chrom, offset_start, offset_end, _ = requests[jbatch]
+                if (chrom != requests[ibatch][0] or
+                    offset_start > batch_end + merge_nbyte or
+                    max(batch_end, offset_end) - batch_start >
+                    max_read_nbyte):
+                    break
+                batch_end = max(batch_end, offset_end)
+                jbatch += 1
+
+            batch_bytes = self._read(batch_start, batch_end - batch_start)
+            for _, offset_start, offset_end, iseq in requests[ibatch:jbatch]:
+                seq_list[iseq] = (batch_bytes[offset_start - batch_start:
+                                              offset_end - batch_start]
+                                  .replace(b'\n', b'').decode())
+            ibatch = jbatch
+
+        return seq_list
+
+
+    def _query_span(self, qregion):
+        """Clip a region object to a 0-based inclusive range on its chrom.
+
+        Returns:
+            (query_start, query_end): 0-based inclusive positions, the whole
+            chromosome if the region has no range or runs past chrom end.
+            None if query chrom is not found in the fai index
+
+        """
+        fai = self.fai_data.get(qregion.chrom)
+        if fai is None:
+            logger.warning('chrom "%s" is not found in ref. seq.',
+                           qregion.chrom)
+            return None
+
+        if qregion.length == -1 or qregion.pend > fai['chrom_len']:
+            return 0, fai['chrom_len'] - 1
+        return qregion.pstart - 1, qregion.pend - 1
+
+
+    def fetch(self, chrom, start, end):
+        """Fetch the bases of a 0-based half-open range [start, end) on chrom.
+
+        This is the raw read under the query methods, for modules that scan
+        the reference in large blocks: bases are returned as they are in the
+        fasta (case kept, no newline), the range is clipped to the
+        chromosome, and no stats or hooks are recorded.
+
+        Args:
+            chrom: chromosome name in the fai index (string)
+            start: 0-based inclusive starting position (int)
+            end: 0-based exclusive ending position (int)
+
+        Returns:
+            a bytes object of the sequence, empty if the clipped range is
+            empty
+
+        Raises:
+            KeyError: chrom is not found in the fai index
+
+        """
+        start = max(start, 0)
+        end = min(end, self.fai_data[chrom]['chrom_len'])
+        if start >= end:
+            return b''
+        if self._twobit is not None:
+            return self._twobit.fetch(chrom, start, end)
+        offset_start, read_nbyte = self._byte_range(chrom, start, end - 1)
+        return self._read(offset_start, read_nbyte).replace(b'\n', b'')
+
+
+    def _byte_range(self, chrom, query_start, query_end):
+        """Convert a 0-based inclusive base range to a byte range in fasta.
+
+        Args:
+            chrom: chromosome name in the fai index (string)
+            query_start: 0-based inclusive starting position (int)
+            query_end: 0-based inclusive ending position (int)
+
+        Returns:
+            offset_start: byte offset of the first base in fasta (int)
+            read_nbyte: number of bytes (newlines included) to read (int)
+
+        """
+        fai = self.fai_data[chrom]
+        chrom_offset = fai['byte_offset']
+        line_ndiff = fai['line_nchar'] - fai['line_nbase']
+        line_nbase = fai['line_nbase']
         offset_start = (chrom_offset + query_start + line_ndiff *
                         (query_start // line_nbase))
         offset_end = (chrom_offset + query_end + line_ndiff *
                       (query_end // line_nbase))
-        read_nbyte = offset_end - offset_start + 1
+        return offset_start, offset_end - offset_start + 1
 
-        with open(self.fa_name) as file_fa:
-            file_fa.seek(offset_start)
-            seq_str = file_fa.read(read_nbyte).replace('\n', '')
 
-        return seq_str
+    def _read(self, offset_start, read_nbyte):
+        """Read raw bytes (newlines included) from the fasta.
+
+        Returns:
+            a bytes object of length read_nbyte (shorter at end of file)
+
+        """
+        if self._stats is not None:
+            self._stats.add_read(read_nbyte)
+        if self._bgzf is not None:
+            return self._bgzf.read(offset_start, read_nbyte)
+        if self._shared_fasta is not None:
+            return self._shared_fasta[offset_start:
+                                      offset_start + read_nbyte].tobytes()
+        if self._fa_mmap is not None:
+            return self._fa_mmap[offset_start:offset_start + read_nbyte]
+        with open(self.fa_name, 'rb') as file_fa:
+            file_fa.seek(offset_start)
+            return file_fa.read(read_nbyte)
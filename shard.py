@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""This module splits a reference into shards of balanced callable bases.
+
+    shard_genome() split the reference into nshard shards with about the same
+    number of callable bases (bases outside N gaps, or inside the targets if
+    any), cutting preferably at N gaps and never inside a target.
+
+        Example:
+
+            $ python3 shard.py -f ref.fa -k 50 -g gaps.bed -o shards/shard
+
+        This will write shards/shard.0001.bed ... shards/shard.0050.bed, the
+        callable intervals of every shard. Small contigs are grouped in a
+        shard and large chromosomes split across several.
+
+    find_gaps() find the N gaps of a reference, to be saved once as a BED
+    file (-G) and given to the following runs (-g).
+
+"""
+
+import os
+import sys
+import bisect
+import logging
+import argparse
+import itertools
+
+from sequence import Sequence
+from region import Region, RegionArray, merge_regions, intersect_regions, \
+    complement_regions
+
+logger = logging.getLogger(__name__)
+
+
+def find_gaps(sequence, min_gap=1, block_nbase=4194304):
+    """Find runs of N in the reference.
+
+    The runs come from the mask index of the reference (see
+    Sequence.load_mask_index()), where N stands for any non-ACGT base.
+
+    Args:
+        sequence: Sequence object of the reference
+        min_gap: min length of a gap (int)
+        block_nbase: number of bases read at a time if the mask index is
+            built (int)
+
+    Yields:
+        Region objects of the gaps, in sequence.chrom_list order
+    """
+    sequence.load_mask_index(block_nbase=block_nbase)
+    for chrom in sequence.chrom_list:
+        starts, ends = sequence.mask_runs(chrom, 'N')
+        for start, end in zip(starts, ends):
+            if end - start >= min_gap:
+                yield Region._from_valid(chrom, start + 1, end)
+
+
+def shard_genome(sequence, nshard, gaps=(), targets=None,
+                 max_imbalance=0.05):
+    """Split the reference into shards of balanced callable bases.
+
+    The reference is laid out in sequence.chrom_list order and cut where the
+    running number of callable bases reaches every 1/nshard of the total.
+    A cut inside a target moves to the nearest target boundary; otherwise a
+    cut moves to the nearest gap or chromosome end if that changes the
+    shard by at most max_imbalance of a shard's bases.
+
+    Args:
+        sequence: Sequence object of the reference
+        nshard: number of shards (int)
+        gaps: iterable of Region objects of N gaps (see find_gaps())
+        targets: iterable of Region objects of the target intervals (e.g.
+            exome capture), None for the whole genome
+        max_imbalance: fraction of a shard's bases a cut may move to land in
+            a gap (float)
+
+    Returns:
+        a list of shards, each a list of Region objects (callable intervals
+        of the shard, i.e. outside gaps), shards without any callable base
+        are dropped
+
+    Raises:
+        ValueError: nshard < 1
+    """
+    if nshard < 1:
+        raise ValueError('number of shards must be >=1 (found {})'
+                         .format(nshard))
+    chrom_order = sequence.chrom_list
+    # callable intervals as 0-based half-open global positions (chroms laid
+    # out end to end in fai order)
+    chrom_offsets = _global_offsets(sequence, chrom_order)
+    chrom_offset = dict(zip(chrom_order, chrom_offsets))
+    callable_regions = list(complement_regions(gaps, sequence))
+    intervals = _global_intervals(callable_regions, chrom_offset)
+    if targets is not None:
+        targets = list(merge_regions(targets, 0, chrom_order))
+        weighted = _global_intervals(
+            intersect_regions(callable_regions, targets, chrom_order, True),
+            chrom_offset)
+        no_cut = _global_intervals(targets, chrom_offset)
+    else:
+        weighted = intervals
+        no_cut = []
+
+    cuts = sorted(set(_find_cuts(weighted, no_cut, nshard, max_imbalance)))
+    # split the callable intervals (never across chroms) at the cuts
+    shards = [[] for _ in range(len(cuts) + 1)]
+    for start, end in intervals:
+        ichrom = bisect.bisect_right(chrom_offsets, start) - 1
+        chrom, offset = chrom_order[ichrom], chrom_offsets[ichrom]
+        icut = bisect.bisect_right(cuts, start)
+        while start < end:
+            piece_end = min(end, cuts[icut]) if icut < len(cuts) else end
+            shards[icut].append(Region._from_valid(chrom, start - offset + 1,
+                                                   piece_end - offset))
+            start = piece_end
+            icut += 1
+    return [regions for regions in shards if regions]
+
+
+def _global_offsets(sequence, chrom_list):
+    """Return the global position of the start of every chrom of
+    chrom_list (laid out end to end), followed by the total length."""
+    return list(itertools.accumulate(
+        (sequence.fai_data[chrom]['chrom_len'] for chrom in chrom_list),
+        initial=0))
+
+
+def _global_intervals(regions, chrom_offset):
+    """Convert Region objects to 0-based half-open global (start, end).
+
+    Args:
+        regions: iterable of Region objects
+        chrom_offset: {chrom: global position of its start} (see
+            _global_offsets()), regions on other chroms are skipped
+    """
+    return [(chrom_offset[region.chrom] + region.pstart - 1,
+             chrom_offset[region.chrom] + region.pend)
+            for region in regions if region.chrom in chrom_offset]
+
+
+def _find_cuts(weighted, no_cut, nshard, max_imbalance):
+    """Find nshard - 1 cut positions balancing the weighted bases.
+
+    Args:
+        weighted: sorted non-overlapping (start, end) of the bases to balance
+        no_cut: sorted non-overlapping (start, end) that must not be cut
+        nshard: number of shards (int)
+        max_imbalance: fraction of a shard's bases a cut may move to land
+            at the boundary of a weighted interval (float)
+
+    Returns:
+        a list of global positions (a cut at p separates p - 1 and p)
+    """
+    total = sum(end - start for start, end in weighted)
+    if not total:
+        return []
+    shard_nbase = total / nshard
+    tolerance = max_imbalance * shard_nbase
+    cum_ends = list(itertools.accumulate(end - start
+                                         for start, end in weighted))
+    no_cut_starts = [start for start, _ in no_cut]
+    cuts = []
+    for ishard in range(1, nshard):
+        cum_target = ishard * shard_nbase
+        i = min(bisect.bisect_left(cum_ends, cum_target), len(weighted) - 1)
+        start, end = weighted[i]
+        cum_start = cum_ends[i] - (end - start)
+        cut = start + round(cum_target - cum_start)
+        # snap to the interval boundary (gap, chrom end or target end)
+        if cut - start <= tolerance or end - cut <= tolerance:
+            cut = start if cut - start <= end - cut else end
+        j = bisect.bisect_right(no_cut_starts, cut) - 1
+        if j >= 0 and no_cut[j][0] < cut < no_cut[j][1]:
+            no_start, no_end = no_cut[j]
+            cut = no_start if cut - no_start <= no_end - cut else no_end
+        cuts.append(cut)
+    return cuts
+
+
+def write_bed(regions, out_file):
+    """Write Region objects as BED lines (0-based half-open)."""
+    out_file.writelines('{}\t{}\t{}\n'.format(region.chrom, region.pstart - 1,
+                                              region.pend)
+                        for region in regions)
+
+
+def main():
+    """Wrapper of function shard_genome() with command line inputs."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-f', '--fasta', metavar="fasta",
+                        help="reference FASTA file (with .fai)",
+                        type=str, required=True)
+    parser.add_argument('-k', '--nshard', metavar="num_shard",
+                        help="number of shards",
+                        type=int, required=True)
+    parser.add_argument('-g', '--gaps', metavar="gap_bed",
+                        help=("BED file of the N gaps (default: found in the "
+                              "reference)"),
+                        type=str, required=False, default=None)
+    parser.add_argument('-G', '--save-gaps', metavar="gap_bed",
+                        help="write the N gaps found in the reference",
+                        type=str, required=False, default=None)
+    parser.add_argument('-m', '--min-gap', metavar="min_gap",
+                        help="min length of an N gap to find (default: 1)",
+                        type=int, required=False, default=1)
+    parser.add_argument('-T', '--targets', metavar="target_bed",
+                        help="BED file of targets, never cut, balanced on",
+                        type=str, required=False, default=None)
+    parser.add_argument('-o', '--output', metavar="prefix",
+                        help=("write shards to prefix.NNNN.bed (default: "
+                              "shard number and regions on stdout)"),
+                        type=str, required=False, default=None)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=':: %(message)s',
+                        stream=sys.stderr)
+
+    with Sequence(args.fasta, mode='mmap') as sequence:
+        if args.gaps:
+            gaps = RegionArray.read_bed(args.gaps)
+        else:
+            gaps = list(find_gaps(sequence, args.min_gap))
+            if args.save_gaps:
+                with open(args.save_gaps, 'w') as gap_file:
+                    write_bed(gaps, gap_file)
+        targets = RegionArray.read_bed(args.targets) if args.targets else None
+        shards = shard_genome(sequence, args.nshard, gaps, targets)
+
+    for ishard, regions in enumerate(shards, 1):
+        if args.output:
+            out_dir = os.path.dirname(args.output)
+            if out_dir:
+                os.makedirs(out_dir, exist_ok=True)
+            with open('{}.{:04d}.bed'.format(args.output, ishard),
+                      'w') as bed_file:
+                write_bed(regions, bed_file)
+        else:
+            print('{}\t{}'.format(ishard, ' '.join(map(str, regions))),
+                  file=sys.stdout)
+    logger.info('%d shards, %s callable bases per shard', len(shards),
+                '/'.join(str(sum(region.length for region in regions))
+                         for regions in shards))
+
+
+if __name__ == '__main__':
+
+    main()
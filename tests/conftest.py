@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Shared fixtures: small random references and fastq files.
+
+Every feature is checked against a brute-force reference computed from the
+plain python strings the fixtures were written from.
+"""
+
+import os
+import sys
+import zlib
+import random
+import struct
+
+import pytest
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(_HERE, '..'), os.path.join(_HERE, '..',
+                                                        'prototype')]
+
+# bases drawn for the random references: mostly ACGT in both cases, some N
+# runs and IUPAC codes
+_BASES = 'ACGT' * 6 + 'acgt' * 3 + 'NRY'
+
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000'
+                          '000000')
+
+
+def random_seq(rand, length):
+    """Draw a random sequence string with N runs and soft-masked runs."""
+    seq = []
+    while len(seq) < length:
+        kind = rand.random()
+        run_len = rand.randint(1, 40)
+        if kind < 0.1:
+            seq.append('N' * run_len)
+        elif kind < 0.3:
+            seq.append(''.join(rand.choice('acgtn') for _ in range(run_len)))
+        else:
+            seq.append(''.join(rand.choice(_BASES) for _ in range(run_len)))
+    return ''.join(seq)[:length]
+
+
+def write_fasta(fasta_name, seqs, line_width=60):
+    """Write a fasta and its fai (samtools layout) from {chrom: seq}."""
+    offset = 0
+    with open(fasta_name, 'w') as fasta_file, \
+            open(fasta_name + '.fai', 'w') as fai_file:
+        for chrom, seq in seqs.items():
+            header = '>{} description\n'.format(chrom)
+            offset += len(header)
+            lines = [seq[i:i + line_width]
+                     for i in range(0, len(seq), line_width)]
+            body = ''.join(line + '\n' for line in lines)
+            fasta_file.write(header + body)
+            line_nbase = len(lines[0]) if lines else 0
+            fai_file.write('{}\t{}\t{}\t{}\t{}\n'.format(
+                chrom, len(seq), offset, line_nbase, line_nbase + 1))
+            offset += len(body)
+
+
+def bgzip(in_name, out_name, block_nbyte=1000):
+    """Compress a file as BGZF blocks of block_nbyte and write its .gzi."""
+    with open(in_name, 'rb') as in_file:
+        data = in_file.read()
+    index = []
+    compressed_offset = 0
+    with open(out_name, 'wb') as out_file:
+        for start in range(0, len(data), block_nbyte):
+            block = data[start:start + block_nbyte]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            block_size = 18 + len(cdata) + 8
+            out_file.write(struct.pack('<4sIBBHBBHH', b'\x1f\x8b\x08\x04', 0,
+                                       0, 255, 6, ord('B'), ord('C'), 2,
+                                       block_size - 1))
+            out_file.write(cdata)
+            out_file.write(struct.pack('<II', zlib.crc32(block), len(block)))
+            if start:
+                index.append((compressed_offset, start))
+            compressed_offset += block_size
+        out_file.write(_BGZF_EOF)
+    with open(out_name + '.gzi', 'wb') as gzi_file:
+        gzi_file.write(struct.pack('<Q', len(index)))
+        for offsets in index:
+            gzi_file.write(struct.pack('<QQ', *offsets))
+
+
+def random_records(rand, nread, nlane=2):
+    """Draw fastq records (as strings) with Illumina read ids."""
+    records = []
+    for iread in range(nread):
+        lane = rand.randint(1, nlane)
+        read_len = rand.randint(20, 80)
+        seq = ''.join(rand.choice('ACGTN' if rand.random() < 0.05 else 'ACGT')
+                      for _ in range(read_len))
+        qual = ''.join(chr(33 + rand.randint(2, 40)) for _ in range(read_len))
+        records.append(('@HWI-7001446:480:C6BH4ANXX:{}:1101:{}:{} 1:N:0:ACGT'
+                        .format(lane, iread, rand.randint(1, 9999)),
+                        seq, '+', qual))
+    # a few duplicated reads
+    records += records[:nread // 20]
+    return records
+
+
+def write_fastq(fastq_name, records):
+    """Write fastq records as plain text."""
+    with open(fastq_name, 'w') as fastq_file:
+        fastq_file.writelines('\n'.join(record) + '\n' for record in records)
+
+
+@pytest.fixture(scope='session')
+def reference_seqs():
+    """Sequences of the test reference, {chrom: seq}."""
+    rand = random.Random(7)
+    lengths = {'chr1': 5000, 'chr2': 1234, 'chrM': 61, 'tiny': 1, 'edge': 60,
+               'chr3': 3001}
+    return {chrom: random_seq(rand, length)
+            for chrom, length in lengths.items()}
+
+
+@pytest.fixture
+def reference(tmp_path, reference_seqs):
+    """Plain fasta (with fai) of reference_seqs, returns its name."""
+    fasta_name = str(tmp_path / 'ref.fa')
+    write_fasta(fasta_name, reference_seqs, line_width=60)
+    return fasta_name
+
+
+@pytest.fixture
+def bgzf_reference(tmp_path, reference_seqs):
+    """BGZF fasta (with fai and gzi) of reference_seqs, returns its name."""
+    plain_name = str(tmp_path / 'plain.fa')
+    write_fasta(plain_name, reference_seqs, line_width=70)
+    fasta_name = str(tmp_path / 'ref.fa.gz')
+    bgzip(plain_name, fasta_name, block_nbyte=777)
+    os.rename(plain_name + '.fai', fasta_name + '.fai')
+    return fasta_name
+
+
+@pytest.fixture(scope='session')
+def fastq_records():
+    """Records of the test fastq files, (header, seq, plus, qual) strings."""
+    return random_records(random.Random(11), 3000)
+
+
+@pytest.fixture
+def fastq_files(tmp_path, fastq_records):
+    """The test records as plain, BGZF and multi-member gzip fastq files."""
+    plain_name = str(tmp_path / 'S1.R1.fastq')
+    write_fastq(plain_name, fastq_records)
+    bgzf_name = str(tmp_path / 'S1.R1.bgzf.fastq.gz')
+    bgzip(plain_name, bgzf_name, block_nbyte=4096)
+    gzip_name = str(tmp_path / 'S1.R1.fastq.gz')
+    with open(plain_name, 'rb') as plain_file:
+        data = plain_file.read()
+    with open(gzip_name, 'wb') as gzip_file:
+        half = len(data) // 2
+        for part in (data[:half], data[half:]):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            gzip_file.write(compressor.compress(part) + compressor.flush())
+    return {'plain': plain_name, 'bgzf': bgzf_name, 'gzip': gzip_name}
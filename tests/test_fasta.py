@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""fai building, Fasta queries and region file queries against python string
+slicing."""
+
+import io
+import random
+
+import pytest
+
+from fasta import Fasta, build_index, query_region_file
+
+
+def read_fai(fai_name):
+    with open(fai_name) as fai_file:
+        return fai_file.read()
+
+
+@pytest.mark.parametrize('nproc', [1, 3])
+def test_build_index(reference, nproc, tmp_path):
+    fai_name = str(tmp_path / 'built.fai')
+    fai_data, chrom_list = build_index(reference, nproc, fai_name)
+    assert read_fai(fai_name) == read_fai(reference + '.fai')
+    with Fasta(reference) as fa:
+        assert fai_data == fa.fai_data
+        assert chrom_list == fa.chrom_list
+
+
+@pytest.mark.parametrize('fasta_text', [
+    'ACGT\n>chr1\nACGT\n',
+    '>chr1\nACGT\nACG\nACGT\n',
+    '>chr1\nACGT\n>chr1\nACGT\n',
+])
+def test_build_index_malformed(tmp_path, fasta_text):
+    fasta_name = str(tmp_path / 'bad.fa')
+    with open(fasta_name, 'w') as fasta_file:
+        fasta_file.write(fasta_text)
+    with pytest.raises(ValueError):
+        build_index(fasta_name)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_query_region(reference, reference_seqs, use_mmap):
+    rand = random.Random(5)
+    with Fasta(reference, use_mmap=use_mmap) as fa:
+        for chrom, chrom_seq in reference_seqs.items():
+            for _ in range(50):
+                pstart = rand.randint(1, len(chrom_seq))
+                pend = min(pstart + rand.randint(0, 130), len(chrom_seq))
+                assert fa.query_region(chrom, pstart, pend) == \
+                    ('{}:{}-{}'.format(chrom, pstart, pend),
+                     chrom_seq[pstart - 1:pend])
+            assert fa.query_region(chrom, None, None)[1] == chrom_seq
+            assert fa.query_region(chrom, 1, len(chrom_seq) + 1)[1] is None
+        assert fa.query_region('no_chrom', 1, 10) is None
+
+
+def test_write_record(tmp_path, reference_seqs):
+    fasta_name = str(tmp_path / 'written.fa')
+    with Fasta(fasta_name, 'w', line_width=50) as fa:
+        for chrom, chrom_seq in reference_seqs.items():
+            fa.write_record(chrom, chrom_seq, 'test record')
+        with pytest.raises(ValueError):
+            fa.write_record('chr1', 'ACGT')
+    written_fai = read_fai(fasta_name + '.fai')
+    assert build_index(fasta_name)[1] == list(reference_seqs)
+    assert read_fai(fasta_name + '.fai') == written_fai
+    with Fasta(fasta_name) as fa:
+        for chrom, chrom_seq in reference_seqs.items():
+            assert fa.query_region(chrom, None, None)[1] == chrom_seq
+
+
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_query_region_file(reference, reference_seqs, tmp_path, nproc):
+    rand = random.Random(6)
+    lines = ['# comment', 'track name=x']
+    expected = []
+    for _ in range(300):
+        chrom = rand.choice(list(reference_seqs))
+        chrom_seq = reference_seqs[chrom]
+        pstart = rand.randint(1, len(chrom_seq))
+        pend = min(pstart + rand.randint(0, 100), len(chrom_seq))
+        if rand.random() < 0.5:
+            lines.append('{}\t{}\t{}'.format(chrom, pstart - 1, pend))
+        else:
+            lines.append('{}:{}-{}'.format(chrom, pstart, pend))
+        expected.append('> {}:{}-{}\n{}\n'.format(chrom, pstart, pend,
+                                                  chrom_seq[pstart - 1:pend]))
+    lines += ['no_chrom:1-10', 'chrM:1-1000', 'tiny']
+    expected.append('> tiny:1-1\n{}\n'.format(reference_seqs['tiny']))
+    region_name = str(tmp_path / 'regions.txt')
+    with open(region_name, 'w') as region_file:
+        region_file.write('\n'.join(lines) + '\n')
+    out_file = io.StringIO()
+    nrecord = query_region_file(reference, region_name, out_file, nproc,
+                                chunk_size=17)
+    assert nrecord == len(expected)
+    assert out_file.getvalue() == ''.join(expected)
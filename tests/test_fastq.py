@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Chunked fastq parsing against read_fastq(), and read groups and QC
+statistics against brute force over the records."""
+
+import io
+import json
+import random
+import functools
+import operator
+import collections
+
+import pytest
+
+from conftest import write_fastq
+from fastq import read_fastq, split_fastq, read_fastq_chunk, map_fastq, \
+    get_rgstr, read_group_census, batch_rgstr, write_rgstr_table, fastq_qc, \
+    _qc_records, _merge_qc
+
+RG_STR = '@RG\tID:HWI-7001446.480.{0}\tPL:ILLUMINA\t' \
+    'PU:HWI-7001446.480.C6BH4ANXX.{0}\tSM:S1'
+
+
+def as_bytes(records):
+    return [tuple(line.encode() for line in record) for record in records]
+
+
+@pytest.mark.parametrize('kind', ['plain', 'bgzf', 'gzip'])
+def test_read_fastq(fastq_files, fastq_records, kind):
+    assert list(read_fastq(fastq_files[kind], buffer_nbyte=1000)) == \
+        as_bytes(fastq_records)
+
+
+def test_read_fastq_crlf_and_truncated(tmp_path, fastq_records):
+    fastq_name = str(tmp_path / 'crlf.fastq')
+    with open(fastq_name, 'wb') as fastq_file:
+        fastq_file.write(b''.join(b'\r\n'.join(record) + b'\r\n'
+                                  for record in as_bytes(fastq_records[:50])))
+    assert list(read_fastq(fastq_name, 777)) == as_bytes(fastq_records[:50])
+    with open(fastq_name, 'ab') as fastq_file:
+        fastq_file.write(b'@truncated\nACGT\n')
+    with pytest.raises(ValueError):
+        list(read_fastq(fastq_name))
+
+
+@pytest.mark.parametrize('kind', ['plain', 'bgzf', 'gzip'])
+@pytest.mark.parametrize('nchunk', [1, 2, 3, 7, 50, 1000])
+def test_read_fastq_chunk(fastq_files, kind, nchunk):
+    fastq_name = fastq_files[kind]
+    chunks = split_fastq(fastq_name, nchunk)
+    if kind == 'gzip':
+        assert len(chunks) == 1
+    records = [record for chunk_start, chunk_end in chunks
+               for record in read_fastq_chunk(fastq_name, chunk_start,
+                                              chunk_end, buffer_nbyte=500)]
+    assert records == list(read_fastq(fastq_name))
+
+
+@pytest.mark.parametrize('kind', ['plain', 'bgzf'])
+def test_map_fastq(fastq_files, fastq_records, kind):
+    assert map_fastq(fastq_files[kind], list, operator.add, nproc=3,
+                     nchunk=11) == as_bytes(fastq_records)
+
+
+def test_get_rgstr(fastq_files, fastq_records):
+    first_lane = fastq_records[0][0].split(':')[3]
+    assert get_rgstr(fastq_files['plain']) == RG_STR.format(first_lane)
+    assert get_rgstr(fastq_files['bgzf'], head_nline=None, nproc=2) == \
+        RG_STR.format(1)
+
+
+@pytest.mark.parametrize('kind', ['plain', 'bgzf'])
+def test_read_group_census(fastq_files, fastq_records, kind, tmp_path):
+    lane_counts = collections.Counter(record[0].split(':')[3]
+                                      for record in fastq_records)
+    read_groups = read_group_census(fastq_files[kind], nproc=2)
+    assert [(read_group['rg_str'], read_group['count'])
+            for read_group in read_groups] == \
+        [(RG_STR.format(lane), count)
+         for lane, count in sorted(lane_counts.items())]
+
+    split_prefix = str(tmp_path / 'split')
+    read_groups = read_group_census(fastq_files[kind],
+                                    split_prefix=split_prefix)
+    for read_group, lane in zip(read_groups, sorted(lane_counts)):
+        assert list(read_fastq(read_group['fastq_name'])) == \
+            as_bytes(record for record in fastq_records
+                     if record[0].split(':')[3] == lane)
+
+
+def test_batch_rgstr(fastq_files, tmp_path):
+    empty_name = str(tmp_path / 'empty.fastq')
+    open(empty_name, 'w').close()
+    missing_name = str(tmp_path / 'missing.fastq')
+    cache_name = str(tmp_path / 'cache.json')
+    fastq_list = [fastq_files['plain'], (fastq_files['gzip'], 'S2'),
+                  empty_name, missing_name]
+    results = batch_rgstr(fastq_list, head_nline=4, nproc=2,
+                          cache_name=cache_name)
+    assert list(results) == [fastq_files['plain'], fastq_files['gzip'],
+                             empty_name, missing_name]
+    rg_str = get_rgstr(fastq_files['plain'])
+    assert results[fastq_files['plain']] == {'rg_str': rg_str, 'error': None}
+    assert results[fastq_files['gzip']]['rg_str'] == \
+        rg_str.replace('SM:S1', 'SM:S2')
+    assert results[empty_name]['rg_str'] is None
+    assert results[empty_name]['error'].startswith('ValueError')
+    assert results[missing_name]['error'].startswith('FileNotFoundError')
+    with open(cache_name) as cache_file:
+        assert len(json.load(cache_file)) == 2
+    assert batch_rgstr(fastq_list, head_nline=4,
+                       cache_name=cache_name) == results
+
+    out_file = io.StringIO()
+    write_rgstr_table(results, out_file)
+    rows = [line.split('\t') for line in out_file.getvalue().splitlines()]
+    assert rows[0] == ['fastq', 'ID', 'PL', 'PU', 'SM', 'error']
+    assert rows[1][:5] == [fastq_files['plain']] + \
+        [field.split(':', 1)[1] for field in rg_str.split('\t')[1:]]
+    assert rows[3][1:5] == [''] * 4 and rows[3][5].startswith('ValueError')
+    out_file = io.StringIO()
+    write_rgstr_table(results, out_file, 'json')
+    assert json.loads(out_file.getvalue()) == results
+
+
+@pytest.mark.parametrize('kind', ['plain', 'bgzf', 'gzip'])
+def test_fastq_qc(fastq_files, fastq_records, kind):
+    seqs = [record[1] for record in fastq_records]
+    quals = [record[3] for record in fastq_records]
+    max_len = max(map(len, seqs))
+    gc_hist = [0] * 101
+    for seq in seqs:
+        gc_hist[round(100 * sum(base in 'GCgc' for base in seq) /
+                      len(seq))] += 1
+    per_cycle_bases = [collections.Counter(seq[cycle] for seq in seqs
+                                           if len(seq) > cycle)
+                       for cycle in range(max_len)]
+    per_cycle_quals = [collections.Counter(ord(qual[cycle]) - 33
+                                           for qual in quals
+                                           if len(qual) > cycle)
+                       for cycle in range(max_len)]
+
+    qc = fastq_qc(fastq_files[kind], nproc=2)
+    assert qc['nread'] == len(seqs)
+    assert qc['nbase'] == sum(map(len, seqs))
+    assert qc['length'] == collections.Counter(map(len, seqs))
+    assert qc['gc_hist'] == gc_hist
+    assert qc['n_frac'] == pytest.approx(
+        sum(seq.count('N') for seq in seqs) / qc['nbase'])
+    assert qc['n_per_read'] == collections.Counter(seq.count('N')
+                                                   for seq in seqs)
+    assert qc['per_cycle_bases'] == per_cycle_bases
+    assert qc['per_cycle_quals'] == per_cycle_quals
+    assert qc['per_cycle_mean_qual'] == pytest.approx(
+        [sum(qual * count for qual, count in counter.items()) /
+         sum(counter.values()) for counter in per_cycle_quals])
+    assert qc['duplicate_rate'] == pytest.approx(
+        1 - len(set(seqs)) / len(seqs))
+
+
+def test_fastq_qc_dup_bounded(tmp_path):
+    # 20000 distinct sequences, each read 1 to 4 times (duplicate rate 0.6)
+    rand = random.Random(12)
+    records = []
+    for iseq in range(20000):
+        seq = ''.join(rand.choice('ACGT') for _ in range(30))
+        records += [('@r{}_{}'.format(iseq, icopy), seq, '+', 'I' * 30)
+                    for icopy in range(1 + iseq % 4)]
+    rand.shuffle(records)
+    fastq_name = str(tmp_path / 'dup.fastq')
+    write_fastq(fastq_name, records)
+
+    qc_records = functools.partial(_qc_records, dup_nkey=1000,
+                                   batch_nread=3000)
+    whole_qc = qc_records(read_fastq(fastq_name))
+    assert len(whole_qc['dup']) == 1000
+    # the chunk results are bounded, and merge into the sample of the whole
+    chunk_qcs = [qc_records(read_fastq_chunk(fastq_name, *chunk))
+                 for chunk in split_fastq(fastq_name, 7)]
+    assert all(len(qc['dup']) <= 1000 for qc in chunk_qcs)
+    merged_qc = functools.reduce(_merge_qc, chunk_qcs)
+    assert len(merged_qc['dup']) == 1000
+    assert merged_qc['dup'] == whole_qc['dup']
+
+    qc = fastq_qc(fastq_name, nproc=2, dup_nkey=1000)
+    assert qc['duplicate_rate'] == pytest.approx(0.6, abs=0.05)
+    assert fastq_qc(fastq_name, dup_nkey=20000)['duplicate_rate'] == \
+        pytest.approx(0.6)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""N and soft-masked run index against brute force over python strings."""
+
+import os
+import re
+import random
+
+import pytest
+
+import sequence as sequence_module
+from conftest import random_seq, write_fasta
+from sequence import Sequence
+from region import Region
+
+
+def expected_runs(seq, pattern):
+    matches = list(re.finditer(pattern, seq))
+    return ([match.start() for match in matches],
+            [match.end() for match in matches])
+
+
+def expected_stats(seqs, region):
+    seq = seqs[region.chrom]
+    if region.length != -1 and region.pend <= len(seq):
+        seq = seq[region.pstart - 1:region.pend]
+    n_count = len(re.sub('[ACGTacgt]', '', seq))
+    masked_count = sum(map(str.islower, seq))
+    return {
+        'length': len(seq),
+        'n_count': n_count,
+        'masked_count': masked_count,
+        'n_frac': n_count / len(seq),
+        'masked_frac': masked_count / len(seq),
+        'in_gap': n_count == len(seq),
+    }
+
+
+def random_regions(seqs, nregion=300, seed=1):
+    rand = random.Random(seed)
+    regions = [Region(chrom) for chrom in seqs]
+    for _ in range(nregion):
+        chrom = rand.choice(list(seqs))
+        pstart = rand.randint(1, len(seqs[chrom]))
+        regions.append(Region(chrom, pstart,
+                              pstart + rand.choice([0, 1, 10, 100, 6000])))
+    return regions
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap', '2bit'])
+def test_mask_stats(reference, reference_seqs, mode):
+    with Sequence(reference, mode=mode) as seq:
+        for region in random_regions(reference_seqs):
+            assert seq.mask_stats(region) == \
+                expected_stats(reference_seqs, region), str(region)
+        assert seq.mask_stats(Region('no_chrom', 1, 10)) is None
+        for chrom, chrom_seq in reference_seqs.items():
+            assert [list(bounds) for bounds in seq.mask_runs(chrom, 'N')] \
+                == list(expected_runs(chrom_seq, '[^ACGTacgt]+'))
+            assert [list(bounds) for bounds in seq.mask_runs(chrom,
+                                                             'masked')] \
+                == list(expected_runs(chrom_seq, '[a-z]+'))
+        assert seq.mask_runs('no_chrom') is None
+        with pytest.raises(ValueError):
+            seq.mask_runs('chr1', 'x')
+
+
+def test_mask_index_block_size(reference, reference_seqs):
+    # runs crossing block boundaries are joined
+    with Sequence(reference) as seq:
+        seq.load_mask_index(block_nbase=7)
+        for chrom, chrom_seq in reference_seqs.items():
+            assert [list(bounds) for bounds in seq.mask_runs(chrom, 'N')] \
+                == list(expected_runs(chrom_seq, '[^ACGTacgt]+'))
+
+
+def test_mask_index_saved(reference, reference_seqs, monkeypatch):
+    mask_name = reference + '.mask'
+    with Sequence(reference) as seq:
+        seq.mask_stats(Region('chr1', 1, 10))
+        assert not os.path.exists(mask_name)
+        # saved after the index was built by mask_stats()
+        seq.load_mask_index(save=True)
+    assert os.path.isfile(mask_name)
+
+    def no_build(*args, **kwargs):
+        raise AssertionError('mask index built again')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(sequence_module._MaskIndex, 'build', no_build)
+        with Sequence(reference) as seq:
+            for region in random_regions(reference_seqs, 50):
+                assert seq.mask_stats(region) == \
+                    expected_stats(reference_seqs, region)
+
+    # same lengths (same fai), other bases: the saved index is stale
+    rand = random.Random(8)
+    new_seqs = {chrom: random_seq(rand, len(chrom_seq))
+                for chrom, chrom_seq in reference_seqs.items()}
+    fa_stat = os.stat(reference)
+    write_fasta(reference, new_seqs)
+    os.utime(reference, ns=(fa_stat.st_atime_ns, fa_stat.st_mtime_ns + 1000))
+    assert os.path.getsize(reference) == fa_stat.st_size
+    with Sequence(reference) as seq:
+        for region in random_regions(new_seqs, 50):
+            assert seq.mask_stats(region) == expected_stats(new_seqs, region)
+        seq.load_mask_index(save=True)
+    with monkeypatch.context() as patch:
+        patch.setattr(sequence_module._MaskIndex, 'build', no_build)
+        with Sequence(reference, mode='2bit') as seq:
+            assert seq.mask_stats(Region('chr1')) == \
+                expected_stats(new_seqs, Region('chr1'))
+
+
+def test_mask_index_twobit_agrees(reference, reference_seqs):
+    with Sequence(reference) as seq, \
+            Sequence(reference, mode='2bit') as twobit_seq:
+        for chrom in reference_seqs:
+            for kind in ('N', 'masked'):
+                assert [list(bounds)
+                        for bounds in seq.mask_runs(chrom, kind)] == \
+                    [list(bounds)
+                     for bounds in twobit_seq.mask_runs(chrom, kind)]
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Reference server answers against direct Sequence queries."""
+
+import os
+import time
+import random
+import socket
+import asyncio
+import contextlib
+import threading
+
+import pytest
+
+from sequence import Sequence
+from region import RegionArray
+import refserver
+from refserver import RefServer, serve, query_server
+
+
+def exit_worker(ref_name, region_strs):
+    """A query worker that dies (breaks the process pool)."""
+    os._exit(1)
+
+
+@pytest.fixture
+def broken_workers(monkeypatch):
+    """Make the workers of the next server die on their first query."""
+    monkeypatch.setattr(refserver, '_query_worker', exit_worker)
+
+
+@pytest.fixture
+def server(tmp_path, reference, bgzf_reference):
+    """Serve the test references on a Unix socket in a thread."""
+    socket_name = str(tmp_path / 'ref.sock')
+    references = {'plain': reference, 'bgzf': bgzf_reference}
+
+    async def run_server():
+        try:
+            await serve(references, socket_name, nproc=2, max_pending=4)
+        finally:
+            # connections still being served
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    server_task = loop.create_task(run_server())
+
+    def run():
+        with contextlib.suppress(asyncio.CancelledError):
+            loop.run_until_complete(server_task)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    for _ in range(500):
+        if os.path.exists(socket_name) or server_task.done():
+            break
+        time.sleep(0.01)
+    try:
+        yield socket_name
+    finally:
+        loop.call_soon_threadsafe(server_task.cancel)
+        thread.join()
+        loop.close()
+    assert not os.path.exists(socket_name)
+
+
+def request(socket_name, data):
+    """Send raw request bytes, return the whole response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(30)
+        conn.connect(socket_name)
+        conn.sendall(data)
+        conn.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+def random_region_strs(seqs, nregion, seed):
+    rand = random.Random(seed)
+    region_strs = list(seqs)
+    for _ in range(nregion):
+        chrom = rand.choice(list(seqs))
+        pstart = rand.randint(1, len(seqs[chrom]))
+        region_strs.append('{}:{}-{}'.format(chrom, pstart,
+                                             pstart + rand.randint(0, 300)))
+    return region_strs + ['no_chrom:1-10', 'chr2:7']
+
+
+def test_query_server(server, reference, reference_seqs):
+    region_strs = random_region_strs(reference_seqs, 2000, seed=1)
+    with Sequence(reference) as seq:
+        expected = seq.query_regions(RegionArray.from_strings(region_strs))
+    assert list(query_server(region_strs, server, batch_nregion=37,
+                             max_pending=5)) == expected
+    assert list(query_server(region_strs, server, ref_name='bgzf',
+                             batch_nregion=500)) == expected
+    with pytest.raises(ValueError):
+        list(query_server(['chr1:10-5'], server))
+    with pytest.raises(ValueError):
+        list(query_server(['chr1'], server, ref_name='no_ref'))
+
+
+def test_pipelined_requests(server, reference_seqs):
+    lines = ['chr1:1-10', '@bgzf chr2:5-9 chrM', '', 'chr1:x-1',
+             '@no_ref chr1', 'tiny no_chrom'] * 20
+    response = request(server, ''.join(line + '\n' for line in lines)
+                       .encode()).decode().split('\n')
+    assert response.pop() == ''
+    assert len(response) == len(lines)
+    for line, response_line in zip(lines, response):
+        if line in ('chr1:x-1', '@no_ref chr1'):
+            assert response_line.startswith('ERR\t')
+        else:
+            assert response_line == '\t'.join(
+                str_seq for region_str in line.split()
+                if not region_str.startswith('@')
+                for str_seq in [query(reference_seqs, region_str)])
+
+
+def query(seqs, region_str):
+    region = RegionArray.from_strings([region_str])[0]
+    if region.chrom not in seqs:
+        return ''
+    seq = seqs[region.chrom]
+    if region.length == -1 or region.pend > len(seq):
+        return seq
+    return seq[region.pstart - 1:region.pend]
+
+
+def test_http(server, reference_seqs):
+    response = request(server, b'GET /query?ref=bgzf&region=chr2:1-10'
+                       b'&region=tiny HTTP/1.0\r\nHost: x\r\n\r\n')
+    header, body = response.split(b'\r\n\r\n', 1)
+    assert header.startswith(b'HTTP/1.0 200 OK')
+    assert body.decode() == '{}\n{}\n'.format(reference_seqs['chr2'][:10],
+                                              reference_seqs['tiny'])
+    response = request(server, b'GET /query?region=chr1:9-2 HTTP/1.0\r\n\r\n')
+    assert response.startswith(b'HTTP/1.0 400 Bad Request')
+    response = request(server, b'GET /other HTTP/1.0\r\n\r\n')
+    assert response.startswith(b'HTTP/1.0 404 Not Found')
+
+
+def test_broken_workers(broken_workers, server):
+    response = request(server, b'GET /query?region=chr1:1-10 HTTP/1.0\r\n\r\n')
+    header, body = response.split(b'\r\n\r\n', 1)
+    assert header.startswith(b'HTTP/1.0 500 Internal Server Error')
+    assert body.startswith(b'BrokenProcessPool: ')
+    assert request(server, b'chr1:1-10\n').startswith(
+        b'ERR\tBrokenProcessPool: ')
+
+
+def test_ref_server_errors(reference):
+    with pytest.raises(ValueError):
+        RefServer({})
+    with pytest.raises(ValueError):
+        RefServer([reference], nproc=0)
+    assert RefServer([reference]).default_ref == os.path.basename(reference)
+    with pytest.raises(ValueError):
+        asyncio.run(serve([reference]))
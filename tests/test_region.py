@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Region parsing, RegionIndex and region set operations against brute force
+over python sets of positions."""
+
+import random
+
+import pytest
+
+from sequence import Sequence
+from region import Region, RegionArray, RegionIndex, RegionRangeError, \
+    sort_regions, merge_regions, intersect_regions, subtract_regions, \
+    complement_regions
+
+CHROMS = ['chr1', 'chr2', 'chr10']
+
+
+def random_regions(nregion, seed, max_pos=2000, max_len=100):
+    rand = random.Random(seed)
+    regions = []
+    for _ in range(nregion):
+        pstart = rand.randint(1, max_pos)
+        regions.append(Region(rand.choice(CHROMS), pstart,
+                              pstart + rand.randint(0, max_len)))
+    return regions
+
+
+def positions(regions):
+    """Set of (chrom, pos) covered by regions."""
+    return {(region.chrom, pos) for region in regions
+            for pos in range(region.pstart, region.pend + 1)}
+
+
+def assert_sorted_disjoint(regions):
+    for region, next_region in zip(regions, regions[1:]):
+        assert (CHROMS.index(region.chrom), region.pend) < \
+            (CHROMS.index(next_region.chrom), next_region.pstart)
+        assert region.length == region.pend - region.pstart + 1 > 0
+
+
+def test_region_array_from_strings():
+    region_strs = ['chr1', 'chr1:5', 'chr2:10-20', 'chrUn_x:1-1']
+    regions = RegionArray.from_strings(region_strs)
+    assert [str(region) for region in regions] == \
+        ['chr1', 'chr1:5-5', 'chr2:10-20', 'chrUn_x:1-1']
+    assert regions[2].length == 11
+    with pytest.raises(ValueError):
+        RegionArray.from_strings(['chr1:x-2'])
+    with pytest.raises(RegionRangeError):
+        RegionArray.from_strings(['chr1:20-10'])
+
+
+def test_region_array_from_bed():
+    bed_lines = ['track name=x', '# comment', 'chr1\t0\t10\tname',
+                 'chr2\t99\t100', '']
+    regions = RegionArray.from_bed(bed_lines)
+    assert [str(region) for region in regions] == ['chr1:1-10',
+                                                   'chr2:100-100']
+    with pytest.raises(RegionRangeError):
+        RegionArray.from_bed(['chr1\t10\t10'])
+
+
+def test_region_index():
+    regions = random_regions(400, seed=1)
+    index = RegionIndex(regions)
+    assert len(index) == len(regions)
+    for query in random_regions(200, seed=2, max_len=300):
+        expected = [region for region in regions
+                    if region.chrom == query.chrom and
+                    region.pstart <= query.pend and
+                    query.pstart <= region.pend]
+        hits = index.overlaps(query)
+        assert sorted(map(id, hits)) == sorted(map(id, expected))
+        assert [region.pstart for region in hits] == \
+            sorted(region.pstart for region in expected)
+        pos = query.pstart
+        assert sorted(map(id, index.contains(query.chrom, pos))) == \
+            sorted(id(region) for region in regions
+                   if region.chrom == query.chrom and
+                   region.pstart <= pos <= region.pend)
+        nearest = index.nearest(query)
+        if expected:
+            assert sorted(map(id, nearest)) == sorted(map(id, expected))
+        else:
+            chrom_regions = [region for region in regions
+                             if region.chrom == query.chrom]
+            distance = min(max(region.pstart - query.pend,
+                               query.pstart - region.pend)
+                           for region in chrom_regions)
+            assert nearest
+            assert all(max(region.pstart - query.pend,
+                           query.pstart - region.pend) == distance
+                       for region in nearest)
+    assert index.overlaps(Region('no_chrom', 1, 10)) == []
+
+
+def test_region_index_whole_chrom():
+    index = RegionIndex([Region('chr1'), Region('chr2', 5, 10)])
+    assert [str(region) for region in index.contains('chr1', 123456)] == \
+        ['chr1']
+    assert index.contains('chr2', 11) == []
+
+
+@pytest.mark.parametrize('buffer_nregion', [7, 1000000])
+def test_sort_regions(buffer_nregion):
+    regions = random_regions(300, seed=3)
+    sorted_regions = list(sort_regions(iter(regions), CHROMS,
+                                       buffer_nregion))
+    assert [(region.chrom, region.pstart, region.pend)
+            for region in sorted_regions] == \
+        sorted(((region.chrom, region.pstart, region.pend)
+                for region in regions),
+               key=lambda key: (CHROMS.index(key[0]), key[1], key[2]))
+
+
+def test_merge_regions():
+    regions = random_regions(300, seed=4)
+    merged = list(merge_regions(regions, 0, CHROMS))
+    assert_sorted_disjoint(merged)
+    assert positions(merged) == positions(regions)
+    # no two merged regions are adjacent
+    assert all(region.chrom != next_region.chrom or
+               next_region.pstart > region.pend + 1
+               for region, next_region in zip(merged, merged[1:]))
+
+
+def test_merge_regions_gap():
+    regions = [Region('chr1', 1, 10), Region('chr1', 16, 20),
+               Region('chr1', 30, 40)]
+    assert [str(region) for region in merge_regions(regions, 5)] == \
+        ['chr1:1-20', 'chr1:30-40']
+
+
+def test_intersect_subtract_regions():
+    regions = random_regions(300, seed=5)
+    other_regions = random_regions(300, seed=6)
+    intersection = list(intersect_regions(regions, other_regions, CHROMS))
+    difference = list(subtract_regions(regions, other_regions, CHROMS))
+    assert_sorted_disjoint(intersection)
+    assert_sorted_disjoint(difference)
+    assert positions(intersection) == \
+        positions(regions) & positions(other_regions)
+    assert positions(difference) == \
+        positions(regions) - positions(other_regions)
+
+
+def test_complement_regions(reference, reference_seqs):
+    with Sequence(reference) as seq:
+        chrom_len = len(reference_seqs['chr2'])
+        regions = [Region('chr1', 100, 200), Region('chr1', 150, 300),
+                   Region('chr2', chrom_len - 10, chrom_len + 50),
+                   Region('chr2', chrom_len + 100, chrom_len + 200),
+                   Region('no_chrom', 1, 10)]
+        complement = list(complement_regions(regions, seq))
+    all_positions = {(chrom, pos) for chrom, chrom_seq
+                     in reference_seqs.items()
+                     for pos in range(1, len(chrom_seq) + 1)}
+    assert all(region.length > 0 for region in complement)
+    assert positions(complement) == all_positions - positions(regions)
+    assert [region.chrom for region in complement][:2] == ['chr1', 'chr1']
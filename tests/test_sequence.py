@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Sequence queries in every reading mode against python string slicing."""
+
+import os
+import re
+import random
+
+import pytest
+
+from sequence import Sequence
+from region import Region
+
+_COMPLEMENT = str.maketrans('ACGTNRYacgtnry', 'TGCANYRtgcanyr')
+
+
+def expected_region(seqs, region):
+    """Bases of a region as Sequence.query_region() documents them."""
+    seq = seqs[region.chrom]
+    if region.length == -1 or region.pend > len(seq):
+        return seq
+    return seq[region.pstart - 1:region.pend]
+
+
+def as_twobit(seq):
+    """A sequence as held by a 2-bit reference (non-ACGT bases are N)."""
+    return re.sub('[^ACGTacgt]', lambda match: 'n' if match.group().islower()
+                  else 'N', seq)
+
+
+def random_regions(seqs, nregion=300, seed=1):
+    """Draw regions of every chrom, some of them past the chrom end."""
+    rand = random.Random(seed)
+    regions = [Region(chrom) for chrom in seqs]
+    for _ in range(nregion):
+        chrom = rand.choice(list(seqs))
+        pstart = rand.randint(1, len(seqs[chrom]))
+        pend = pstart + rand.choice([0, 1, 59, 60, 61, 500, 2000])
+        regions.append(Region(chrom, pstart, pend))
+    return regions
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap'])
+@pytest.mark.parametrize('compressed', [False, True])
+def test_query_region(reference, bgzf_reference, reference_seqs, mode,
+                      compressed):
+    fasta_name = bgzf_reference if compressed else reference
+    with Sequence(fasta_name, mode=mode, cache_nblock=2) as seq:
+        for region in random_regions(reference_seqs):
+            assert (seq.query_region(region) ==
+                    expected_region(reference_seqs, region)), str(region)
+        assert seq.query_region(Region('no_chrom', 1, 10)) == ''
+
+
+def test_query_region_twobit(reference, reference_seqs):
+    twobit_seqs = {chrom: as_twobit(seq)
+                   for chrom, seq in reference_seqs.items()}
+    with Sequence(reference, mode='2bit', save_2bit=True) as seq:
+        for region in random_regions(reference_seqs):
+            assert (seq.query_region(region) ==
+                    expected_region(twobit_seqs, region)), str(region)
+    assert os.path.isfile(reference + '.2bit')
+    # loaded from the saved .2bit
+    with Sequence(reference, mode='2bit') as seq:
+        for region in random_regions(reference_seqs, seed=2):
+            assert (seq.query_region(region) ==
+                    expected_region(twobit_seqs, region)), str(region)
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap', '2bit'])
+def test_query_regions(reference, reference_seqs, mode):
+    regions = random_regions(reference_seqs, 500)
+    regions.append(Region('no_chrom', 1, 10))
+    with Sequence(reference, mode=mode) as seq:
+        seq_list = seq.query_regions(regions, merge_nbyte=100,
+                                     max_read_nbyte=1000)
+        assert seq_list == [seq.query_region(region) for region in regions]
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap'])
+def test_fetch(reference, reference_seqs, mode):
+    rand = random.Random(3)
+    with Sequence(reference, mode=mode) as seq:
+        for chrom, chrom_seq in reference_seqs.items():
+            for _ in range(50):
+                start = rand.randint(-5, len(chrom_seq) + 5)
+                end = start + rand.randint(-2, 200)
+                assert (seq.fetch(chrom, start, end).decode() ==
+                        chrom_seq[max(start, 0):max(end, 0)]), (chrom, start,
+                                                                end)
+        with pytest.raises(KeyError):
+            seq.fetch('no_chrom', 0, 10)
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap'])
+def test_query_bytes(reference, reference_seqs, mode):
+    rand = random.Random(4)
+    with Sequence(reference, mode=mode) as seq:
+        for _ in range(200):
+            chrom = rand.choice(list(reference_seqs))
+            chrom_seq = reference_seqs[chrom]
+            pstart = rand.randint(1, len(chrom_seq))
+            pend = min(pstart + rand.randint(0, 150), len(chrom_seq))
+            flank = rand.choice([0, 1, 10])
+            expected = chrom_seq[max(pstart - 1 - flank, 0):pend + flank]
+            region = Region(chrom, pstart, pend)
+            assert seq.query_bytes(region, flank=flank).decode() == expected
+            assert (seq.query_bytes(region, '-', flank).decode() ==
+                    expected.translate(_COMPLEMENT)[::-1])
+            assert (seq.query_bytes(region, '-', flank, 'upper').decode() ==
+                    expected.translate(_COMPLEMENT)[::-1].upper())
+            assert (seq.query_bytes(region, case='lower').decode() ==
+                    chrom_seq[pstart - 1:pend].lower())
+        with pytest.raises(ValueError):
+            seq.query_bytes(Region('chr1', 1, 10), strand='x')
+
+
+def test_query_bytes_zero_copy(reference, reference_seqs):
+    with Sequence(reference, mode='mmap') as seq:
+        view = seq.query_bytes(Region('chr1', 2, 30), zero_copy=True)
+        assert bytes(view).decode() == reference_seqs['chr1'][1:30]
+        if isinstance(view, memoryview):
+            view.release()
+
+
+def test_stats_and_hooks(reference, reference_seqs):
+    events = []
+    with Sequence(reference, stats=True) as seq:
+        seq.add_hook(lambda event, info: events.append((event, info)))
+        seq.query_region(Region('chr1', 1, 100))
+        seq.query_regions([Region('chr1', 1, 10), Region('chr2', 5, 9)])
+        seq.query_bytes(Region('chr2', 1, 5))
+        stats = seq.stats()
+    assert [event for event, _ in events] == ['query_region', 'query_regions',
+                                              'query_bytes']
+    assert [info['nbase'] for _, info in events] == [100, 15, 5]
+    assert stats['queries'] == 3
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Gaps and shards against brute force over python sets of positions."""
+
+import io
+import re
+
+import pytest
+
+from sequence import Sequence
+from region import Region
+from shard import find_gaps, shard_genome, write_bed
+
+
+def positions(regions):
+    """Set of (chrom, pos) covered by regions."""
+    return {(region.chrom, pos) for region in regions
+            for pos in range(region.pstart, region.pend + 1)}
+
+
+def expected_gaps(seqs, min_gap):
+    return [(chrom, match.start() + 1, match.end())
+            for chrom, seq in seqs.items()
+            for match in re.finditer('[^ACGTacgt]+', seq)
+            if match.end() - match.start() >= min_gap]
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap', '2bit'])
+@pytest.mark.parametrize('min_gap', [1, 5])
+def test_find_gaps(reference, reference_seqs, mode, min_gap):
+    with Sequence(reference, mode=mode) as seq:
+        gaps = list(find_gaps(seq, min_gap, block_nbase=100))
+    assert [(gap.chrom, gap.pstart, gap.pend) for gap in gaps] == \
+        expected_gaps(reference_seqs, min_gap)
+
+
+@pytest.mark.parametrize('nshard', [1, 2, 3, 7, 20])
+def test_shard_genome(reference, reference_seqs, nshard):
+    max_imbalance = 0.05
+    with Sequence(reference) as seq:
+        gaps = list(find_gaps(seq, min_gap=3))
+        shards = shard_genome(seq, nshard, gaps, None, max_imbalance)
+    all_positions = {(chrom, pos) for chrom, chrom_seq
+                     in reference_seqs.items()
+                     for pos in range(1, len(chrom_seq) + 1)}
+    callable_positions = all_positions - positions(gaps)
+    shard_positions = [positions(regions) for regions in shards]
+    assert len(shards) == nshard
+    assert set().union(*shard_positions) == callable_positions
+    assert sum(map(len, shard_positions)) == len(callable_positions)
+
+    # shards follow the reference order
+    chrom_order = list(reference_seqs)
+    keys = [(chrom_order.index(region.chrom), region.pstart, region.pend)
+            for regions in shards for region in regions]
+    assert keys == sorted(keys)
+    assert all(key[2] < next_key[1] or key[0] < next_key[0]
+               for key, next_key in zip(keys, keys[1:]))
+
+    shard_nbase = len(callable_positions) / nshard
+    for nbase in map(len, shard_positions):
+        assert abs(nbase - shard_nbase) <= 2 * max_imbalance * shard_nbase + 1
+
+
+def test_shard_genome_targets(reference, reference_seqs):
+    targets = [Region('chr1', 100, 900), Region('chr1', 850, 2000),
+               Region('chr1', 2500, 4800), Region('chr2', 1, 1234),
+               Region('chr3', 10, 2900), Region('chrM', 1, 61)]
+    with Sequence(reference) as seq:
+        gaps = list(find_gaps(seq))
+        shards = shard_genome(seq, 6, gaps, targets)
+    shard_positions = [positions(regions) for regions in shards]
+    gap_positions = positions(gaps)
+    # no target is cut: its callable bases all go to one shard
+    for target in [Region('chr1', 100, 2000)] + targets[2:]:
+        target_positions = positions([target]) - gap_positions
+        assert sum(bool(target_positions & shard) for shard
+                   in shard_positions) == 1, str(target)
+    assert set().union(*shard_positions) == \
+        {(chrom, pos) for chrom, chrom_seq in reference_seqs.items()
+         for pos in range(1, len(chrom_seq) + 1)} - gap_positions
+
+
+def test_shard_genome_errors(reference):
+    with Sequence(reference) as seq:
+        with pytest.raises(ValueError):
+            shard_genome(seq, 0)
+        all_gaps = [Region(chrom, 1, seq.fai_data[chrom]['chrom_len'])
+                    for chrom in seq.chrom_list]
+        assert shard_genome(seq, 5, all_gaps) == []
+
+
+def test_write_bed():
+    out_file = io.StringIO()
+    write_bed([Region('chr1', 1, 10), Region('chr2', 5, 5)], out_file)
+    assert out_file.getvalue() == 'chr1\t0\t10\nchr2\t4\t5\n'
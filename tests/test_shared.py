@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""References shared between processes, and the binary fai index."""
+
+import os
+import sys
+import subprocess
+import multiprocessing
+
+import pytest
+
+from sequence import Sequence, _FaiTable
+from region import Region
+
+REGIONS = [Region('chr1', 1, 100), Region('chr1', 4950, 5000),
+           Region('chr2'), Region('chrM', 60, 61), Region('tiny', 1, 1),
+           Region('chr3', 61, 200)]
+
+_ATTACH_CODE = '''
+import sys
+sys.path[:0] = {path!r}
+from sequence import Sequence
+from region import Region
+seq = Sequence.attach({shm_name!r})
+print(seq.query_region(Region('chr2', 11, 20)))
+seq.close()
+'''
+
+
+def query_shared(shm_name):
+    """Query REGIONS in a pool worker attached to a shared reference."""
+    with Sequence.attach(shm_name) as seq:
+        return [seq.query_region(region) for region in REGIONS]
+
+
+@pytest.mark.parametrize('mode', ['file', 'mmap', '2bit'])
+def test_share_attach(reference, mode):
+    with Sequence(reference, mode=mode) as seq:
+        expected = [seq.query_region(region) for region in REGIONS]
+        shm_name = seq.share()
+        assert seq.share() == shm_name
+        with Sequence.attach(shm_name) as shared_seq:
+            assert shared_seq.mode == 'shared'
+            assert list(shared_seq.chrom_list) == seq.chrom_list
+            assert [shared_seq.query_region(region)
+                    for region in REGIONS] == expected
+            assert shared_seq.query_regions(REGIONS) == expected
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            assert pool.map(query_shared, [shm_name] * 4) == [expected] * 4
+
+
+def test_shared_outlives_attached_process(reference, reference_seqs):
+    path = [os.path.join(os.path.dirname(__file__), '..')]
+    with Sequence(reference) as seq:
+        shm_name = seq.share()
+        for _ in range(2):
+            result = subprocess.run(
+                [sys.executable, '-c',
+                 _ATTACH_CODE.format(path=path, shm_name=shm_name)],
+                capture_output=True, text=True, check=True)
+            assert result.stdout == reference_seqs['chr2'][10:20] + '\n'
+            assert 'leaked' not in result.stderr
+        with Sequence.attach(shm_name) as shared_seq:
+            assert shared_seq.query_region(REGIONS[0]) == \
+                reference_seqs['chr1'][:100]
+    with pytest.raises(FileNotFoundError):
+        Sequence.attach(shm_name)
+
+
+def test_fai_table(reference, reference_seqs):
+    with Sequence(reference, save_index=True) as seq:
+        fai_data = dict(seq.fai_data)
+        assert isinstance(seq.fai_data, dict)
+    assert os.path.isfile(reference + '.fai.bin')
+    with Sequence(reference) as seq:
+        assert isinstance(seq.fai_data, _FaiTable)
+        assert list(seq.chrom_list) == list(reference_seqs)
+        assert dict(seq.fai_data) == fai_data
+        assert 'chr3' in seq.fai_data and 'no_chrom' not in seq.fai_data
+        assert seq.fai_data['chr3'] is seq.fai_data['chr3']
+        with pytest.raises(KeyError):
+            seq.fai_data['no_chrom']
+        assert seq.query_region(Region('chr2')) == reference_seqs['chr2']
+
+    # the binary index is stale once the fai changes
+    fai_stat = os.stat(reference + '.fai')
+    os.utime(reference + '.fai', ns=(fai_stat.st_atime_ns,
+                                     fai_stat.st_mtime_ns + 1000))
+    with Sequence(reference) as seq:
+        assert isinstance(seq.fai_data, dict)
+        assert seq.fai_data == fai_data
+
+
+def test_fai_table_pack():
+    fai_data = {'chr{}'.format(ichrom): {'chrom_len': ichrom,
+                                         'byte_offset': 10 * ichrom,
+                                         'line_nbase': 60,
+                                         'line_nchar': 61}
+                for ichrom in range(300, 0, -1)}
+    fai_table = _FaiTable(_FaiTable.pack(fai_data, list(fai_data)))
+    assert list(fai_table.names()) == list(fai_data)
+    assert len(fai_table) == len(fai_data)
+    assert all(fai_table[chrom] == entry for chrom, entry in fai_data.items())
+    assert 'chr0' not in fai_table and 0 not in fai_table
+    fai_table.release()
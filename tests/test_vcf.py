@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Allele normalization against known bcftools norm results, and VCF
+annotation."""
+
+import io
+
+import pytest
+
+from conftest import write_fasta
+from sequence import Sequence
+from vcf import INFO_HEADERS, _RefBuffer, normalize_alleles, annotate_vcf
+
+SEQS = {
+    #        1   5    10   15   20   25   30
+    'chrT': 'TTACACACAGGGGGCTTTTTAAAGCGCGCATATATCCGGA' * 3,
+    'chrS': 'AAAACGTTGCA' * 5,
+}
+
+# (chrom, pos, alleles) -> (pos, alleles) as given by bcftools norm
+NORM_CASES = [
+    # CA deleted in the ACACACA repeat, shifted to its start
+    (('chrT', 7, ['ACA', 'A']), (2, ['TAC', 'T'])),
+    (('chrT', 8, ['CA', '']), (2, ['TAC', 'T'])),
+    # GG inserted in the G run
+    (('chrT', 13, ['G', 'GGG']), (9, ['A', 'AGG'])),
+    # shared last bases trimmed, shared first bases trimmed
+    (('chrT', 15, ['CTT', 'CT']), (15, ['CT', 'C'])),
+    (('chrT', 10, ['GGGGGC', 'GGGGC']), (9, ['AG', 'A'])),
+    # multiallelic deletion and insertion
+    (('chrT', 7, ['ACA', 'A', 'ACACA']), (2, ['TAC', 'T', 'TACAC'])),
+    # di-nucleotide repeat GCGCGC
+    (('chrT', 27, ['CGC', 'C']), (23, ['AGC', 'A'])),
+    # at the chrom start: padded on the right
+    (('chrS', 2, ['AA', 'A']), (1, ['AA', 'A'])),
+    (('chrS', 1, ['AAAA', 'AAA']), (1, ['AA', 'A'])),
+    # SNV and MNP are left as they are
+    (('chrT', 5, ['A', 'G']), (5, ['A', 'G'])),
+    (('chrT', 5, ['AC', 'GT']), (5, ['AC', 'GT'])),
+]
+
+
+@pytest.fixture
+def small_reference(tmp_path):
+    fasta_name = str(tmp_path / 'small.fa')
+    write_fasta(fasta_name, SEQS, line_width=13)
+    return fasta_name
+
+
+@pytest.mark.parametrize('variant, expected', NORM_CASES)
+def test_normalize_alleles(small_reference, variant, expected):
+    with Sequence(small_reference) as seq:
+        ref_buffer = _RefBuffer(seq, block_nbase=16, back_nbase=8)
+        assert normalize_alleles(ref_buffer, *variant) == expected
+
+
+def test_ref_buffer(reference, reference_seqs):
+    with Sequence(reference) as seq:
+        ref_buffer = _RefBuffer(seq, block_nbase=100, back_nbase=20)
+        for chrom in ('chr1', 'chr2', 'chr1'):
+            chrom_seq = reference_seqs[chrom].upper()
+            for start in range(-5, len(chrom_seq) + 5, 37):
+                for end in (start + 1, start + 30, start + 250):
+                    assert ref_buffer.fetch(chrom, start, end).decode() == \
+                        chrom_seq[max(start, 0):max(end, 0)]
+                # before the buffer
+                assert ref_buffer.fetch(chrom, start - 50, start).decode() \
+                    == chrom_seq[max(start - 50, 0):max(start, 0)]
+        assert ref_buffer.fetch('no_chrom', 0, 10) == b''
+
+
+def vcf_line(chrom, pos, ref, alt, info='.'):
+    return '\t'.join([chrom, str(pos), '.', ref, alt, '50', 'PASS', info,
+                      'GT', '0/1']) + '\n'
+
+
+def test_annotate_vcf(small_reference):
+    header = ['##fileformat=VCFv4.2\n',
+              '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n']
+    records = [vcf_line(chrom, pos, alleles[0], ','.join(alleles[1:]))
+               for (chrom, pos, alleles), _ in NORM_CASES
+               if all(alleles) and chrom == 'chrT']
+    records.sort(key=lambda line: int(line.split('\t')[1]))
+    records += [vcf_line('chrT', 36, 'c', 't'),
+                vcf_line('chrT', 40, 'A', 'T', 'DP=3'),
+                vcf_line('chrT', 50, 'gcg', 'G'),
+                vcf_line('chrUn', 5, 'A', 'C'),
+                vcf_line('chrS', 2, 'AA', 'A'),
+                vcf_line('chrS', 54, 'TGCA', 'T')]
+    out_file = io.StringIO()
+    with Sequence(small_reference) as seq:
+        counts = annotate_vcf(seq, header + records, out_file, context=3,
+                              max_shift=20)
+    lines = out_file.getvalue().splitlines(True)
+    assert lines[:4] == header[:1] + [info + '\n' for info in INFO_HEADERS]
+    assert lines[4] == header[1]
+    out_records = [line.rstrip('\n').split('\t') for line in lines[5:]]
+    assert len(out_records) == len(records)
+    assert counts == {'records': len(records), 'ref_mismatch': 2,
+                      'normalized': 7, 'unknown_chrom': 1}
+
+    # sorted per chrom after normalization
+    chroms = [fields[0] for fields in out_records]
+    assert chroms == sorted(chroms, key=['chrT', 'chrUn', 'chrS'].index)
+    for chrom in set(chroms):
+        positions = [int(fields[1]) for fields in out_records
+                     if fields[0] == chrom]
+        assert positions == sorted(positions)
+
+    expected = {}
+    for (chrom, pos, alleles), (new_pos, new_alleles) in NORM_CASES:
+        if all(alleles):
+            expected[chrom, '{}:{}:{}'.format(pos, alleles[0],
+                                              ','.join(alleles[1:]))] = \
+                (new_pos, new_alleles)
+    for fields in out_records:
+        chrom, pos, ref, alt, info = (fields[0], int(fields[1]), fields[3],
+                                      fields[4], fields[7].split(';'))
+        assert fields[8:] == ['GT', '0/1']
+        if chrom == 'chrUn':
+            assert info == ['.']
+            continue
+        chrom_seq = SEQS[chrom]
+        ref_bases = chrom_seq[pos - 1:pos - 1 + len(ref)]
+        assert info[-1] == 'REFCTX={}[{}]{}'.format(
+            chrom_seq[max(pos - 4, 0):pos - 1], ref_bases,
+            chrom_seq[pos - 1 + len(ref):pos + 2 + len(ref)])
+        old_var = [field[7:] for field in info
+                   if field.startswith('OLDVAR=')]
+        if old_var:
+            assert (pos, [ref] + alt.split(',')) == \
+                expected[chrom, old_var[0]]
+        elif ref.upper() != ref_bases:
+            assert info[-2] == 'REFMISMATCH=' + ref_bases
+        if (chrom, pos) == ('chrT', 40):
+            assert info[0] == 'DP=3'
+    assert ['chrS', '1', 'AA', 'A'] in [fields[:2] + fields[3:5]
+                                        for fields in out_records]
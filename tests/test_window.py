@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Window statistics against brute force over python strings."""
+
+import io
+import re
+import itertools
+
+import pytest
+
+from sequence import Sequence
+from region import Region
+from window import WINDOW_COLUMNS, scan_windows, write_window_table
+
+
+def window_row(seq, kmer_size):
+    """Statistics of a window as documented by scan_windows()."""
+    seq = seq.upper()
+    acgt = sum(seq.count(base) for base in 'ACGT')
+    runs = [len(run) for run in re.findall(r'A+|C+|G+|T+', seq)]
+    row = {
+        'length': len(seq),
+        'gc_frac': (seq.count('G') + seq.count('C')) / acgt if acgt else None,
+        'n_frac': (len(seq) - acgt) / len(seq),
+        'cpg_count': sum(seq[i:i + 2] == 'CG' for i in range(len(seq))),
+        'max_homopolymer': max(runs, default=0),
+    }
+    kmers = itertools.product('ACGT', repeat=kmer_size) if kmer_size else []
+    for kmer in map(''.join, kmers):
+        row['kmer_' + kmer] = sum(seq[i:i + kmer_size] == kmer
+                                  for i in range(len(seq)))
+    return row
+
+
+def expected_rows(seqs, regions, window_size, step, kmer_size):
+    rows = []
+    for region in regions:
+        seq = seqs[region.chrom]
+        pstart = 1 if region.length == -1 else region.pstart
+        pend = len(seq) if region.length == -1 else min(region.pend,
+                                                        len(seq))
+        for start in range(pstart, pend + 1, step):
+            end = min(start + window_size - 1, pend)
+            row = window_row(seq[start - 1:end], kmer_size)
+            row.update(chrom=region.chrom, pstart=start, pend=end)
+            rows.append(row)
+    return rows
+
+
+def table_rows(tables):
+    return [dict(zip(table, row)) for table in tables
+            for row in zip(*table.values())]
+
+
+@pytest.mark.parametrize('mode', ['file', '2bit'])
+@pytest.mark.parametrize('window_size, step, kmer_size, block_nbase', [
+    (100, None, 0, 4194304),
+    (100, 30, 2, 250),
+    (7, 3, 3, 10),
+    (1000, 1000, 1, 1),
+])
+def test_scan_windows(reference, reference_seqs, mode, window_size, step,
+                      kmer_size, block_nbase):
+    if mode == '2bit':
+        seqs = {chrom: re.sub('[^ACGTacgt]', 'N', seq)
+                for chrom, seq in reference_seqs.items()}
+    else:
+        seqs = reference_seqs
+    regions = [Region('chr1'), Region('chr2', 100, 1000),
+               Region('chrM', 50, 500), Region('tiny'),
+               Region('no_chrom', 1, 10)]
+    with Sequence(reference, mode=mode) as seq:
+        tables = list(scan_windows(seq, regions, window_size, step,
+                                   kmer_size, block_nbase))
+        assert table_rows(scan_windows(seq, None, window_size, step)) == \
+            [{column: row[column] for column in WINDOW_COLUMNS}
+             for row in expected_rows(seqs, map(Region, seqs), window_size,
+                                      step or window_size, 0)]
+    rows = table_rows(tables)
+    expected = expected_rows(seqs, regions[:-1], window_size,
+                             step or window_size, kmer_size)
+    assert [row.keys() for row in rows] == [row.keys() for row in expected]
+    for row, expected_row in zip(rows, expected):
+        assert row == pytest.approx(expected_row), row
+
+
+def test_write_window_table(reference):
+    with Sequence(reference) as seq:
+        out_file = io.StringIO()
+        write_window_table(scan_windows(seq, [Region('chrM')], 30, None, 1),
+                           out_file, kmer_size=1)
+    lines = [line.split('\t') for line in out_file.getvalue().splitlines()]
+    assert lines[0] == list(WINDOW_COLUMNS) + ['kmer_A', 'kmer_C', 'kmer_G',
+                                               'kmer_T']
+    assert [line[:4] for line in lines[1:]] == [
+        ['chrM', '1', '30', '30'], ['chrM', '31', '60', '30'],
+        ['chrM', '61', '61', '1']]
+    assert all(len(line) == len(lines[0]) for line in lines)
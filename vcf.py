@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""This module annotates VCF records with their reference context.
+
+    annotate_vcf() stream the records of a sorted VCF, check their REF allele
+    against the reference, left-normalize indels and add the reference
+    context of every variant to its INFO field.
+
+        Example:
+
+            $ python3 vcf.py -f ref.fa -i calls.vcf.gz -o annotated.vcf -c 10
+
+    Reference bases are read through a sliding buffer per chromosome (one
+    large sequential read per block_nbase bases) instead of one query per
+    record.
+
+"""
+
+import sys
+import gzip
+import heapq
+import logging
+import argparse
+
+from sequence import Sequence
+
+logger = logging.getLogger(__name__)
+
+INFO_HEADERS = (
+    '##INFO=<ID=REFCTX,Number=1,Type=String,Description="Reference bases '
+    'around the variant, reference bases of REF in brackets">',
+    '##INFO=<ID=REFMISMATCH,Number=1,Type=String,Description="REF allele '
+    'does not match the reference, which reads this">',
+    '##INFO=<ID=OLDVAR,Number=1,Type=String,Description="POS:REF:ALT before '
+    'left normalization">',
+)
+
+
+class _RefBuffer(object):
+    """A sliding window of reference bases over one chromosome at a time.
+
+    Requests must come in increasing order of start position (per chrom),
+    up to back_nbase bases before the previous ones; the buffer keeps the
+    last back_nbase bases when it slides forward. Requests before the buffer
+    are served by a direct read.
+    """
+
+
+    def __init__(self, sequence, block_nbase=1048576, back_nbase=2048):
+        """Initialize a _RefBuffer object on a Sequence object.
+
+        Args:
+            sequence: Sequence object of the reference
+            block_nbase: number of bases read at a time (int)
+            back_nbase: number of bases kept before the last request (int)
+        """
+        self.sequence = sequence
+        self.block_nbase = block_nbase
+        self.back_nbase = back_nbase
+        self.chrom = None
+        self.chrom_len = 0
+        self.buf_start = 0
+        self.buf = b''
+
+
+    def fetch(self, chrom, start, end):
+        """Return upper case bases of chrom in 0-based half-open [start, end),
+        clipped to the chromosome (empty if chrom is not in the reference)."""
+        if chrom != self.chrom:
+            fai = self.sequence.fai_data.get(chrom)
+            if fai is None:
+                return b''
+            self.chrom = chrom
+            self.chrom_len = fai['chrom_len']
+            self.buf_start = 0
+            self.buf = b''
+        start = max(start, 0)
+        end = min(end, self.chrom_len)
+        if start >= end:
+            return b''
+        if start < self.buf_start:
+            return self._read(start, end)
+        buf_end = self.buf_start + len(self.buf)
+        if end > buf_end:
+            new_start = max(start - self.back_nbase, 0)
+            new_end = min(max(end, new_start + self.block_nbase),
+                          self.chrom_len)
+            if self.buf_start <= new_start < buf_end:
+                self.buf = (self.buf[new_start - self.buf_start:] +
+                            self._read(buf_end, new_end))
+            else:
+                self.buf = self._read(new_start, new_end)
+            self.buf_start = new_start
+        return self.buf[start - self.buf_start:end - self.buf_start]
+
+
+    def _read(self, start, end):
+        """Read upper case bases in 0-based half-open [start, end)."""
+        return self.sequence.fetch(self.chrom, start, end).upper()
+
+
+def _is_simple(allele):
+    """Check if an allele is a plain base string (not symbolic/breakend)."""
+    return allele.isalpha() and allele.isascii()
+
+
+def normalize_alleles(ref_buffer, chrom, pos, alleles, max_shift=1000):
+    """Left-align and trim alleles (the first one is REF) on the reference.
+
+    Shared last bases are removed (moving left, and extending the alleles
+    with the reference base before them when one becomes empty), then
+    shared first bases are removed while every allele keeps one base.
+
+    Args:
+        ref_buffer: _RefBuffer object of the reference
+        chrom: chromosome name (string)
+        pos: 1-based position of the alleles (int)
+        alleles: list of upper case allele strings, REF first
+        max_shift: max number of bases to move left (int)
+
+    Returns:
+        (pos, alleles): normalized 1-based position and alleles
+    """
+    min_pos = max(pos - max_shift, 1)
+    while True:
+        if all(alleles) and len(set(allele[-1] for allele in alleles)) == 1:
+            alleles = [allele[:-1] for allele in alleles]
+        elif not all(alleles) and pos > min_pos:
+            pos -= 1
+            base = ref_buffer.fetch(chrom, pos - 1, pos).decode()
+            alleles = [base + allele for allele in alleles]
+        else:
+            break
+    if not all(alleles):
+        # at the start of the chromosome (or max_shift): pad on the right
+        base = ref_buffer.fetch(chrom, pos - 1 + len(alleles[0]),
+                                pos + len(alleles[0])).decode()
+        alleles = [allele + base for allele in alleles]
+    while (min(map(len, alleles)) >= 2 and
+           len(set(allele[0] for allele in alleles)) == 1):
+        alleles = [allele[1:] for allele in alleles]
+        pos += 1
+    return pos, alleles
+
+
+def annotate_vcf(sequence, vcf_file, out_file, context=10, normalize=True,
+                 max_shift=1000, block_nbase=1048576):
+    """Validate, normalize and annotate the records of a sorted VCF.
+
+    REF alleles are compared (case insensitive) to the reference; records
+    with a mismatching REF are flagged with INFO REFMISMATCH and left as is.
+    Records with plain base alleles are left-normalized (see
+    normalize_alleles()), the original POS:REF:ALT going to INFO OLDVAR, and
+    every record on a reference chrom gets INFO REFCTX. As normalization
+    moves records left, output records are re-sorted within max_shift bases.
+
+    Args:
+        sequence: Sequence object of the reference
+        vcf_file: iterable of VCF lines (file object)
+        out_file: output file object
+        context: number of reference bases on both sides in REFCTX (int)
+        normalize: left-normalize indels (bool)
+        max_shift: max number of bases a record moves left (int)
+        block_nbase: number of reference bases read at a time (int)
+
+    Returns:
+        a dictionary of counts: records, ref_mismatch, normalized,
+        unknown_chrom
+    """
+    ref_buffer = _RefBuffer(sequence, block_nbase, max_shift + context + 1)
+    counts = dict.fromkeys(('records', 'ref_mismatch', 'normalized',
+                            'unknown_chrom'), 0)
+    # heap of (pos, record number, line) of the current chrom, written once
+    # no later record can be normalized before them
+    pending = []
+    pending_chrom = None
+
+    for line in vcf_file:
+        if line.startswith('#'):
+            if line.startswith('#CHROM'):
+                out_file.write(''.join(header + '\n'
+                                       for header in INFO_HEADERS))
+            out_file.write(line)
+            continue
+        fields = line.rstrip('\r\n').split('\t', 8)
+        chrom, pos = fields[0], int(fields[1])
+        counts['records'] += 1
+        if chrom != pending_chrom:
+            while pending:
+                out_file.write(heapq.heappop(pending)[2])
+            pending_chrom = chrom
+        while pending and pending[0][0] < pos - max_shift:
+            out_file.write(heapq.heappop(pending)[2])
+
+        if chrom not in sequence.fai_data:
+            counts['unknown_chrom'] += 1
+            heapq.heappush(pending, (pos, counts['records'],
+                                     '\t'.join(fields) + '\n'))
+            continue
+        ref, alts = fields[3], fields[4].split(',')
+        info = [] if fields[7] == '.' else [fields[7]]
+        ref_bases = ref_buffer.fetch(chrom, pos - 1,
+                                     pos - 1 + len(ref)).decode()
+        ref_match = ref.upper() == ref_bases
+        if not ref_match:
+            counts['ref_mismatch'] += 1
+            info.append('REFMISMATCH=' + (ref_bases or '.'))
+        elif (normalize and all(map(_is_simple, alts)) and
+              any(len(alt) != len(ref) for alt in alts)):
+            new_pos, alleles = normalize_alleles(
+                ref_buffer, chrom, pos,
+                [allele.upper() for allele in [ref] + alts], max_shift)
+            if new_pos != pos or alleles[0] != ref.upper():
+                counts['normalized'] += 1
+                info.append('OLDVAR={}:{}:{}'.format(pos, ref, fields[4]))
+                pos, ref = new_pos, alleles[0]
+                fields[1], fields[3] = str(pos), ref
+                fields[4] = ','.join(alleles[1:])
+        left = ref_buffer.fetch(chrom, pos - 1 - context, pos - 1).decode()
+        right = ref_buffer.fetch(chrom, pos - 1 + len(ref),
+                                 pos - 1 + len(ref) + context).decode()
+        if ref_match:
+            # REF may have been normalized
+            ref_bases = ref.upper()
+        info.append('REFCTX={}[{}]{}'.format(left, ref_bases, right))
+        fields[7] = ';'.join(info)
+        heapq.heappush(pending, (pos, counts['records'],
+                                 '\t'.join(fields) + '\n'))
+
+    while pending:
+        out_file.write(heapq.heappop(pending)[2])
+    return counts
+
+
+def main():
+    """Wrapper of function annotate_vcf() with command line inputs."""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-f', '--fasta', metavar="fasta",
+                        help="reference FASTA file (with .fai)",
+                        type=str, required=True)
+    parser.add_argument('-i', '--input', metavar="vcf_name",
+                        help="input VCF (.vcf or .vcf.gz), sorted",
+                        type=str, required=True)
+    parser.add_argument('-o', '--output', metavar="out_name",
+                        help="output VCF (default: stdout)",
+                        type=str, required=False, default=None)
+    parser.add_argument('-c', '--context', metavar="num_base",
+                        help="reference bases on each side (default: 10)",
+                        type=int, required=False, default=10)
+    parser.add_argument('-n', '--no-normalize',
+                        help="do not left-normalize indels",
+                        action='store_true')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=':: %(message)s',
+                        stream=sys.stderr)
+
+    if args.input.endswith('.gz'):
+        vcf_file = gzip.open(args.input, 'rt')
+    else:
+        vcf_file = open(args.input)
+    out_file = open(args.output, 'w') if args.output else sys.stdout
+    with Sequence(args.fasta, mode='mmap') as sequence, vcf_file:
+        counts = annotate_vcf(sequence, vcf_file, out_file, args.context,
+                              not args.no_normalize)
+    if args.output:
+        out_file.close()
+    logger.info('%d records, %d REF mismatches, %d normalized, %d on '
+                'unknown chroms', counts['records'], counts['ref_mismatch'],
+                counts['normalized'], counts['unknown_chrom'])
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,163 @@
+import re
+import itertools
+import collections
+
+from region import Region
+
+
+# columns of the window table (followed by one column per k-mer)
+WINDOW_COLUMNS = ('chrom', 'pstart', 'pend', 'length', 'gc_frac', 'n_frac',
+                  'cpg_count', 'max_homopolymer')
+
+
+def scan_windows(sequence, regions=None, window_size=1000, step=None,
+                 kmer_size=0, block_nbase=4194304):
+    """Compute sequence statistics in sliding windows over the reference.
+
+    Windows of window_size bases start every step bases from the start of
+    each region (the last window of a region may be shorter). Sequence is
+    fetched block_nbase bases at a time and every statistic of a window is
+    computed by whole-window bytes operations (count, find, regex), no
+    python loop runs over bases.
+
+    Args:
+        sequence: Sequence object of the reference
+        regions: iterable of Region objects to scan (default: every chrom in
+            sequence.chrom_list), clipped to the chromosome length
+        window_size: number of bases per window (int)
+        step: distance between window starts (int, default: window_size)
+        kmer_size: also count every k-mer of this size (int, 0 for none)
+        block_nbase: number of bases fetched at a time (int)
+
+    Yields:
+        table: a dictionary of columns (lists of equal length) for the
+        windows of one block:
+            chrom, pstart, pend (1-based inclusive), length: window position
+            gc_frac: (G+C) / (A+C+G+T), None if the window is all N
+            n_frac: fraction of bases that are not A/C/G/T
+            cpg_count: number of CpG dinucleotides
+            max_homopolymer: longest run of a single base (A/C/G/T)
+            kmer_{KMER}: number of (overlapping) occurrences of each k-mer
+                if kmer_size > 0, k-mers in lexicographic order
+
+    """
+    step = step or window_size
+    if regions is None:
+        regions = [Region(chrom) for chrom in sequence.chrom_list]
+    kmers = _kmers(kmer_size)
+    nwindow_block = max(block_nbase // step, 1)
+
+    for region in regions:
+        if region.chrom not in sequence.fai_data:
+            continue
+        chrom_len = sequence.fai_data[region.chrom]['chrom_len']
+        if region.length == -1:
+            pstart, pend = 1, chrom_len
+        else:
+            pstart, pend = region.pstart, min(region.pend, chrom_len)
+        window_starts = range(pstart, pend + 1, step)
+        for iblock in range(0, len(window_starts), nwindow_block):
+            block_starts = window_starts[iblock:iblock + nwindow_block]
+            block_start = block_starts[0]
+            block_end = min(block_starts[-1] + window_size - 1, pend)
+            block_seq = sequence.fetch(region.chrom, block_start - 1,
+                                       block_end).upper()
+            yield _window_table(region.chrom, block_seq, block_start,
+                                block_starts, window_size, pend,
+                                kmers)
+
+
+def write_window_table(tables, out_file, kmer_size=0):
+    """Write the tables of scan_windows() as tab separated text.
+
+    Args:
+        tables: iterable of tables yielded by scan_windows()
+        out_file: output file object
+        kmer_size: k-mer size given to scan_windows() (int)
+
+    """
+    columns = list(WINDOW_COLUMNS)
+    columns += ['kmer_' + kmer for kmer in _kmers(kmer_size)]
+    out_file.write('\t'.join(columns) + '\n')
+    for table in tables:
+        rows = zip(*(table[column] for column in columns))
+        out_file.write(''.join('\t'.join('NA' if value is None else
+                                         '{:.4f}'.format(value)
+                                         if isinstance(value, float) else
+                                         str(value) for value in row) + '\n'
+                               for row in rows))
+
+
+def _window_table(chrom, block_seq, block_start, window_starts, window_size,
+                  pend, kmers):
+    """Compute the columns of the windows in a block of sequence."""
+    windows = [block_seq[start - block_start:
+                         min(start + window_size - 1, pend) - block_start + 1]
+               for start in window_starts]
+    lengths = list(map(len, windows))
+    count_a, count_c, count_g, count_t = (
+        list(map(bytes.count, windows, itertools.repeat(base)))
+        for base in (b'A', b'C', b'G', b'T'))
+    count_gc = list(map(int.__add__, count_c, count_g))
+    count_acgt = list(map(sum, zip(count_a, count_c, count_g, count_t)))
+
+    table = {
+        'chrom': [chrom] * len(windows),
+        'pstart': list(window_starts),
+        'pend': [start + length - 1
+                 for start, length in zip(window_starts, lengths)],
+        'length': lengths,
+        'gc_frac': [gc / acgt if acgt else None
+                    for gc, acgt in zip(count_gc, count_acgt)],
+        'n_frac': [(length - acgt) / length if length else 0.0
+                   for length, acgt in zip(lengths, count_acgt)],
+        'cpg_count': list(map(bytes.count, windows,
+                              itertools.repeat(b'CG'))),
+        'max_homopolymer': list(map(_max_homopolymer, windows)),
+    }
+    if kmers:
+        kmer_keys = [kmer.encode() for kmer in kmers]
+        kmer_rows = [_count_kmers(window, len(kmers[0]), kmer_keys)
+                     for window in windows]
+        for kmer, column in zip(kmers, zip(*kmer_rows)):
+            table['kmer_' + kmer] = list(column)
+    return table
+
+
+_LONG_HOMOPOLYMER = re.compile(rb'A{4,}|C{4,}|G{4,}|T{4,}')
+
+
+def _max_homopolymer(window):
+    """Return the longest run of a single base (A/C/G/T) in a window."""
+    runs = _LONG_HOMOPOLYMER.findall(window)
+    if runs:
+        return max(map(len, runs))
+    for run_len in (3, 2, 1):
+        if any(base * run_len in window for base in (b'A', b'C', b'G', b'T')):
+            return run_len
+    return 0
+
+
+def _kmers(kmer_size):
+    """Return every k-mer of a size (A/C/G/T) in lexicographic order."""
+    if kmer_size <= 0:
+        return []
+    return [''.join(kmer)
+            for kmer in itertools.product('ACGT', repeat=kmer_size)]
+
+
+def _count_kmers(window, kmer_size, kmer_keys):
+    """Count the (overlapping) k-mers of a window in one pass.
+
+    Every k-mer slice of the window is counted by a Counter over a map (no
+    python loop per base), then looked up for every k-mer of kmer_keys.
+
+    Returns:
+        a list of counts in the order of kmer_keys
+    """
+    nkmer = len(window) - kmer_size + 1
+    counter = collections.Counter(map(window.__getitem__,
+                                      map(slice, range(nkmer),
+                                          range(kmer_size,
+                                                nkmer + kmer_size))))
+    return list(map(counter.get, kmer_keys, itertools.repeat(0)))